@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+Streaming alert engine.
+
+Rules are evaluated incrementally as each sample arrives. Anything a
+rule needs to remember about the past is kept in rolling statistics
+that take constant time and memory per sample, so the cost of a sample
+only depends on the number of rules for its site and never on how much
+history there is.
+
+Samples are `samples.Sample` records.
+"""
+
+# system imports
+#
+import math
+from collections import deque, namedtuple, defaultdict
+
+# Project modules
+#
+from samples import GRID_UNKNOWN
+
+Alert = namedtuple(
+    "Alert", ["site", "rule", "firing", "value", "message", "timestamp"]
+)
+
+
+##################################################################
+##################################################################
+#
+class EWMA:
+    """
+    Exponentially weighted moving average.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.value = None
+
+    ####################################################################
+    #
+    def update(self, x):
+        if self.value is None:
+            self.value = x
+        else:
+            self.value += self.alpha * (x - self.value)
+        return self.value
+
+
+##################################################################
+##################################################################
+#
+class RollingMinMax:
+    """
+    Minimum and maximum over a sliding time window using monotonic
+    deques. Each value is pushed and popped at most once so updates are
+    amortized O(1).
+    """
+
+    ####################################################################
+    #
+    def __init__(self, window):
+        """
+        Keyword Arguments:
+        window -- length of the window in seconds
+        """
+        self.window = window
+        self.mins = deque()  # (t, value), values increasing
+        self.maxs = deque()  # (t, value), values decreasing
+
+    ####################################################################
+    #
+    def update(self, t, x):
+        """
+        Add value `x` seen at time `t` (seconds) and drop values that are
+        older than the window.
+        """
+        while self.mins and self.mins[-1][1] >= x:
+            self.mins.pop()
+        self.mins.append((t, x))
+        while self.maxs and self.maxs[-1][1] <= x:
+            self.maxs.pop()
+        self.maxs.append((t, x))
+
+        cutoff = t - self.window
+        while self.mins[0][0] <= cutoff:
+            self.mins.popleft()
+        while self.maxs[0][0] <= cutoff:
+            self.maxs.popleft()
+
+    ####################################################################
+    #
+    @property
+    def min(self):
+        return self.mins[0][1] if self.mins else None
+
+    ####################################################################
+    #
+    @property
+    def max(self):
+        return self.maxs[0][1] if self.maxs else None
+
+
+##################################################################
+##################################################################
+#
+class RollingPercentile:
+    """
+    Approximate percentiles over the last `size` values using a fixed
+    set of histogram bins. Adding a value and evicting the oldest are
+    O(1). A query walks the bins so it is O(number of bins), which is a
+    constant that does not grow with the window.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, size, low, high, bins=100):
+        """
+        Keyword Arguments:
+        size -- number of most recent values in the window
+        low  -- values below this are counted in the first bin
+        high -- values above this are counted in the last bin
+        bins -- number of bins between `low` and `high`
+        """
+        self.size = size
+        self.low = low
+        self.high = high
+        self.bin_width = (high - low) / bins
+        self.counts = [0] * bins
+        self.window = deque()
+
+    ####################################################################
+    #
+    def update(self, x):
+        """
+        Add `x` to the window. NaN, a missing reading, is ignored.
+        """
+        if math.isnan(x):
+            return
+        idx = int((x - self.low) / self.bin_width)
+        idx = min(max(idx, 0), len(self.counts) - 1)
+        self.counts[idx] += 1
+        self.window.append(idx)
+        if len(self.window) > self.size:
+            self.counts[self.window.popleft()] -= 1
+
+    ####################################################################
+    #
+    def percentile(self, p):
+        """
+        Return the value below which `p` percent of the window falls, as
+        the midpoint of the bin it lands in. None if we have no values.
+        """
+        if not self.window:
+            return None
+        target = p / 100 * len(self.window)
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return self.low + (idx + 0.5) * self.bin_width
+        return self.high
+
+
+##################################################################
+##################################################################
+#
+class Rule:
+    """
+    Base class for rules. Sub-classes implement `check()` which returns
+    a tuple of (condition, value, message) for a sample.
+
+    To keep a noisy value from flapping an alert on and off, the
+    condition must hold for `fire_after` samples in a row before the
+    alert fires and must be clear for `clear_after` samples in a row
+    before it resolves.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, name, fire_after=1, clear_after=1):
+        self.name = name
+        self.fire_after = fire_after
+        self.clear_after = clear_after
+        self.firing = False
+        self.streak = 0
+
+    ####################################################################
+    #
+    def check(self, sample):
+        raise NotImplementedError
+
+    ####################################################################
+    #
+    def evaluate(self, site, sample):
+        """
+        Update the rule with a sample. Returns an `Alert` if the rule
+        started or stopped firing, otherwise None.
+        """
+        condition, value, message = self.check(sample)
+        if condition == self.firing:
+            self.streak = 0
+            return None
+        self.streak += 1
+        needed = self.clear_after if self.firing else self.fire_after
+        if self.streak < needed:
+            return None
+        self.firing = condition
+        self.streak = 0
+        return Alert(
+            site, self.name, self.firing, value, message, sample.timestamp
+        )
+
+
+##################################################################
+##################################################################
+#
+class GridDownRule(Rule):
+    """
+    Fires when the gateway says we are not connected to the grid.
+    Samples that do not know the grid status leave the alert as it is.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, name="grid_down", **kwargs):
+        super().__init__(name, **kwargs)
+
+    ####################################################################
+    #
+    def check(self, sample):
+        status = sample.grid_status_name
+        if sample.grid_status == GRID_UNKNOWN:
+            return self.firing, status, f"Grid status: {status}"
+        return (
+            not sample.grid_connected,
+            status,
+            f"Grid status: {status}",
+        )
+
+
+##################################################################
+##################################################################
+#
+class BatteryReserveRule(Rule):
+    """
+    Fires when the battery charge is within `margin` percent of the
+    backup reserve. Samples without a battery reading leave the alert as
+    it is.
+    """
+
+    ####################################################################
+    #
+    def __init__(
+        self, reserve_pct, margin=5.0, name="battery_reserve", **kwargs
+    ):
+        super().__init__(name, **kwargs)
+        self.reserve_pct = reserve_pct
+        self.margin = margin
+
+    ####################################################################
+    #
+    def check(self, sample):
+        pct = sample.battery_pct
+        if math.isnan(pct):
+            return self.firing, pct, "Battery: no reading"
+        return (
+            pct <= self.reserve_pct + self.margin,
+            pct,
+            f"Battery at {pct:.1f}%, reserve is {self.reserve_pct}%",
+        )
+
+
+##################################################################
+##################################################################
+#
+class LowSolarRule(Rule):
+    """
+    Fires when solar output is well below what is normal for this time
+    of day. The day is split in to `slots` and each slot keeps an EWMA
+    of the solar output seen in it on previous days. Samples without a
+    solar reading leave the alert and the baselines as they are.
+    """
+
+    ####################################################################
+    #
+    def __init__(
+        self,
+        factor=0.5,
+        min_baseline=200.0,
+        slots=96,
+        alpha=0.1,
+        tz=None,
+        name="low_solar",
+        **kwargs,
+    ):
+        """
+        Keyword Arguments:
+        factor       -- fire when solar < factor * the slot's baseline
+        min_baseline -- ignore slots whose baseline is below this many
+                        watts (night, dawn, dusk)
+        slots        -- how many time of day slots to split a day in to
+        alpha        -- EWMA weight given to each new sample
+        tz           -- timezone the time of day is taken in. Defaults
+                        to the local timezone
+        """
+        kwargs.setdefault("fire_after", 15)
+        kwargs.setdefault("clear_after", 5)
+        super().__init__(name, **kwargs)
+        self.factor = factor
+        self.min_baseline = min_baseline
+        self.tz = tz
+        self.slot_secs = 86400 // slots
+        self.baselines = [EWMA(alpha) for _ in range(slots)]
+
+    ####################################################################
+    #
+    def check(self, sample):
+        solar = sample.solar
+        if math.isnan(solar):
+            return self.firing, solar, "Solar: no reading"
+        ts = sample.as_datetime(self.tz)
+        secs = ts.hour * 3600 + ts.minute * 60 + ts.second
+        baseline = self.baselines[secs // self.slot_secs]
+        expected = baseline.value
+        low = (
+            expected is not None
+            and expected >= self.min_baseline
+            and solar < self.factor * expected
+        )
+        # Do not let an unusually bad day drag the baseline down.
+        #
+        if not low:
+            baseline.update(solar)
+        return (
+            low,
+            solar,
+            f"Solar {solar:.0f}W, usually {expected or 0:.0f}W at this time",
+        )
+
+
+##################################################################
+##################################################################
+#
+class ThresholdRule(Rule):
+    """
+    Generic rule that fires when a rolling statistic of a sample field
+    crosses a threshold.
+
+    `stat` is one of:
+    - None: the raw value
+    - ('ewma', alpha)
+    - ('min', window_secs) or ('max', window_secs)
+    - ('percentile', p, size, low, high)
+
+    A sample with no reading for the field, NaN, leaves the alert and
+    the statistic as they are.
+    """
+
+    ####################################################################
+    #
+    def __init__(
+        self, name, field, threshold, above=True, stat=None, **kwargs
+    ):
+        super().__init__(name, **kwargs)
+        self.field = field
+        self.threshold = threshold
+        self.above = above
+        self.stat = stat
+        kind = stat[0] if stat else None
+        if kind == "ewma":
+            self.tracker = EWMA(stat[1])
+        elif kind in ("min", "max"):
+            self.tracker = RollingMinMax(stat[1])
+        elif kind == "percentile":
+            self.tracker = RollingPercentile(*stat[2:])
+        else:
+            self.tracker = None
+
+    ####################################################################
+    #
+    def check(self, sample):
+        x = getattr(sample, self.field)
+        if math.isnan(x):
+            return self.firing, x, f"{self.name}: no {self.field} reading"
+        kind = self.stat[0] if self.stat else None
+        if kind == "ewma":
+            value = self.tracker.update(x)
+        elif kind in ("min", "max"):
+            self.tracker.update(sample.timestamp, x)
+            value = getattr(self.tracker, kind)
+        elif kind == "percentile":
+            self.tracker.update(x)
+            value = self.tracker.percentile(self.stat[1])
+        else:
+            value = x
+        if self.above:
+            crossed = value > self.threshold
+        else:
+            crossed = value < self.threshold
+        return (
+            crossed,
+            value,
+            f"{self.name}: {self.field} {value:.1f} "
+            f"{'>' if self.above else '<'} {self.threshold}",
+        )
+
+
+##################################################################
+##################################################################
+#
+class AlertEngine:
+    """
+    Holds the rules for every site and runs each new sample through the
+    rules for its site.
+    """
+
+    ####################################################################
+    #
+    def __init__(self):
+        self.rules = defaultdict(list)
+
+    ####################################################################
+    #
+    def add_rule(self, site, rule):
+        self.rules[site].append(rule)
+
+    ####################################################################
+    #
+    def process(self, site, sample):
+        """
+        Evaluate a sample for `site`. Returns the list of `Alert`s that
+        started or stopped firing because of it. Gap markers have nothing
+        to evaluate.
+        """
+        if sample.is_gap:
+            return []
+        alerts = []
+        for rule in self.rules[site]:
+            alert = rule.evaluate(site, sample)
+            if alert is not None:
+                alerts.append(alert)
+        return alerts
+
+    ####################################################################
+    #
+    def firing(self):
+        """
+        Return (site, rule name) for every rule currently firing.
+        """
+        return [
+            (site, rule.name)
+            for site, rules in self.rules.items()
+            for rule in rules
+            if rule.firing
+        ]
+
+
+####################################################################
+#
+def default_engine(site, reserve_pct, tz=None):
+    """
+    Return an `AlertEngine` with the grid down, battery near reserve
+    and low solar rules set up for `site`. `tz` is the site's timezone.
+    """
+    engine = AlertEngine()
+    engine.add_rule(site, GridDownRule())
+    engine.add_rule(site, BatteryReserveRule(reserve_pct, clear_after=5))
+    engine.add_rule(site, LowSolarRule(tz=tz))
+    return engine
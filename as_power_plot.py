@@ -4,21 +4,33 @@
 #
 """
 Continuously plot powerwall and solar roof data via matplotlib.
+
+Each sample is published once to a `sinks.FanOut`. The history file,
+the alert rules, and, if they are configured, influxdb and an MQTT
+broker each get it from their own queue in their own thread so none of
+them can hold up sampling. The plot is drawn from the matplotlib loop.
+
+influxdb is written to if INFLUX_SPOOL_DIR is set, through a spool in
+that directory, with the credentials from vault at INFLUXDB_CREDS_PATH.
+Samples are published to MQTT_TOPIC on MQTT_HOST if it is set.
 """
 
 # system imports
 #
 import os
-import json
-from pathlib import Path
+import time
 import pprint
-from datetime import datetime
+from pathlib import Path
+from collections import deque
 
 # 3rd party modules
 #
-import pytz
-from tesla_powerwall import Powerwall, MeterType
-from tesla_powerwall.error import PowerwallUnreachableError
+from tesla_powerwall import Powerwall
+from tesla_powerwall.error import (
+    APIError,
+    AccessDeniedError,
+    PowerwallUnreachableError,
+)
 
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
@@ -29,6 +41,22 @@ from dotenv import load_dotenv
 # Project modules
 #
 from utils import get_hvac_client
+from sinks import (
+    BLOCK,
+    AlertSink,
+    FanOut,
+    HistorySink,
+    MqttSink,
+    SeriesSink,
+    SpoolSink,
+)
+from alerts import default_engine
+from history import TIMEZONE, HistoryWriter, load_range
+from samples import METERS, Sample, grid_status_code
+from metric_schema import SCHEMA
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from gapfill import GapFiller
+from profiler import Profiler
 
 # XXX Should move dotenv processing in to `main()` and pass configured
 # values as parameters instead of module level attributes.
@@ -37,13 +65,21 @@ load_dotenv()
 
 VAULT_SECRETS_PATH = os.getenv("VAULT_SECRETS_PATH")
 POWERWALL_HOST = os.getenv("BACKUP_GW_ADDR")
-TIMEZONE = pytz.timezone("US/Pacific")
 NUM_SAMPLE_HORIZON = 1440  # 1 day at 1 minute between samples
 PLOT_INTERVAL = 1000 * 60  # once a minute
-HISTORY_FILE_DIR = Path(os.getenv("HISTORY_FILE_DIR")).expanduser()
-LAST_DAY_FILE = HISTORY_FILE_DIR / "last_24h.json"
-HISTORY_FILE_FMT = "%Y-%m-%d_data.json"
-DATE_FMT = "%Y-%m-%d_%H:%M:%S%z"
+PROBE_TIMEOUT = 2  # seconds
+
+# What the gateway raises when it is down, restarting, or will not let
+# us log in again. All failures for the circuit breaker.
+#
+GATEWAY_ERRORS = (PowerwallUnreachableError, APIError, AccessDeniedError)
+SITE_NAME = os.getenv("SITE_NAME", "as01")
+BACKUP_RESERVE_PCT = float(os.getenv("BACKUP_RESERVE_PCT", "20"))
+INFLUX_SPOOL_DIR = os.getenv("INFLUX_SPOOL_DIR")
+INFLUXDB_CREDS_PATH = os.getenv("INFLUXDB_CREDS_PATH")
+MQTT_HOST = os.getenv("MQTT_HOST")
+MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
+MQTT_TOPIC = os.getenv("MQTT_TOPIC", f"powerwall/{SITE_NAME}/sample")
 PP = pprint.PrettyPrinter(indent=2)
 
 
@@ -63,92 +99,254 @@ def get_login_credentials():
 
 ####################################################################
 #
-def draw_plot(i, creds, ax, ax2, x_axis, meter_values, battery_pct):
+def read_sample(powerwall, schema=SCHEMA):
     """
-    Read values from the powerwall and plot them vs time.
+    Read a `Sample` with the columns in the metric schema from the
+    backup gateway. Endpoints nothing in the schema comes from are not
+    requested.
+    """
+    sample = schema.new_sample(time.time())
+    if "battery_pct" in schema:
+        sample.battery_pct = powerwall.get_charge()
+    if "grid_status" in schema:
+        sample.grid_status = grid_status_code(powerwall.get_grid_status())
+    if schema.meters:
+        schema.read_meters(sample, powerwall.get_meters().response)
+    return sample
 
-    Keyword Arguments:
-    i            --
-    creds        --
-    x_axis       --
-    meter_values --
-    battery_pct  --
+
+####################################################################
+#
+def gateway_breaker():
     """
-    powerwall = Powerwall(POWERWALL_HOST)
-    try:
+    Return a `CircuitBreaker` for reads from the backup gateway. While
+    it is open its probes are a status request with a short timeout.
+    """
+    probe = Powerwall(POWERWALL_HOST, timeout=PROBE_TIMEOUT)
+    return CircuitBreaker(
+        "gateway",
+        max_delay=PLOT_INTERVAL / 1000,
+        errors=GATEWAY_ERRORS,
+        probe=probe.get_version,
+    )
+
+
+####################################################################
+#
+def read_gateway(powerwall, creds):
+    """
+    Read a sample from the gateway, logging in first if we are not
+    logged in or the gateway has forgotten our login, as it does when
+    it restarts.
+    """
+    if powerwall.get_pinned_version() is None:
         powerwall.detect_and_pin_version()
-    except PowerwallUnreachableError as e:
-        print(e)
-        return
-    _ = powerwall.login(creds["password"])
-
-    # Get new values..
-    now = datetime.now(tz=pytz.utc)
-    now = now.astimezone(TIMEZONE)
-    x_axis.append(now)
-    battery_pct.append(powerwall.get_charge())
-    meters = powerwall.get_meters()
-    for meter_type in MeterType:
-        meter = meters.get_meter(meter_type)
-        meter_type = meter_type.value
-        meter_values[meter_type].append(meter.instant_power)
-
-    # Truncate at our horizon for number of samples to keep
-    #
-    x_axis = x_axis[-NUM_SAMPLE_HORIZON:]
-    battery_pct = battery_pct[-NUM_SAMPLE_HORIZON:]
-    for meter_type in MeterType:
-        meter_type = meter_type.value
-        meter_values[meter_type] = meter_values[meter_type][
-            -NUM_SAMPLE_HORIZON:
-        ]
-
-    # Write our file out to both by-date and last 24h files as json
-    #
-    data = {
-        "meter_values": meter_values,
-        "x_axis": [x.strftime(DATE_FMT) for x in x_axis],
-        "battery_pct": battery_pct,
-    }
+    if not powerwall.is_authenticated():
+        powerwall.login(creds["password"])
     try:
-        with open(LAST_DAY_FILE, "w") as f:
-            json.dump(data, f)
-        today_file = HISTORY_FILE_DIR / now.strftime(HISTORY_FILE_FMT)
-        with open(today_file, "w") as f:
-            json.dump(data, f)
-    except Exception:
-        pass
+        return read_sample(powerwall)
+    except AccessDeniedError:
+        powerwall.login(creds["password"])
+        return read_sample(powerwall)
+
+
+####################################################################
+#
+def new_series(samples=()):
+    """
+    Return the series of samples we plot. It only ever holds our
+    horizon of samples, older ones drop off as new ones are added.
+    """
+    return deque(samples, maxlen=NUM_SAMPLE_HORIZON)
+
 
+####################################################################
+#
+def render_plot(ax, ax2, series):
+    """
+    Plot the meters and battery charge vs time.
+    """
     ax.clear()
     ax2.clear()
 
+    # Matplotlib dates are days since the epoch.
+    #
+    x_axis = [s.timestamp / 86400 for s in series]
+
     legend_lines = []
     legend_names = []
-    for meter_type in MeterType:
-        meter_type = meter_type.value
-        (l,) = ax.plot(x_axis, meter_values[meter_type])
+    for meter in METERS:
+        (l,) = ax.plot(x_axis, [getattr(s, meter) for s in series])
         legend_lines.append(l)
-        legend_names.append(meter_type)
+        legend_names.append(meter)
 
     ax.set_ylabel("Wh")
     ax.grid(which="major", axis="both", color="grey")
 
-    (l,) = ax2.plot(x_axis, battery_pct, color="lightblue", linestyle="dashed")
+    (l,) = ax2.plot(
+        x_axis,
+        [s.battery_pct for s in series],
+        color="lightblue",
+        linestyle="dashed",
+    )
     legend_lines.append(l)
     legend_names.append("Battery % Chg")
     ax2.set_ylabel("% Chg")
     ax2.grid(which="major", color="lightblue", linestyle="dotted")
 
-    hours = mdates.HourLocator(interval=1)
-    h_fmt = mdates.DateFormatter("%H", tz=now.tzinfo)
+    hours = mdates.HourLocator(interval=1, tz=TIMEZONE)
+    h_fmt = mdates.DateFormatter("%H", tz=TIMEZONE)
     qtr_hr = mdates.MinuteLocator(byminute=[15, 30, 45], interval=1)
 
     ax.legend(legend_lines, legend_names, loc="best")
+    ax.xaxis_date(TIMEZONE)
     ax.xaxis.set_major_formatter(h_fmt)
     ax.xaxis.set_major_locator(hours)
     ax.xaxis.set_minor_locator(qtr_hr)
 
-    plt.title("AS Powerwall")
+    ax.set_title("AS Powerwall")
+
+
+####################################################################
+#
+def new_fanout(series, writer, alert_engine=None, timings=None):
+    """
+    Return a `sinks.FanOut` with the sinks every sample goes to: the
+    history, the alert rules, and the plot. replay.py uses it too so it
+    runs samples through exactly what the live plot does.
+
+    Losing history is worse than a short wait for the disk, the rest
+    can drop samples if they fall behind.
+
+    Keyword Arguments:
+    series       -- deque of samples from `new_series()`, written by the
+                    polled "plot" sink
+    writer       -- `history.HistoryWriter` the samples are saved with
+    alert_engine -- if not None, the `alerts.AlertEngine` the samples
+                    are run through
+    timings      -- if not None, a `profiler.Profiler` or
+                    `profiler.PhaseTimings` each sink's writes are timed
+                    by, as a phase named after the sink
+    """
+    fanout = FanOut(timings)
+    fanout.add(HistorySink(writer), overflow=BLOCK)
+    if alert_engine is not None:
+        fanout.add(AlertSink(alert_engine, SITE_NAME, TIMEZONE))
+    fanout.add(SeriesSink(series), polled=True)
+    return fanout
+
+
+####################################################################
+#
+def draw_plot(
+    i,
+    powerwall,
+    breaker,
+    creds,
+    ax,
+    ax2,
+    series,
+    fanout,
+    gap_filler=None,
+    profiler=None,
+):
+    """
+    Read values from the powerwall, publish them to the sinks, and plot
+    them vs time.
+
+    When the gateway can not be reached a gap marker is published at the
+    first failure. While the breaker is open we do not touch the network
+    at all.
+
+    Keyword Arguments:
+    i            --
+    powerwall    -- `Powerwall` kept between ticks
+    breaker      -- `CircuitBreaker` from `gateway_breaker()`
+    creds        --
+    series       -- deque of samples we are plotting
+    fanout       -- `sinks.FanOut` with a "history" sink and a polled
+                    "plot" sink for `series`
+    gap_filler   -- if not None, a `gapfill.GapFiller` whose backfilled
+                    samples are merged in to the history and plot
+    profiler     -- if not None, a `profiler.Profiler` each phase of the
+                    tick is timed with
+    """
+    timings = None if profiler is None else profiler.timings
+    filled = gap_filler.poll() if gap_filler is not None else []
+    if filled:
+        history = fanout.sink("history")
+        history.merge(filled)
+        now = time.time()
+        series.clear()
+        series.extend(load_range(now - 86400, now, history.writer.history_dir))
+        print(f"Backfilled {len(filled)} samples from the cloud")
+
+    t0 = time.perf_counter()
+    sample = None
+    try:
+        sample = breaker.call(read_gateway, powerwall, creds)
+    except CircuitOpenError:
+        pass
+    except GATEWAY_ERRORS as e:
+        print(e)
+        if breaker.failures == 1:
+            sample = Sample.gap(time.time())
+    t1 = time.perf_counter()
+    if sample is not None:
+        fanout.publish(sample)
+    t2 = time.perf_counter()
+    if fanout.poll("plot") or filled:
+        render_plot(ax, ax2, series)
+    t3 = time.perf_counter()
+    if timings is not None:
+        timings.add("fetch", t1 - t0)
+        timings.add("publish", t2 - t1)
+        timings.add("render", t3 - t2)
+
+
+####################################################################
+#
+def add_influx_sink(fanout, profiler=None):
+    """
+    If INFLUX_SPOOL_DIR is set add a sink writing samples, and the sink
+    and spool metrics, to influxdb through a spool there. Returns the
+    `spool.SpoolDrainer`, or None. If `profiler` is given the drainer's
+    writes to influxdb are timed with it.
+    """
+    if not INFLUX_SPOOL_DIR:
+        return None
+    # Imported here so the plot does not need influxdb_client unless it
+    # is writing to influxdb.
+    #
+    from spool import Spool, SpoolDrainer, influx_writer
+
+    influxdb_creds = get_hvac_client().secrets.kv.v1.read_secret(
+        INFLUXDB_CREDS_PATH
+    )["data"]
+    spool = Spool(Path(INFLUX_SPOOL_DIR).expanduser())
+    drainer = SpoolDrainer(
+        spool,
+        influx_writer(
+            influxdb_creds["url"],
+            influxdb_creds["token"],
+            influxdb_creds["org"],
+            influxdb_creds["bucket"],
+        ),
+        timings=profiler,
+    )
+    drainer.start()
+    tags = {"site": SITE_NAME}
+    fanout.add(
+        SpoolSink(
+            spool,
+            tags,
+            metrics=lambda: [
+                *fanout.metrics_lines(tags),
+                drainer.metrics_line(tags),
+            ],
+        )
+    )
+    return drainer
 
 
 #############################################################################
@@ -160,21 +358,34 @@ def main():
     """
     creds = get_login_credentials()
 
-    # Load saved data if it exists
+    # Start with the last day of samples we saved, if any
+    #
+    now = time.time()
+    series = new_series(load_range(now - 86400, now))
+    writer = HistoryWriter(prune=True)
+
+    # kill -USR1 to start and stop profiling, kill -USR2 for a report.
+    # The sinks time their writes with it from their own threads.
+    #
+    profiler = Profiler("as_power_plot").install()
+    fanout = new_fanout(
+        series,
+        writer,
+        default_engine(SITE_NAME, BACKUP_RESERVE_PCT, TIMEZONE),
+        profiler,
+    )
+    drainer = add_influx_sink(fanout, profiler)
+    if MQTT_HOST:
+        fanout.add(MqttSink(MQTT_HOST, MQTT_TOPIC, MQTT_PORT))
+
+    powerwall = Powerwall(POWERWALL_HOST)
+    breaker = gateway_breaker()
+
+    # Look for gaps left while we were not running now, and every so
+    # often after that for gaps from gateway outages.
     #
-    if LAST_DAY_FILE.exists():
-        with open(LAST_DAY_FILE, "r") as f:
-            data = json.load(f)
-            meter_values = data["meter_values"]
-            x_axis = [datetime.strptime(x, DATE_FMT) for x in data["x_axis"]]
-            battery_pct = data["battery_pct"]
-    else:
-        meter_values = {}
-        for meter_type in MeterType:
-            meter_type = meter_type.value
-            meter_values[meter_type] = []
-        battery_pct = []  # battery charge percent plotting on Y2 axis
-        x_axis = []  # Timestamps plotted on X axis
+    gap_filler = GapFiller()
+    gap_filler.poll()
 
     fig = plt.figure()
     ax = fig.add_subplot(1, 1, 1)
@@ -183,10 +394,25 @@ def main():
     _ = animation.FuncAnimation(
         fig,
         draw_plot,
-        fargs=(creds, ax, ax2, x_axis, meter_values, battery_pct),
+        fargs=(
+            powerwall,
+            breaker,
+            creds,
+            ax,
+            ax2,
+            series,
+            fanout,
+            gap_filler,
+            profiler,
+        ),
         interval=PLOT_INTERVAL,
     )
     plt.show()
+    fanout.close()
+    if drainer is not None:
+        drainer.stop()
+        drainer.join()
+        drainer.spool.close()
 
 
 ############################################################################
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+Backfill the local history store with the power history for a range of
+days from the Tesla cloud API.
+
+Days are fetched concurrently, limited to a maximum request rate, and
+retried with exponential backoff. Every completed day is recorded in a
+checkpoint file so an interrupted run picks up where it left off.
+
+Usage:
+  backfill.py [options] <start> [<end>]
+
+Arguments:
+  <start>           First day to fetch, YYYY-MM-DD
+  <end>             Last day to fetch, YYYY-MM-DD. Defaults to yesterday
+
+Options:
+  --version
+  -h, --help        Show this text and exit
+  -c, --concurrency=<n>  How many requests may be in flight [default: 8]
+  -r, --rate=<n>    Maximum requests per second [default: 4]
+  --retries=<n>     How many times to retry a day before giving up
+                    [default: 5]
+  --refetch         Fetch days even if the checkpoint says we have them
+"""
+
+# system imports
+#
+import os
+import json
+import time
+import random
+import asyncio
+from pathlib import Path
+from urllib.parse import urlencode
+from datetime import date, datetime, time as dt_time, timedelta
+
+# 3rd party imports
+#
+import aiohttp
+from docopt import docopt
+from tesla_api import ApiError
+
+# Project modules
+#
+from utils import get_hvac_client
+from token_store import TokenStore, tesla_api_login
+from history import (
+    HISTORY_FILE_DIR,
+    TIMEZONE,
+    save_calendar_day,
+    write_json_atomic,
+)
+
+VAULT_SECRETS_PATH = os.getenv("VAULT_SECRETS_PATH")
+TOKEN_STORE = TokenStore()
+CHECKPOINT_FILE = HISTORY_FILE_DIR / "backfill_checkpoint.json"
+
+# How many completed days between checkpoint writes.
+#
+CHECKPOINT_EVERY = 16
+BACKOFF_BASE = 1.0  # seconds
+BACKOFF_MAX = 60.0  # seconds
+
+# Errors from the network or the tesla API that are worth retrying a
+# request for. Anything else is a bug and is raised straight away.
+#
+RETRY_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ApiError)
+
+
+##################################################################
+##################################################################
+#
+class PeriodMismatchError(Exception):
+    """
+    Raised when the cloud sends a time series that is not for the
+    period we asked for, so it is never stored as that day's history.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, day, timestamp):
+        self.day = day
+        self.timestamp = timestamp
+        super().__init__(
+            f"{day}: asked for this day, got a row at {timestamp}"
+        )
+
+
+####################################################################
+#
+def get_login_credentials(hvac_client):
+    """
+    Go to vault, get our login credentials and return a dict properly
+    formatted for authenticating with the web site.
+    """
+    login_credentials = hvac_client.secrets.kv.v1.read_secret(
+        VAULT_SECRETS_PATH
+    )
+    return login_credentials["data"]
+
+
+####################################################################
+#
+async def login():
+    """
+    Log in to the tesla API with the credentials from vault. Called by
+    the token store when we need a new token.
+    """
+    creds = get_login_credentials(get_hvac_client())
+    return await tesla_api_login(creds["username"], creds["password"])
+
+
+##################################################################
+##################################################################
+#
+class RateLimiter:
+    """
+    Token bucket that lets at most `rate` callers per second through
+    `acquire()`, with bursts of up to `burst` callers.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    ####################################################################
+    #
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+##################################################################
+##################################################################
+#
+class Checkpoint:
+    """
+    The set of days that have been successfully backfilled. Saved
+    atomically so an interrupted run never leaves a corrupt checkpoint.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, path=CHECKPOINT_FILE):
+        self.path = Path(path)
+        self.done = set()
+        self.dirty = 0
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                self.done = set(json.load(f)["done"])
+
+    ####################################################################
+    #
+    def __contains__(self, day):
+        return day.isoformat() in self.done
+
+    ####################################################################
+    #
+    def add(self, day):
+        self.done.add(day.isoformat())
+        self.dirty += 1
+        if self.dirty >= CHECKPOINT_EVERY:
+            self.save()
+
+    ####################################################################
+    #
+    def save(self):
+        write_json_atomic(self.path, {"done": sorted(self.done)})
+        self.dirty = 0
+
+
+####################################################################
+#
+def day_end(day):
+    """
+    Return the end of `day` in our local timezone. The calendar history
+    API returns the period that ends at `end_date`.
+    """
+    return TIMEZONE.localize(datetime.combine(day, dt_time(23, 59, 59)))
+
+
+####################################################################
+#
+async def calendar_history(site, kind, period, end):
+    """
+    Return the calendar history of `kind` for the `period` that ends at
+    `end`, a timezone aware datetime.
+
+    tesla_api's energy site only asks for the current period, so we
+    call the calendar_history endpoint ourselves with the site's client
+    and give it `end_date` explicitly.
+    """
+    query = urlencode(
+        {"kind": kind, "period": period, "end_date": end.isoformat()}
+    )
+    return await site._api_client.get(
+        f"energy_sites/{site._energy_site_id}/calendar_history?{query}"
+    )
+
+
+####################################################################
+#
+def check_period(day, end, time_series):
+    """
+    Raise `PeriodMismatchError` unless every row of `time_series` is on
+    `day` and no later than `end`.
+    """
+    start = TIMEZONE.localize(datetime.combine(day, dt_time()))
+    for row in time_series:
+        ts = datetime.fromisoformat(row["timestamp"])
+        if not start <= ts <= end:
+            raise PeriodMismatchError(day, row["timestamp"])
+
+
+####################################################################
+#
+async def fetch_day(site, day, limiter, retries, end=None):
+    """
+    Fetch the power time series for a single day, retrying with
+    exponential backoff and jitter on network and API errors. If `end`
+    is given the series stops at that time on `day` instead of at the
+    end of the day. Raises `PeriodMismatchError` if the cloud sends a
+    series for some other time.
+    """
+    if end is None:
+        end = day_end(day)
+    attempt = 0
+    while True:
+        await limiter.acquire()
+        try:
+            history = await calendar_history(site, "power", "day", end)
+        except RETRY_ERRORS as e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1))
+            delay = random.uniform(delay / 2, delay)
+            print(f"{day}: {e}, retry {attempt}/{retries} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+        time_series = history["time_series"]
+        check_period(day, end, time_series)
+        return time_series
+
+
+####################################################################
+#
+async def backfill(site, days, checkpoint, concurrency, rate, retries):
+    """
+    Fetch every day in `days` that is not already in the checkpoint and
+    write it to the history store. Returns the list of days that failed.
+    Any error other than running out of retries or the cloud sending the
+    wrong day is raised, stopping the run.
+
+    Keyword Arguments:
+    site        -- tesla_api energy site
+    days        -- list of datetime.date to fetch
+    checkpoint  -- `Checkpoint` of days already fetched
+    concurrency -- number of requests in flight at once
+    rate        -- maximum requests per second
+    retries     -- retries per day before giving up on it
+    """
+    queue = asyncio.Queue()
+    for day in days:
+        queue.put_nowait(day)
+    limiter = RateLimiter(rate, burst=concurrency)
+    failed = []
+    today = datetime.now(tz=TIMEZONE).date()
+
+    async def worker():
+        while True:
+            try:
+                day = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                time_series = await fetch_day(site, day, limiter, retries)
+            except (*RETRY_ERRORS, PeriodMismatchError) as e:
+                print(f"{day}: giving up: {e}")
+                failed.append(day)
+                continue
+            save_calendar_day(day, time_series)
+            # Today is not over yet so we will want it again next run.
+            #
+            if day < today:
+                checkpoint.add(day)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for w in workers:
+            w.cancel()
+        checkpoint.save()
+    return failed
+
+
+#############################################################################
+#
+async def main(args):
+    """
+    Work out what days we need, log in to the tesla API, and backfill.
+    """
+    start = date.fromisoformat(args["<start>"])
+    if args["<end>"]:
+        end = date.fromisoformat(args["<end>"])
+    else:
+        end = datetime.now(tz=TIMEZONE).date() - timedelta(days=1)
+
+    checkpoint = Checkpoint()
+    days = []
+    day = start
+    while day <= end:
+        if args["--refetch"] or day not in checkpoint:
+            days.append(day)
+        day += timedelta(days=1)
+    print(f"{len(days)} days to fetch between {start} and {end}")
+    if not days:
+        return
+
+    async with TOKEN_STORE.client(login) as client:
+        energy_sites = await client.list_energy_sites()
+        assert len(energy_sites) == 1
+        started = time.monotonic()
+        failed = await backfill(
+            energy_sites[0],
+            days,
+            checkpoint,
+            int(args["--concurrency"]),
+            float(args["--rate"]),
+            int(args["--retries"]),
+        )
+        elapsed = time.monotonic() - started
+        print(
+            f"Fetched {len(days) - len(failed)} days in {elapsed:.1f}s, "
+            f"{len(failed)} failed"
+        )
+        for day in sorted(failed):
+            print(f"  failed: {day}")
+
+
+############################################################################
+############################################################################
+#
+# Here is where it all starts
+#
+if __name__ == "__main__":
+    args = docopt(__doc__, version="0.1")
+    asyncio.run(main(args))
+#
+############################################################################
+############################################################################
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+Generate per-day and per-month reports from the daily gateway history
+files.
+
+Loading, summarizing and plotting each day is independent so those are
+spread across a pool of processes. The daily summaries are then merged
+in to monthly summaries, whose charts are rendered in the same pool, and
+an overall summary is written as json. Time spent in each stage is
+reported at the end.
+
+Usage:
+  batch_report.py [options] <start> [<end>]
+
+Arguments:
+  <start>           First day to report on, YYYY-MM-DD
+  <end>             Last day to report on, YYYY-MM-DD. Defaults to today
+
+Options:
+  --version
+  -h, --help        Show this text and exit
+  -j, --jobs=<n>    Number of worker processes. Defaults to the number
+                    of cpus
+  -o, --output=<dir>  Where to write the charts and summary
+                    [default: reports]
+  --no-render       Only compute the summaries, do not draw any charts
+"""
+
+# system imports
+#
+import os
+import json
+import math
+import time
+from pathlib import Path
+from statistics import median
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+
+# 3rd party modules
+#
+from docopt import docopt
+import matplotlib
+
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt  # noqa: E402
+import matplotlib.dates as mdates  # noqa: E402
+
+# Project modules
+#
+from history import TIMEZONE, load_day  # noqa: E402
+from samples import METERS  # noqa: E402
+
+STAGES = ("load", "aggregate", "render")
+
+# An interval longer than this many of the day's usual poll periods is
+# an outage, not something we can draw a straight line across.
+#
+MAX_INTERVAL_POLLS = 3
+DEFAULT_POLL = 60  # seconds, if a day has too few samples to tell
+
+
+####################################################################
+#
+def summarize_day(samples):
+    """
+    Reduce a day of samples to a small summary dict.
+
+    Energy is integrated from the instant power samples with the
+    trapezoid rule and split in to what flowed in (positive power) and
+    out (negative power) of each meter, in kWh. Nothing is counted across
+    gaps in the samples: gap markers, and intervals more than
+    `MAX_INTERVAL_POLLS` times the day's usual time between samples,
+    which are outages that left no marker. The hours the energy was
+    integrated over are reported as "covered_hours".
+    """
+    steps = [b.timestamp - a.timestamp for a, b in zip(samples, samples[1:])]
+    poll = median([x for x in steps if x > 0] or [DEFAULT_POLL])
+    max_step = MAX_INTERVAL_POLLS * poll
+    hours = [x / 3600 if x <= max_step else math.nan for x in steps]
+    local_hours = [s.as_datetime(TIMEZONE).hour for s in samples]
+    meters = {}
+    for meter in METERS:
+        values = [getattr(s, meter) for s in samples]
+        readings = [v for v in values if not math.isnan(v)]
+        energy_in = energy_out = covered = 0.0
+        hourly = defaultdict(list)
+        for idx, value in enumerate(values):
+            if math.isnan(value):
+                continue
+            hourly[local_hours[idx]].append(value)
+            if idx == 0:
+                continue
+            wh = (values[idx - 1] + value) / 2 * hours[idx - 1]
+            if math.isnan(wh):
+                continue
+            covered += hours[idx - 1]
+            if wh > 0:
+                energy_in += wh
+            else:
+                energy_out -= wh
+        meters[meter] = {
+            "energy_in_kwh": round(energy_in / 1000, 3),
+            "energy_out_kwh": round(energy_out / 1000, 3),
+            "covered_hours": round(covered, 3),
+            "min": min(readings, default=None),
+            "max": max(readings, default=None),
+            "mean": sum(readings) / len(readings) if readings else None,
+            "hourly_mean": {
+                h: sum(v) / len(v) for h, v in sorted(hourly.items())
+            },
+        }
+    battery_pct = [s.battery_pct for s in samples if s.has("battery_pct")]
+    return {
+        "samples": sum(1 for s in samples if not s.is_gap),
+        "gaps": sum(1 for s in samples if s.is_gap),
+        "battery_min": min(battery_pct, default=None),
+        "battery_max": max(battery_pct, default=None),
+        "meters": meters,
+    }
+
+
+####################################################################
+#
+def render_day(day, samples, output_dir):
+    """
+    Draw the day's samples the same way as_power_plot.py does and save
+    the chart as a png.
+    """
+    fig = plt.figure(figsize=(12, 6))
+    ax = fig.add_subplot(1, 1, 1)
+    ax2 = ax.twinx()
+    # Matplotlib dates are days since the epoch.
+    #
+    x_axis = [s.timestamp / 86400 for s in samples]
+    for meter in METERS:
+        ax.plot(x_axis, [getattr(s, meter) for s in samples], label=meter)
+    ax.set_ylabel("Wh")
+    ax.grid(which="major", axis="both", color="grey")
+    ax2.plot(
+        x_axis,
+        [s.battery_pct for s in samples],
+        color="lightblue",
+        linestyle="dashed",
+        label="Battery % Chg",
+    )
+    ax2.set_ylabel("% Chg")
+    ax.legend(loc="best")
+    ax.xaxis_date(TIMEZONE)
+    ax.xaxis.set_major_formatter(mdates.DateFormatter("%H", tz=TIMEZONE))
+    ax.xaxis.set_major_locator(mdates.HourLocator(interval=1, tz=TIMEZONE))
+    ax.set_title(f"AS Powerwall {day}")
+    path = output_dir / "daily" / f"{day}.png"
+    fig.savefig(path)
+    plt.close(fig)
+
+
+####################################################################
+#
+def process_day(day, output_dir, render):
+    """
+    Worker: load, summarize and optionally render a single day. Returns
+    (day, summary, timings) with summary None if there is no data for
+    that day.
+    """
+    timings = dict.fromkeys(STAGES, 0.0)
+    t0 = time.perf_counter()
+    samples = load_day(day)
+    t1 = time.perf_counter()
+    timings["load"] = t1 - t0
+    if not samples:
+        return day, None, timings
+
+    summary = summarize_day(samples)
+    t2 = time.perf_counter()
+    timings["aggregate"] = t2 - t1
+    if render:
+        render_day(day, samples, output_dir)
+        timings["render"] = time.perf_counter() - t2
+    return day, summary, timings
+
+
+####################################################################
+#
+def extreme(fn, values):
+    """
+    Return `fn` (`min` or `max`) of the `values` that are not None, or
+    None if none are. Days that are all gaps have no min or max.
+    """
+    return fn((v for v in values if v is not None), default=None)
+
+
+####################################################################
+#
+def merge_month(days):
+    """
+    Merge a list of (day, summary) for a month in to a monthly summary.
+    """
+    meters = {}
+    for day, summary in days:
+        for meter, m in summary["meters"].items():
+            merged = meters.setdefault(
+                meter,
+                {
+                    "energy_in_kwh": 0.0,
+                    "energy_out_kwh": 0.0,
+                    "covered_hours": 0.0,
+                    "min": m["min"],
+                    "max": m["max"],
+                    "daily_in_kwh": {},
+                    "daily_out_kwh": {},
+                },
+            )
+            merged["energy_in_kwh"] += m["energy_in_kwh"]
+            merged["energy_out_kwh"] += m["energy_out_kwh"]
+            merged["covered_hours"] += m.get("covered_hours", 0.0)
+            merged["min"] = extreme(min, (merged["min"], m["min"]))
+            merged["max"] = extreme(max, (merged["max"], m["max"]))
+            merged["daily_in_kwh"][str(day)] = m["energy_in_kwh"]
+            merged["daily_out_kwh"][str(day)] = m["energy_out_kwh"]
+    return {
+        "days": len(days),
+        "samples": sum(s["samples"] for _, s in days),
+        "gaps": sum(s.get("gaps", 0) for _, s in days),
+        "battery_min": extreme(min, (s["battery_min"] for _, s in days)),
+        "battery_max": extreme(max, (s["battery_max"] for _, s in days)),
+        "meters": meters,
+    }
+
+
+####################################################################
+#
+def render_month(month, summary, output_dir):
+    """
+    Worker: bar chart of the energy in to each meter for every day of
+    the month. Returns the time it took.
+    """
+    t0 = time.perf_counter()
+    fig = plt.figure(figsize=(12, 6))
+    ax = fig.add_subplot(1, 1, 1)
+    meters = list(summary["meters"])
+    width = 0.8 / max(len(meters), 1)
+    for idx, meter in enumerate(meters):
+        daily = summary["meters"][meter]["daily_in_kwh"]
+        days = [date.fromisoformat(d) for d in daily]
+        ax.bar(
+            [mdates.date2num(d) + idx * width for d in days],
+            list(daily.values()),
+            width=width,
+            label=meter,
+        )
+    ax.xaxis_date()
+    ax.set_ylabel("kWh")
+    ax.legend(loc="best")
+    ax.set_title(f"AS Powerwall {month}")
+    fig.savefig(output_dir / "monthly" / f"{month}.png")
+    plt.close(fig)
+    return time.perf_counter() - t0
+
+
+#############################################################################
+#
+def main():
+    """
+    Fan the days out to the process pool, merge, and write the results.
+    """
+    args = docopt(__doc__, version="0.1")
+    start = date.fromisoformat(args["<start>"])
+    if args["<end>"]:
+        end = date.fromisoformat(args["<end>"])
+    else:
+        end = datetime.now(tz=TIMEZONE).date()
+    jobs = int(args["--jobs"]) if args["--jobs"] else os.cpu_count()
+    render = not args["--no-render"]
+    output_dir = Path(args["--output"])
+    (output_dir / "daily").mkdir(parents=True, exist_ok=True)
+    (output_dir / "monthly").mkdir(parents=True, exist_ok=True)
+
+    days = [start + timedelta(days=n) for n in range((end - start).days + 1)]
+    cpu_time = dict.fromkeys(STAGES, 0.0)
+    wall_time = {}
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        t0 = time.perf_counter()
+        by_month = defaultdict(list)
+        chunksize = max(1, len(days) // (jobs * 4))
+        for day, summary, timings in pool.map(
+            process_day,
+            days,
+            [output_dir] * len(days),
+            [render] * len(days),
+            chunksize=chunksize,
+        ):
+            for stage, secs in timings.items():
+                cpu_time[stage] += secs
+            if summary is not None:
+                by_month[day.strftime("%Y-%m")].append((day, summary))
+        wall_time["days"] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        months = {m: merge_month(d) for m, d in sorted(by_month.items())}
+        wall_time["merge"] = time.perf_counter() - t0
+
+        if render:
+            t0 = time.perf_counter()
+            for secs in pool.map(
+                render_month,
+                list(months),
+                list(months.values()),
+                [output_dir] * len(months),
+            ):
+                cpu_time["render"] += secs
+            wall_time["months"] = time.perf_counter() - t0
+
+    # The per-day breakdown is only needed for the monthly charts.
+    #
+    summary = {}
+    for month, s in months.items():
+        meters = {
+            meter: {k: v for k, v in ms.items() if not k.startswith("daily")}
+            for meter, ms in s["meters"].items()
+        }
+        summary[month] = dict(s, meters=meters)
+    with open(output_dir / "summary.json", "w") as f:
+        json.dump(summary, f, indent=2)
+
+    n_days = sum(s["days"] for s in months.values())
+    print(f"{n_days} days with data in {len(months)} months, {jobs} workers")
+    for stage in STAGES:
+        print(f"  {stage:>10}: {cpu_time[stage]:8.2f}s worker time")
+    for phase, secs in wall_time.items():
+        print(f"  {phase:>10}: {secs:8.2f}s wall clock")
+
+
+############################################################################
+############################################################################
+#
+# Here is where it all starts
+#
+if __name__ == "__main__":
+    main()
+#
+############################################################################
+############################################################################
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+A circuit breaker for calls to something that may go away for a while,
+like the backup gateway.
+
+While the breaker is closed calls go through. After `failure_threshold`
+failures in a row it opens and calls fail immediately with
+`CircuitOpenError` instead of each waiting for a network timeout. Once
+the backoff delay has passed the breaker is half-open and lets a single
+probe call through. If the probe succeeds the breaker closes, if it
+fails the breaker opens again with the delay doubled, up to `max_delay`.
+
+A probe can be a cheaper call than the one being protected, say a status
+request with a short timeout, so checking whether something has come
+back costs little.
+"""
+
+# system imports
+#
+import time
+import random
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+##################################################################
+##################################################################
+#
+class CircuitOpenError(Exception):
+    """
+    Raised instead of making a call while the breaker is open.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, name, retry_in):
+        self.retry_in = retry_in
+        super().__init__(f"{name}: circuit open, retry in {retry_in:.1f}s")
+
+
+##################################################################
+##################################################################
+#
+class CircuitBreaker:
+    """
+    Circuit breaker with exponential backoff between half-open probes.
+    """
+
+    ####################################################################
+    #
+    def __init__(
+        self,
+        name="gateway",
+        failure_threshold=3,
+        base_delay=1.0,
+        max_delay=30.0,
+        errors=(Exception,),
+        probe=None,
+        clock=time.monotonic,
+    ):
+        """
+        Keyword Arguments:
+        name              -- what we are protecting, for messages
+        failure_threshold -- failures in a row before the breaker opens
+        base_delay        -- seconds before the first probe after opening
+        max_delay         -- longest delay between probes. This bounds how
+                             long a recovery can go unnoticed
+        errors            -- exceptions that count as failures. Anything
+                             else is passed on without touching the state
+        probe             -- if not None, called when half-open before the
+                             protected call is let through
+        clock             -- function returning the time in seconds
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.errors = errors
+        self.probe = probe
+        self.clock = clock
+
+        self.state = CLOSED
+        self.failures = 0  # in a row
+        self.delay = base_delay
+        self.retry_at = 0.0
+        self.opens = 0
+        self.rejected = 0
+
+    ####################################################################
+    #
+    def retry_in(self):
+        """
+        Seconds until a call will be let through. 0 if one would be now.
+        """
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.retry_at - self.clock())
+
+    ####################################################################
+    #
+    def call(self, fn, *args, **kwargs):
+        """
+        Call `fn(*args, **kwargs)` if the breaker allows it and return
+        its result. Raises `CircuitOpenError` if the breaker is open.
+        """
+        if self.state == OPEN:
+            retry_in = self.retry_in()
+            if retry_in > 0:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, retry_in)
+            self.state = HALF_OPEN
+            if self.probe is not None:
+                try:
+                    self.probe()
+                except self.errors:
+                    self.record_failure()
+                    raise
+
+        try:
+            result = fn(*args, **kwargs)
+        except self.errors:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    ####################################################################
+    #
+    def record_success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.delay = self.base_delay
+
+    ####################################################################
+    #
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN:
+            self.delay = min(self.max_delay, self.delay * 2)
+        elif self.failures < self.failure_threshold:
+            return
+        else:
+            self.opens += 1
+        self.state = OPEN
+        # Jitter so a fleet of pollers does not probe in lock step.
+        #
+        self.retry_at = self.clock() + random.uniform(
+            self.delay / 2, self.delay
+        )
+
+    ####################################################################
+    #
+    def metrics(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opens": self.opens,
+            "rejected": self.rejected,
+            "retry_in": self.retry_in(),
+        }
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+Exporters that write power time series out in various formats.
+
+The series is consumed exactly once. `export_rows()` pulls rows from
+any iterable (typically a generator over the tesla api
+`get_energy_site_calendar_history_data()` `time_series`) and hands each
+row to every registered exporter in turn. Each exporter only keeps
+what it needs to write the current row so exporting months of data
+takes constant memory no matter how many formats we write at once.
+
+Each exporter only writes its `columns`. They are picked out of every
+row with a projection built once from the first row (see
+`metric_schema.projection()`) so a narrow export of a wide row costs
+one C level call per row.
+"""
+
+# system imports
+#
+import shutil
+import tempfile
+from datetime import datetime
+
+# Project modules
+#
+from history import TIMEZONE
+from metric_schema import SCHEMA, projection
+
+COLORS = ["red", "blue", "green", "yellow", "orange", "cyan", "magenta"]
+
+# The cloud calendar history columns we chart, from the metric schema.
+#
+CHARTS = list(SCHEMA.calendar_columns)
+
+# Size of the write buffer used for every exporter output file. Rows are
+# small so we want lots of them to go out in a single write(2).
+#
+WRITE_BUFFER_SIZE = 256 * 1024
+
+
+####################################################################
+#
+def row_timestamp(row):
+    """
+    Return the timestamp of a row as a datetime. Seconds since the
+    epoch are given in the site's timezone, `history.TIMEZONE`.
+
+    Keyword Arguments:
+    row -- dict or `samples.Sample` with a 'timestamp'. The value is a
+           datetime, seconds since the epoch, or a string of the
+           format: '2020-10-25T00:00:00-07:00'
+    """
+    ts = row["timestamp"]
+    if isinstance(ts, datetime):
+        return ts
+    if isinstance(ts, (int, float)):
+        return datetime.fromtimestamp(ts, TIMEZONE)
+    return datetime.fromisoformat(ts)
+
+
+####################################################################
+#
+def escape_lp(value):
+    """
+    Escape a measurement name, tag key, tag value, or field key for the
+    influxdb line protocol.
+    """
+    return (
+        value.replace("\\", "\\\\")
+        .replace(",", "\\,")
+        .replace("=", "\\=")
+        .replace(" ", "\\ ")
+    )
+
+
+####################################################################
+#
+def line_protocol(measurement, tags, fields, timestamp_ns):
+    """
+    Return a single influxdb line protocol line (without the trailing
+    newline).
+
+    Keyword Arguments:
+    measurement  -- name of the measurement
+    tags         -- dict of tag name to value. May be empty.
+    fields       -- dict of field name to value. None values are skipped.
+    timestamp_ns -- int nanoseconds since the epoch
+    """
+    key = escape_lp(measurement)
+    if tags:
+        key += "," + ",".join(
+            f"{escape_lp(k)}={escape_lp(str(v))}"
+            for k, v in sorted(tags.items())
+        )
+    field_set = []
+    for k, v in fields.items():
+        if v is None:
+            continue
+        if isinstance(v, bool):
+            v = "true" if v else "false"
+        elif isinstance(v, int):
+            v = f"{v}i"
+        elif isinstance(v, str):
+            v = '"' + v.replace("\\", "\\\\").replace('"', '\\"') + '"'
+        field_set.append(f"{escape_lp(k)}={v}")
+    return f"{key} {','.join(field_set)} {timestamp_ns}"
+
+
+##################################################################
+##################################################################
+#
+class Exporter:
+    """
+    Base class for all exporters. Sub-classes implement `start()`,
+    `write_row()`, and `finish()`. `start()` is called with the first
+    row so headers that depend on the data can be written.
+
+    By the time `write_row()` is called `project(row)` returns the tuple
+    of the row's values for our columns.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, path, columns=None):
+        """
+        Keyword Arguments:
+        path    -- file to write the exported data to
+        columns -- which keys of each row to export. Defaults to `CHARTS`
+        """
+        self.path = path
+        self.columns = list(CHARTS if columns is None else columns)
+        self.project = None
+        self.fh = None
+
+    ####################################################################
+    #
+    def open(self):
+        self.fh = open(self.path, "w", buffering=WRITE_BUFFER_SIZE)
+
+    ####################################################################
+    #
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+    ####################################################################
+    #
+    def start(self, row, ts):
+        pass
+
+    ####################################################################
+    #
+    def write_row(self, row, ts):
+        raise NotImplementedError
+
+    ####################################################################
+    #
+    def finish(self):
+        pass
+
+
+##################################################################
+##################################################################
+#
+class TermgraphExporter(Exporter):
+    """
+    Write a data file for termgraph.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, path="termgraph.dat", columns=None):
+        super().__init__(path, columns)
+
+    ####################################################################
+    #
+    def start(self, row, ts):
+        # Define in our output file what data columns we are writing.
+        #
+        self.fh.write(
+            f"# Tesla energy graph starting {ts.isoformat()}\n"
+            f"@ {','.join(self.columns)}\n"
+        )
+
+    ####################################################################
+    #
+    def write_row(self, row, ts):
+        # The row label, then the data in the same order as the header.
+        #
+        values = ",".join(str(abs(v)) for v in self.project(row))
+        self.fh.write(f"{ts:%H:%M},{values}\n")
+
+
+##################################################################
+##################################################################
+#
+class CSVExporter(Exporter):
+    """
+    Write the series as CSV with an ISO 8601 timestamp column.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, path="tesla-power.csv", columns=None):
+        super().__init__(path, columns)
+
+    ####################################################################
+    #
+    def start(self, row, ts):
+        self.fh.write(f"timestamp,{','.join(self.columns)}\n")
+
+    ####################################################################
+    #
+    def write_row(self, row, ts):
+        values = ",".join(map(str, self.project(row)))
+        self.fh.write(f"{ts.isoformat()},{values}\n")
+
+
+##################################################################
+##################################################################
+#
+class LineProtocolExporter(Exporter):
+    """
+    Write the series as influxdb line protocol, one line per row with
+    each column as a field.
+    """
+
+    ####################################################################
+    #
+    def __init__(
+        self,
+        path="tesla-power.lp",
+        columns=None,
+        measurement="tesla_power",
+        tags=None,
+    ):
+        super().__init__(path, columns)
+        self.measurement = measurement
+        self.tags = tags or {}
+
+    ####################################################################
+    #
+    def write_row(self, row, ts):
+        fields = dict(zip(self.columns, map(float, self.project(row))))
+        ts_ns = int(ts.timestamp()) * 1_000_000_000
+        self.fh.write(
+            line_protocol(self.measurement, self.tags, fields, ts_ns)
+        )
+        self.fh.write("\n")
+
+
+##################################################################
+##################################################################
+#
+class BlessedExporter(Exporter):
+    """
+    Write a javascript file that can be used by `blessed` to write an
+    ascii chart.
+
+    The javascript wants every series as one complete array and the
+    chart minimum up front. To do that in a single pass we spool the x
+    values and each column to their own temporary file and stitch them
+    together in `finish()` once we know the minimum.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, path="tesla-blessed.js", columns=None):
+        super().__init__(path, columns)
+        self.min_y = 0
+        self.spools = None
+        self.sep = ""
+
+    ####################################################################
+    #
+    def open(self):
+        super().open()
+        # One spool for the x axis and then one per column.
+        #
+        self.spools = [
+            tempfile.TemporaryFile(mode="w+", buffering=WRITE_BUFFER_SIZE)
+            for _ in range(len(self.columns) + 1)
+        ]
+        self.min_y = 0
+        self.sep = ""
+
+    ####################################################################
+    #
+    def close(self):
+        if self.spools is not None:
+            for spool in self.spools:
+                spool.close()
+            self.spools = None
+        super().close()
+
+    ####################################################################
+    #
+    def write_row(self, row, ts):
+        sep = self.sep
+        self.spools[0].write(f'{sep}"{ts:%H:%M}"')
+        for spool, value in zip(self.spools[1:], self.project(row)):
+            if value < self.min_y:
+                self.min_y = value
+            spool.write(f"{sep}{value}")
+        self.sep = ","
+
+    ####################################################################
+    #
+    def _copy_spool(self, spool):
+        spool.seek(0)
+        shutil.copyfileobj(spool, self.fh, WRITE_BUFFER_SIZE)
+
+    ####################################################################
+    #
+    def finish(self):
+        fh = self.fh
+        fh.write(
+            f"""
+var blessed = require('blessed')
+, contrib = require('../index')
+, screen = blessed.screen()
+, line = contrib.line(
+      {{ width: 164
+      , height: 24
+      , xPadding: 5
+      , minY: {self.min_y}
+      , showLegend: true
+      , legend: {{width: 12}}
+      , wholeNumbersOnly: false // true=do not show fraction in y axis
+      , label: 'Power data'}});
+"""
+        )
+        series_names = []
+        for idx, c in enumerate(self.columns):
+            series_name = f"series{idx}"
+            series_names.append(series_name)
+            fh.write(f"var {series_name} = {{\n      title: '{c}',\n")
+            fh.write("      x: [")
+            self._copy_spool(self.spools[0])
+            fh.write("],\n      y: [")
+            self._copy_spool(self.spools[idx + 1])
+            fh.write(
+                f"],\n      style: {{line: '{COLORS[idx % len(COLORS)]}'}}\n"
+                "   };\n"
+            )
+        fh.write("screen.append(line); //must append before setting data\n")
+        fh.write(f"line.setData([{', '.join(series_names)}]);\n")
+        fh.write(
+            """
+screen.key(['escape', 'q', 'C-c'], function(ch, key) {
+  return process.exit(0);
+});
+
+screen.render();
+"""
+        )
+
+
+####################################################################
+#
+def export_rows(rows, exporters):
+    """
+    Feed every row to every exporter in a single pass over `rows`.
+    Returns the number of rows exported.
+
+    Keyword Arguments:
+    rows      -- iterable of dicts or `samples.Sample`s. Each row has a
+                 'timestamp' and a key for every column the exporters
+                 write.
+    exporters -- list of `Exporter` instances
+    """
+    for exporter in exporters:
+        exporter.open()
+    count = 0
+    try:
+        for row in rows:
+            ts = row_timestamp(row)
+            if count == 0:
+                for exporter in exporters:
+                    exporter.project = projection(exporter.columns, row)
+                    exporter.start(row, ts)
+            for exporter in exporters:
+                exporter.write_row(row, ts)
+            count += 1
+        for exporter in exporters:
+            exporter.finish()
+    finally:
+        for exporter in exporters:
+            exporter.close()
+    return count
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+Find the holes in the gateway history and fill them from the Tesla
+cloud power history.
+
+A gap is a stretch longer than `MIN_GAP` with no samples, like while
+as_power_plot.py was not running or could not reach the gateway. For
+each gap we ask the cloud only for the power series up to the end of
+that window and keep only the rows inside it. The cloud has a reading
+every five minutes so they are interpolated to the cadence of our own
+samples and flagged `FLAG_CLOUD | FLAG_BACKFILLED` before being merged
+in to the history.
+
+as_power_plot.py checks for gaps in the background with a `GapFiller`
+when it starts and every `GAP_CHECK_INTERVAL` after that. This script
+does the same once, and should only be run when as_power_plot.py is
+not, since they would both be rewriting the same history files.
+
+Usage:
+  gapfill.py [options]
+
+Options:
+  --version
+  -h, --help        Show this text and exit
+  --hours=<n>       How many hours back to look for gaps [default: 24]
+  --dry-run         Only print the gaps, do not fetch or fill them
+"""
+
+# system imports
+#
+import time
+import queue
+import asyncio
+import threading
+from bisect import bisect_left
+from statistics import median
+from datetime import datetime, timedelta
+
+# 3rd party imports
+#
+from docopt import docopt
+
+# Project modules
+#
+from samples import FLAG_BACKFILLED, FLAG_CLOUD, Sample
+from history import HISTORY_FILE_DIR, TIMEZONE, HistoryWriter, load_range
+from backfill import (
+    RETRY_ERRORS,
+    TOKEN_STORE,
+    PeriodMismatchError,
+    RateLimiter,
+    day_end,
+    fetch_day,
+    login,
+)
+
+CADENCE = 60  # seconds, if we can not tell from the samples
+CLOUD_STEP = 5 * 60  # seconds between cloud power readings
+MIN_GAP = CLOUD_STEP  # anything shorter the cloud can not help with
+
+# How far behind real time the cloud series is. We do not look for gaps
+# more recent than this.
+#
+CLOUD_LAG = 15 * 60  # seconds
+GAP_CHECK_INTERVAL = 60 * 60  # seconds
+FETCH_RATE = 2  # requests per second
+FETCH_RETRIES = 3
+
+
+####################################################################
+#
+def cadence_of(samples, default=CADENCE):
+    """
+    Return the usual number of seconds between samples.
+    """
+    times = [s.timestamp for s in samples if not s.is_gap]
+    steps = [b - a for a, b in zip(times, times[1:]) if b > a]
+    return median(steps) if steps else default
+
+
+####################################################################
+#
+def find_gaps(samples, start, end, cadence, min_gap=MIN_GAP):
+    """
+    Return the list of (gap_start, gap_end) windows between `start` and
+    `end` longer than `min_gap` that have no samples in them. Gap markers
+    do not count as samples.
+
+    Keyword Arguments:
+    samples -- the history for `start` to `end`, in timestamp order
+    start   -- seconds since the epoch
+    end     -- seconds since the epoch
+    cadence -- usual seconds between samples
+    min_gap -- shortest gap in seconds worth filling
+    """
+    threshold = max(min_gap, 2 * cadence)
+    gaps = []
+    prev = start
+    for t in [s.timestamp for s in samples if not s.is_gap] + [end]:
+        if t < start or t > end:
+            continue
+        if t - prev > threshold:
+            gaps.append((prev, t))
+        prev = t
+    return gaps
+
+
+####################################################################
+#
+def resample(rows, gap_start, gap_end, cadence):
+    """
+    Interpolate the cloud power series `rows` on to our cadence inside
+    the gap. Returns the list of backfilled `Sample`s. Points the cloud
+    series does not reach on both sides of are left out.
+    """
+    points = sorted(
+        (Sample.from_calendar_row(row) for row in rows),
+        key=lambda p: p.timestamp,
+    )
+    times = [p.timestamp for p in points]
+    filled = []
+    t = gap_start + cadence
+    while t < gap_end:
+        idx = bisect_left(times, t)
+        if idx == len(times):
+            break
+        if idx > 0 or times[idx] == t:
+            after = points[idx]
+            before = after if times[idx] == t else points[idx - 1]
+            span = after.timestamp - before.timestamp
+            frac = (t - before.timestamp) / span if span else 0.0
+            values = {
+                meter: getattr(before, meter)
+                + frac * (getattr(after, meter) - getattr(before, meter))
+                for meter in ("site", "battery", "load", "solar")
+            }
+            filled.append(
+                Sample(t, flags=FLAG_CLOUD | FLAG_BACKFILLED, **values)
+            )
+        t += cadence
+    return filled
+
+
+####################################################################
+#
+async def fetch_window(site, gap_start, gap_end, limiter):
+    """
+    Return the cloud power series rows for a gap, plus one reading each
+    side of it to interpolate from. The cloud only serves a day at a
+    time and stops at the end time we give it so each request stops at
+    the end of the gap and rows before the gap are dropped.
+    """
+    first = gap_start - CLOUD_STEP
+    last = gap_end + CLOUD_STEP
+    day = datetime.fromtimestamp(first, TIMEZONE).date()
+    last_day = datetime.fromtimestamp(last, TIMEZONE).date()
+    rows = []
+    while day <= last_day:
+        end = min(datetime.fromtimestamp(last, TIMEZONE), day_end(day))
+        time_series = await fetch_day(
+            site, day, limiter, FETCH_RETRIES, end=end
+        )
+        for row in time_series:
+            ts = datetime.fromisoformat(row["timestamp"]).timestamp()
+            if first <= ts <= last:
+                rows.append(row)
+        day += timedelta(days=1)
+    return rows
+
+
+####################################################################
+#
+async def fill_gaps(site, gaps, cadence):
+    """
+    Fetch and resample every gap. Returns the backfilled samples.
+    """
+    limiter = RateLimiter(FETCH_RATE)
+
+    async def fill(gap):
+        try:
+            rows = await fetch_window(site, *gap, limiter)
+        except (*RETRY_ERRORS, PeriodMismatchError) as e:
+            print(f"Unable to fill gap {gap}: {e}")
+            return []
+        return resample(rows, *gap, cadence)
+
+    filled = await asyncio.gather(*(fill(gap) for gap in gaps))
+    return [sample for samples in filled for sample in samples]
+
+
+####################################################################
+#
+def detect(hours, history_dir=HISTORY_FILE_DIR, now=None):
+    """
+    Return (gaps, cadence) for the last `hours` of history, not counting
+    the most recent `CLOUD_LAG` the cloud does not have yet.
+    """
+    now = time.time() if now is None else now
+    start = now - hours * 3600
+    end = now - CLOUD_LAG
+    samples = load_range(start, now, history_dir)
+    cadence = cadence_of(samples)
+    return find_gaps(samples, start, end, cadence), cadence
+
+
+####################################################################
+#
+async def backfill_gaps(hours, history_dir=HISTORY_FILE_DIR):
+    """
+    Find the gaps in the last `hours` of history and return the samples
+    that fill them. Nothing is fetched if there are no gaps.
+    """
+    gaps, cadence = detect(hours, history_dir)
+    if not gaps:
+        return []
+    async with TOKEN_STORE.client(login) as client:
+        energy_sites = await client.list_energy_sites()
+        assert len(energy_sites) == 1
+        return await fill_gaps(energy_sites[0], gaps, cadence)
+
+
+##################################################################
+##################################################################
+#
+class GapFiller:
+    """
+    Runs `backfill_gaps()` in a background thread every `interval`
+    seconds so a long running collector never waits on the cloud. The
+    collector calls `poll()` regularly and merges what it returns in to
+    the history itself, since it owns the history files.
+    """
+
+    ####################################################################
+    #
+    def __init__(
+        self,
+        hours=24,
+        interval=GAP_CHECK_INTERVAL,
+        history_dir=HISTORY_FILE_DIR,
+    ):
+        """
+        Keyword Arguments:
+        hours       -- how many hours back to look for gaps
+        interval    -- seconds between checks
+        history_dir -- where the history files are
+        """
+        self.hours = hours
+        self.interval = interval
+        self.history_dir = history_dir
+        self.results = queue.Queue()
+        self.thread = None
+        self.last_run = None
+
+    ####################################################################
+    #
+    def _run(self):
+        try:
+            self.results.put(
+                asyncio.run(backfill_gaps(self.hours, self.history_dir))
+            )
+        except Exception as e:
+            print(f"Gap fill failed: {e}")
+
+    ####################################################################
+    #
+    def poll(self):
+        """
+        Start a check if one is due and none is running. Returns the
+        samples from a check that has finished, or an empty list.
+        """
+        now = time.monotonic()
+        running = self.thread is not None and self.thread.is_alive()
+        if not running and (
+            self.last_run is None or now - self.last_run >= self.interval
+        ):
+            self.last_run = now
+            self.thread = threading.Thread(
+                target=self._run, name="gap-fill", daemon=True
+            )
+            self.thread.start()
+        filled = []
+        while True:
+            try:
+                filled.extend(self.results.get_nowait())
+            except queue.Empty:
+                return filled
+
+
+#############################################################################
+#
+def main():
+    """
+    Find the gaps in the history and fill them.
+    """
+    args = docopt(__doc__, version="0.1")
+    hours = float(args["--hours"])
+    gaps, cadence = detect(hours)
+    for start, end in gaps:
+        print(
+            f"gap {datetime.fromtimestamp(start, TIMEZONE)} to "
+            f"{datetime.fromtimestamp(end, TIMEZONE)}, "
+            f"{(end - start) / 60:.0f} minutes"
+        )
+    if args["--dry-run"] or not gaps:
+        return
+    filled = asyncio.run(backfill_gaps(hours))
+    writer = HistoryWriter()
+    writer.merge(filled)
+    writer.close()
+    print(f"Filled {len(gaps)} gaps with {len(filled)} samples")
+
+
+############################################################################
+############################################################################
+#
+# Here is where it all starts
+#
+if __name__ == "__main__":
+    main()
+#
+############################################################################
+############################################################################
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+An asyncio client for the Backup Gateway 2 local API.
+
+`tesla_powerwall.Powerwall` is synchronous so every request blocks the
+caller. `AsyncPowerwall` has the same login, charge, meters, grid status
+and site info calls as coroutines, and `read_sample()` fetches the
+endpoints a `samples.Sample` is made from concurrently.
+
+Clients share an `aiohttp.ClientSession` made by `gateway_session()`.
+Its connection pool keeps connections to each gateway alive between
+polls so we do not pay for a TLS handshake with every request, and it
+does not verify the gateway's self-signed certificate. One event loop
+and one session can drive any number of gateways, see `read_samples()`.
+
+Responses are wrapped in the same `tesla_powerwall` response classes,
+and failures raised as the same `tesla_powerwall` exceptions, as the
+synchronous client uses.
+"""
+
+# system imports
+#
+import os
+import json
+import time
+import asyncio
+from urllib.parse import urljoin
+
+# 3rd party modules
+#
+import aiohttp
+from tesla_powerwall import (
+    AccessDeniedError,
+    APIError,
+    GridStatus,
+    MetersAggregates,
+    PowerwallStatus,
+    PowerwallUnreachableError,
+    SiteInfo,
+    User,
+    assert_attribute,
+)
+
+# Project modules
+#
+from samples import grid_status_code
+from metric_schema import SCHEMA
+
+DEFAULT_TIMEOUT = 10  # seconds
+KEEPALIVE_TIMEOUT = 120  # seconds
+
+# Most connections we open to any one gateway. The gateway is a small
+# device and does not cope well with many parallel requests.
+#
+CONNECTIONS_PER_GATEWAY = 4
+
+
+####################################################################
+#
+def gateway_session(limit=100, limit_per_host=CONNECTIONS_PER_GATEWAY):
+    """
+    Return an `aiohttp.ClientSession` for talking to backup gateways.
+    It must be closed when done with, e.g. `async with gateway_session()`.
+
+    Keyword Arguments:
+    limit          -- most connections open across all gateways
+    limit_per_host -- most connections open to any one gateway
+    """
+    connector = aiohttp.TCPConnector(
+        ssl=False,
+        limit=limit,
+        limit_per_host=limit_per_host,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+    )
+    # The gateway is addressed by IP address and aiohttp's default cookie
+    # jar ignores cookies from IP addresses.
+    #
+    return aiohttp.ClientSession(
+        connector=connector, cookie_jar=aiohttp.CookieJar(unsafe=True)
+    )
+
+
+##################################################################
+##################################################################
+#
+class AsyncPowerwall:
+    """
+    Async client for one backup gateway.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, endpoint, session, timeout=DEFAULT_TIMEOUT):
+        """
+        Keyword Arguments:
+        endpoint -- host name or address of the gateway
+        session  -- `aiohttp.ClientSession` from `gateway_session()`
+        timeout  -- seconds to wait for any one request
+        """
+        if not endpoint.startswith("http"):
+            endpoint = f"https://{endpoint}"
+        self.endpoint = endpoint.replace("http://", "https://").rstrip("/")
+        self.base_url = f"{self.endpoint}/api/"
+        self.session = session
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.token = None
+        self.credentials = None
+        self.login_lock = asyncio.Lock()
+
+    ####################################################################
+    #
+    def __repr__(self):
+        return f"AsyncPowerwall({self.endpoint!r})"
+
+    ####################################################################
+    #
+    async def _request(self, method, path, payload=None):
+        """
+        Make a request to the gateway api and return the decoded json.
+        Raises the same exceptions as `tesla_powerwall.API` does.
+        """
+        headers = {}
+        if self.token is not None:
+            headers["Authorization"] = f"Bearer {self.token}"
+        try:
+            async with self.session.request(
+                method,
+                urljoin(self.base_url, path),
+                json=payload,
+                headers=headers,
+                timeout=self.timeout,
+            ) as response:
+                status = response.status
+                text = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise PowerwallUnreachableError(e)
+
+        if status in (401, 403):
+            raise AccessDeniedError(path)
+        if status >= 400:
+            raise APIError(f"API returned status code '{status}': {text}")
+        try:
+            data = json.loads(text) if text else {}
+        except ValueError:
+            raise APIError(f"Error while decoding json of response: {text}")
+        if isinstance(data, dict) and "error" in data:
+            raise APIError(data["error"])
+        return data
+
+    ####################################################################
+    #
+    async def get(self, path):
+        """
+        GET an api endpoint. If our login has expired we log in again
+        with the same credentials and retry once.
+        """
+        token = self.token
+        try:
+            return await self._request("GET", path)
+        except AccessDeniedError:
+            if self.credentials is None:
+                raise
+        # Concurrent requests all find out at once. Only the first to get
+        # the lock logs in, the rest use its new token.
+        #
+        async with self.login_lock:
+            if self.token == token:
+                await self.login(*self.credentials)
+        return await self._request("GET", path)
+
+    ####################################################################
+    #
+    async def login(self, password, email=""):
+        """
+        Log in as the customer user. The credentials are kept so we can
+        log in again when the gateway expires our session.
+        """
+        response = await self._request(
+            "POST",
+            "login/Basic",
+            {
+                "username": User.CUSTOMER.value,
+                "email": email,
+                "password": password,
+                "force_sm_off": False,
+            },
+        )
+        self.credentials = (password, email)
+        self.token = response.get("token")
+        return response
+
+    ####################################################################
+    #
+    async def get_charge(self):
+        return assert_attribute(
+            await self.get("system_status/soe"), "percentage", "soe"
+        )
+
+    ####################################################################
+    #
+    async def get_meters(self):
+        return MetersAggregates(await self.get("meters/aggregates"))
+
+    ####################################################################
+    #
+    async def get_grid_status(self):
+        status = assert_attribute(
+            await self.get("system_status/grid_status"),
+            "grid_status",
+            "grid_status",
+        )
+        return GridStatus(status)
+
+    ####################################################################
+    #
+    async def get_site_info(self):
+        return SiteInfo(await self.get("site_info"))
+
+    ####################################################################
+    #
+    async def get_status(self):
+        return PowerwallStatus(await self.get("status"))
+
+    ####################################################################
+    #
+    async def get_version(self):
+        return assert_attribute(await self.get("status"), "version", "status")
+
+    ####################################################################
+    #
+    async def read_sample(self, schema=SCHEMA):
+        """
+        Read a `Sample` with the columns in the metric schema from the
+        gateway. The meters, charge and grid status come from
+        independent endpoints so they are read at the same time, and
+        only if something in the schema comes from them.
+        """
+        sample = schema.new_sample(time.time())
+        reads = {}
+        if schema.meters:
+            reads["meters"] = self.get("meters/aggregates")
+        if "battery_pct" in schema:
+            reads["battery_pct"] = self.get_charge()
+        if "grid_status" in schema:
+            reads["grid_status"] = self.get_grid_status()
+        results = dict(zip(reads, await asyncio.gather(*reads.values())))
+
+        if "meters" in results:
+            schema.read_meters(sample, results["meters"])
+        if "battery_pct" in results:
+            sample.battery_pct = results["battery_pct"]
+        if "grid_status" in results:
+            sample.grid_status = grid_status_code(results["grid_status"])
+        return sample
+
+
+####################################################################
+#
+async def read_samples(gateways):
+    """
+    Read a sample from every gateway at the same time. Returns a dict of
+    gateway to its `Sample`, or to the exception reading it raised so
+    one unreachable gateway does not stop us hearing from the others.
+
+    Keyword Arguments:
+    gateways -- list of logged in `AsyncPowerwall`s
+    """
+    results = await asyncio.gather(
+        *(gw.read_sample() for gw in gateways), return_exceptions=True
+    )
+    return dict(zip(gateways, results))
+
+
+#############################################################################
+#
+async def main():
+    """
+    Read a sample from each of the gateways in BACKUP_GW_ADDR, a comma
+    separated list, every few seconds.
+    """
+    # Imported here so the client does not need vault to be used.
+    #
+    from utils import get_hvac_client
+
+    hvac_client = get_hvac_client()
+    creds = hvac_client.secrets.kv.v1.read_secret(
+        os.getenv("VAULT_SECRETS_PATH")
+    )["data"]
+    hosts = os.getenv("BACKUP_GW_ADDR").split(",")
+
+    async with gateway_session() as session:
+        gateways = [AsyncPowerwall(host.strip(), session) for host in hosts]
+        await asyncio.gather(*(gw.login(creds["password"]) for gw in gateways))
+        while True:
+            started = time.monotonic()
+            for gw, sample in (await read_samples(gateways)).items():
+                print(f"{gw.endpoint}: {sample}")
+            print(f"Read {len(gateways)} in {time.monotonic() - started:.3f}s")
+            await asyncio.sleep(5)
+
+
+############################################################################
+############################################################################
+#
+# Here is where it all starts
+#
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    asyncio.run(main())
+#
+############################################################################
+############################################################################
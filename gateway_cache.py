@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+A caching wrapper around `tesla_powerwall.Powerwall`.
+
+Things like the site info, serial numbers, and VIN only change when the
+gateway firmware is updated, yet every call is a full authenticated
+request to the gateway. `CachingPowerwall` answers those from a cache
+with a per-endpoint time to live. Live data (meters, charge, grid
+status) is not in `ttls` and always goes to the device.
+
+The firmware version is cached with a short ttl and checked before any
+other cached answer is handed out. Whenever it is fetched again and has
+changed, everything in the cache is thrown away.
+"""
+
+# system imports
+#
+import time
+
+# Seconds each endpoint's answer may be served from the cache.
+#
+DEFAULT_TTLS = {
+    "get_version": 300,
+    "get_site_info": 3600,
+    "get_solars": 3600,
+    "get_device_type": 86400,
+    "get_serial_numbers": 86400,
+    "get_vin": 86400,
+}
+
+
+##################################################################
+##################################################################
+#
+class CachingPowerwall:
+    """
+    Wraps a `Powerwall`. Methods named in `ttls` are cached, every other
+    attribute is passed straight through to the wrapped object.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, powerwall, ttls=None, clock=time.monotonic):
+        """
+        Keyword Arguments:
+        powerwall -- the `tesla_powerwall.Powerwall` to wrap
+        ttls      -- dict of method name to seconds. Defaults to
+                     `DEFAULT_TTLS`
+        clock     -- function returning the current time in seconds
+        """
+        self._powerwall = powerwall
+        self._ttls = dict(DEFAULT_TTLS if ttls is None else ttls)
+        self._clock = clock
+        self._cache = {}  # name -> (expires, value)
+        self._methods = {}
+        self._version = None
+        self.hits = dict.fromkeys(self._ttls, 0)
+        self.misses = dict.fromkeys(self._ttls, 0)
+
+    ####################################################################
+    #
+    def __getattr__(self, name):
+        # Only called for attributes we do not have ourselves.
+        #
+        if name not in self._ttls:
+            return getattr(self._powerwall, name)
+        method = self._methods.get(name)
+        if method is None:
+            method = self._methods[name] = self._make_cached(name)
+        return method
+
+    ####################################################################
+    #
+    def _make_cached(self, name):
+        fetch = getattr(self._powerwall, name)
+
+        def cached():
+            if name != "get_version" and "get_version" in self._ttls:
+                self.get_version()
+            now = self._clock()
+            entry = self._cache.get(name)
+            if entry is not None and entry[0] > now:
+                self.hits[name] += 1
+                return entry[1]
+            self.misses[name] += 1
+            value = fetch()
+            if name == "get_version":
+                self._check_version(value)
+            self._cache[name] = (now + self._ttls[name], value)
+            return value
+
+        cached.__name__ = name
+        cached.__doc__ = fetch.__doc__
+        return cached
+
+    ####################################################################
+    #
+    def _check_version(self, version):
+        """
+        Called with every freshly fetched firmware version. If it is not
+        what we saw last time drop the whole cache.
+        """
+        if self._version is not None and version != self._version:
+            self.invalidate()
+        self._version = version
+
+    ####################################################################
+    #
+    def invalidate(self, name=None):
+        """
+        Drop `name` from the cache, or everything if `name` is None.
+        """
+        if name is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(name, None)
+
+    ####################################################################
+    #
+    def cache_stats(self):
+        """
+        Return a dict of method name to {'hits': n, 'misses': n}.
+        """
+        return {
+            name: {"hits": self.hits[name], "misses": self.misses[name]}
+            for name in self._ttls
+        }
@@ -0,0 +1,689 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+The local history store. Everything we collect or download about the
+site ends up in files under `HISTORY_FILE_DIR`:
+
+- `%Y-%m-%d_samples.bin` -- samples read from the backup gateway by
+  as_power_plot.py. A one line json header describing the record
+  layout followed by packed `samples.Sample` records. The records have
+  the columns in the metric schema (see metric_schema.py). Columns are
+  dropped from a day's file once it is older than their retention, and
+  the file once it is older than every column's retention. Columns
+  without a retention are kept forever.
+- `%Y-%m-%d_data.json` -- samples in the format as_power_plot.py used
+  to write, 24 hours of series as json. Still read if there is no
+  `.bin` file for a day.
+- `%Y-%m_samples.arc` and `%Y-%m_samples.idx` -- the month's archive.
+  Once a day is `ARCHIVE_AFTER_DAYS` old its samples are moved out of
+  its own file in to the archive for its month, in compressed chunks of
+  an hour each. The index says where each day's hours are so a day or
+  an hour can be read without decompressing the rest of the month.
+  Archived days lose columns as they outlive their retention too.
+- `calendar/%Y-%m-%d_power.json` -- the tesla cloud
+  `get_energy_site_calendar_history_data(kind="power")` time series for
+  that day
+"""
+
+# system imports
+#
+import os
+import json
+import zlib
+import tempfile
+from pathlib import Path
+from datetime import date, datetime, timedelta
+
+# 3rd party modules
+#
+import pytz
+from dotenv import load_dotenv
+
+# HISTORY_FILE_DIR may be set in .env so make sure it has been loaded
+# before we look at it.
+#
+load_dotenv()
+
+# zstandard compresses the archives smaller and faster, but zlib is
+# always there.
+#
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Project modules
+#
+from samples import METERS, Sample, record_type  # noqa: E402
+from metric_schema import SCHEMA  # noqa: E402
+
+TIMEZONE = pytz.timezone("US/Pacific")
+HISTORY_FILE_DIR = Path(
+    os.getenv("HISTORY_FILE_DIR", "~/.powerwall-history")
+).expanduser()
+SAMPLE_FILE_FMT = "%Y-%m-%d_samples.bin"
+HISTORY_FILE_FMT = "%Y-%m-%d_data.json"
+CALENDAR_DIR = HISTORY_FILE_DIR / "calendar"
+CALENDAR_FILE_FMT = "%Y-%m-%d_power.json"
+DATE_FMT = "%Y-%m-%d_%H:%M:%S%z"
+ARCHIVE_FILE_FMT = "%Y-%m_samples.arc"
+ARCHIVE_INDEX_FMT = "%Y-%m_samples.idx"
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "31"))
+ARCHIVE_CODEC = os.getenv(
+    "ARCHIVE_CODEC", "zstd" if zstandard is not None else "zlib"
+)
+ARCHIVE_CHUNK = 3600  # seconds of samples in each compressed chunk
+
+# name: (compress, decompress)
+#
+CODECS = {"zlib": (lambda data: zlib.compress(data, 9), zlib.decompress)}
+if zstandard is not None:
+    # The compressor objects are not thread safe so each call gets its
+    # own.
+    #
+    CODECS["zstd"] = (
+        lambda data: zstandard.ZstdCompressor(level=19).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+
+
+####################################################################
+#
+def write_json_atomic(path, data):
+    """
+    Write `data` as json to `path` such that readers either see the old
+    file or the complete new one, never a partially written file.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+####################################################################
+#
+def sample_file(day, history_dir=HISTORY_FILE_DIR):
+    """
+    Return the path of the gateway sample file for `day`.
+    """
+    return history_dir / day.strftime(SAMPLE_FILE_FMT)
+
+
+####################################################################
+#
+def history_file(day, history_dir=HISTORY_FILE_DIR):
+    """
+    Return the path of the old style json gateway history for `day`.
+    """
+    return history_dir / day.strftime(HISTORY_FILE_FMT)
+
+
+####################################################################
+#
+def sample_file_header(record=Sample):
+    header = {"fields": record.FIELDS, "format": record.STRUCT.format}
+    return (json.dumps(header) + "\n").encode()
+
+
+####################################################################
+#
+def header_record_type(header):
+    """
+    Return the `Sample` class for the record layout in a sample file
+    header.
+    """
+    fields = header["fields"]
+    core = Sample.STRUCT.format
+    extra_fmt = header["format"][len(core) :]
+    if (
+        not header["format"].startswith(core)
+        or tuple(fields[: len(Sample.FIELDS)]) != Sample.FIELDS
+        or len(fields) - len(Sample.FIELDS) != len(extra_fmt)
+    ):
+        raise ValueError(f"unknown record format {header}")
+    return record_type(zip(fields[len(Sample.FIELDS) :], extra_fmt))
+
+
+####################################################################
+#
+def read_sample_file(path):
+    """
+    Return the list of samples in a sample file. A partial record at
+    the end, from being interrupted in the middle of a write, is
+    ignored.
+    """
+    with open(path, "rb") as f:
+        record = header_record_type(json.loads(f.readline()))
+        data = f.read()
+    size = record.STRUCT.size
+    return list(record.iter_unpack(data[: len(data) - len(data) % size]))
+
+
+####################################################################
+#
+def write_sample_file(path, samples, record=Sample):
+    """
+    Atomically replace the sample file at `path` with `samples` packed
+    as `record`s.
+    """
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(sample_file_header(record))
+            f.write(b"".join(record.pack_from(s) for s in samples))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+####################################################################
+#
+def retained_record(record, schema, age):
+    """
+    Return the record type for a day that is `age` days old: `record`
+    without the extra columns whose retention the day has outlived. If
+    it has outlived none `record` itself is returned.
+    """
+    extra = record.FIELDS[len(Sample.FIELDS) :]
+    fmts = record.STRUCT.format[len(Sample.STRUCT.format) :]
+    keep = [
+        (name, fmt) for name, fmt in zip(extra, fmts) if schema.kept(name, age)
+    ]
+    if len(keep) == len(extra):
+        return record
+    return record_type(keep)
+
+
+####################################################################
+#
+def prune_history(schema=SCHEMA, history_dir=HISTORY_FILE_DIR, today=None):
+    """
+    Apply the schema's retention to the gateway sample files. A day's
+    file is removed once it is older than the retention of every
+    column. Until then it is rewritten without any extra column whose
+    retention it has outlived. The standard `Sample` columns stay until
+    the file is removed. The days in the month archives get the same
+    treatment: a day is archived again without the columns it has
+    outlived, and a month's archive is removed once its last day is
+    older than the retention of every column. Nothing is removed for a
+    column kept forever, and no file or archive is removed while any
+    column is.
+    """
+    history_dir = Path(history_dir)
+    if today is None:
+        today = datetime.now(TIMEZONE).date()
+    max_days = schema.max_retention_days
+    for path in sorted(history_dir.glob("*_samples.bin")):
+        try:
+            day = datetime.strptime(path.name, SAMPLE_FILE_FMT).date()
+        except ValueError:
+            continue
+        age = (today - day).days
+        if max_days is not None and age > max_days:
+            path.unlink()
+            legacy = history_file(day, history_dir)
+            if legacy.exists():
+                legacy.unlink()
+            continue
+        with open(path, "rb") as f:
+            record = header_record_type(json.loads(f.readline()))
+        keep = retained_record(record, schema, age)
+        if keep is not record:
+            write_sample_file(path, read_sample_file(path), keep)
+
+    # A month's archive goes once its last day is older than every
+    # column's retention. Until then any day in it that has outlived a
+    # column is archived again without it. `archive_day()` appends the
+    # smaller day, so the bytes of the old one stay in the archive until
+    # the month is removed.
+    #
+    for path in sorted(history_dir.glob("*_samples.idx")):
+        try:
+            month = datetime.strptime(path.name, ARCHIVE_INDEX_FMT).date()
+        except ValueError:
+            continue
+        last_day = (month + timedelta(days=31)).replace(day=1) - timedelta(
+            days=1
+        )
+        if max_days is not None and (today - last_day).days > max_days:
+            archive_file(month, history_dir).unlink(missing_ok=True)
+            path.unlink()
+            continue
+        index = read_archive_index(month, history_dir)
+        for name, entry in sorted(index["days"].items()):
+            day = date.fromisoformat(name)
+            record = header_record_type(entry["header"])
+            keep = retained_record(record, schema, (today - day).days)
+            if keep is not record:
+                samples = load_archived_day(day, history_dir)
+                archive_day(day, samples, keep, history_dir)
+
+
+####################################################################
+#
+def load_legacy_day(path, day):
+    """
+    Return the samples from an old style json history file that were
+    taken on `day`. The file for a day holds the 24 hours leading up to
+    the last write that day so we drop the samples from the day before.
+    """
+    with open(path, "r") as f:
+        data = json.load(f)
+
+    samples = []
+    meter_values = data["meter_values"]
+    for idx, x in enumerate(data["x_axis"]):
+        x = datetime.strptime(x, DATE_FMT)
+        if x.astimezone(TIMEZONE).date() != day:
+            continue
+        sample = Sample(x.timestamp(), battery_pct=data["battery_pct"][idx])
+        for meter in METERS:
+            if meter in meter_values:
+                setattr(sample, meter, meter_values[meter][idx])
+        samples.append(sample)
+    return samples
+
+
+####################################################################
+#
+def archive_file(day, history_dir=HISTORY_FILE_DIR):
+    """
+    Return the path of the archive for the month `day` is in.
+    """
+    return history_dir / day.strftime(ARCHIVE_FILE_FMT)
+
+
+####################################################################
+#
+def archive_index_file(day, history_dir=HISTORY_FILE_DIR):
+    """
+    Return the path of the index for the month `day` is in.
+    """
+    return history_dir / day.strftime(ARCHIVE_INDEX_FMT)
+
+
+####################################################################
+#
+def read_archive_index(day, history_dir=HISTORY_FILE_DIR):
+    """
+    Return the index of the archive for the month `day` is in, or None
+    if there is no archive for that month. It looks like:
+
+        {"codec": "zlib",
+         "days": {"2021-01-02": {"header": {"fields": [...],
+                                            "format": "<d5fBB..."},
+                                 "chunks": [[start, offset, length],
+                                            ...]},
+                  ...}}
+
+    Each chunk has the samples from `start` for `ARCHIVE_CHUNK` seconds
+    at `offset` in the archive, `length` bytes compressed.
+    """
+    path = archive_index_file(day, history_dir)
+    if not path.exists():
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+####################################################################
+#
+def shuffle(data, size):
+    """
+    Return the packed records in `data` rearranged so the first byte of
+    every record comes first, then the second byte of every record and
+    so on. Neighbouring samples are much alike so this puts long runs of
+    the same or similar bytes together, which compress far better than
+    the records do as they are.
+    """
+    return b"".join(data[i::size] for i in range(size))
+
+
+####################################################################
+#
+def unshuffle(data, size):
+    """
+    Undo `shuffle()`.
+    """
+    count = len(data) // size
+    out = bytearray(len(data))
+    for i in range(size):
+        out[i::size] = data[i * count : (i + 1) * count]
+    return bytes(out)
+
+
+####################################################################
+#
+def archive_day(day, samples, record=Sample, history_dir=HISTORY_FILE_DIR):
+    """
+    Add the `samples` for `day` to its month's archive as `record`s,
+    replacing anything already archived for that day.
+
+    The chunks are appended to the archive and made durable before the
+    new index replaces the old one, so a crash part way through leaves
+    the archive as it was, plus some bytes at the end nothing refers
+    to.
+    """
+    index = read_archive_index(day, history_dir) or {
+        "codec": ARCHIVE_CODEC,
+        "days": {},
+    }
+    if index["codec"] not in CODECS:
+        raise RuntimeError(f"can not write {index['codec']} archives")
+    compress = CODECS[index["codec"]][0]
+
+    hours = {}
+    for sample in sorted(samples, key=lambda s: s.timestamp):
+        start = int(sample.timestamp // ARCHIVE_CHUNK) * ARCHIVE_CHUNK
+        hours.setdefault(start, []).append(record.pack_from(sample))
+
+    path = archive_file(day, history_dir)
+    chunks = []
+    with open(path, "ab") as f:
+        for start, records in sorted(hours.items()):
+            data = compress(shuffle(b"".join(records), record.STRUCT.size))
+            chunks.append([start, f.tell(), len(data)])
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    index["days"][day.isoformat()] = {
+        "header": {"fields": record.FIELDS, "format": record.STRUCT.format},
+        "chunks": chunks,
+    }
+    write_json_atomic(archive_index_file(day, history_dir), index)
+
+
+####################################################################
+#
+def load_archived_day(day, history_dir=HISTORY_FILE_DIR, start=None, end=None):
+    """
+    Return the archived samples for `day`, or None if it is not in its
+    month's archive. If `start` or `end` are given only the chunks that
+    can have samples in that range are read and decompressed, though the
+    samples from those chunks are all returned.
+    """
+    index = read_archive_index(day, history_dir)
+    if index is None or day.isoformat() not in index["days"]:
+        return None
+    if index["codec"] not in CODECS:
+        raise RuntimeError(
+            f"{archive_file(day, history_dir)} is {index['codec']} "
+            "compressed, which needs the zstandard module"
+        )
+    decompress = CODECS[index["codec"]][1]
+    entry = index["days"][day.isoformat()]
+    record = header_record_type(entry["header"])
+
+    samples = []
+    with open(archive_file(day, history_dir), "rb") as f:
+        for chunk_start, offset, length in entry["chunks"]:
+            if end is not None and chunk_start >= end:
+                break
+            if start is not None and chunk_start + ARCHIVE_CHUNK <= start:
+                continue
+            f.seek(offset)
+            data = unshuffle(decompress(f.read(length)), record.STRUCT.size)
+            samples.extend(record.iter_unpack(data))
+    return samples
+
+
+####################################################################
+#
+def archive_history(
+    history_dir=HISTORY_FILE_DIR,
+    today=None,
+    after_days=ARCHIVE_AFTER_DAYS,
+    schema=SCHEMA,
+):
+    """
+    Move every day more than `after_days` old out of its own sample
+    file, or old style json file, in to its month's archive. The day's
+    files are only removed once it is safely in the archive.
+
+    Extra columns whose retention in `schema` the day has outlived are
+    left out. The rest are dropped from the archive by `prune_history()`
+    as they expire.
+    """
+    history_dir = Path(history_dir)
+    if today is None:
+        today = datetime.now(TIMEZONE).date()
+    days = {}
+    for pattern, fmt in (
+        ("*_samples.bin", SAMPLE_FILE_FMT),
+        ("*_data.json", HISTORY_FILE_FMT),
+    ):
+        for path in history_dir.glob(pattern):
+            try:
+                day = datetime.strptime(path.name, fmt).date()
+            except ValueError:
+                continue
+            if (today - day).days > after_days:
+                days[day] = None
+    for day in sorted(days):
+        path = sample_file(day, history_dir)
+        legacy = history_file(day, history_dir)
+        if path.exists():
+            with open(path, "rb") as f:
+                record = header_record_type(json.loads(f.readline()))
+            record = retained_record(record, schema, (today - day).days)
+            archive_day(day, read_sample_file(path), record, history_dir)
+            path.unlink()
+        else:
+            archive_day(day, load_legacy_day(legacy, day), Sample, history_dir)
+        if legacy.exists():
+            legacy.unlink()
+
+
+####################################################################
+#
+def load_day(day, history_dir=HISTORY_FILE_DIR):
+    """
+    Return the list of gateway samples taken on `day`, or None if we
+    have no history for that day.
+    """
+    path = sample_file(day, history_dir)
+    if path.exists():
+        return read_sample_file(path)
+    path = history_file(day, history_dir)
+    if path.exists():
+        return load_legacy_day(path, day)
+    return load_archived_day(day, history_dir)
+
+
+####################################################################
+#
+def load_range(start, end, history_dir=HISTORY_FILE_DIR):
+    """
+    Return the gateway samples with timestamps from `start` up to but
+    not including `end`, both seconds since the epoch.
+    """
+    day = datetime.fromtimestamp(start, TIMEZONE).date()
+    last_day = datetime.fromtimestamp(end, TIMEZONE).date()
+    samples = []
+    while day <= last_day:
+        if (
+            sample_file(day, history_dir).exists()
+            or history_file(day, history_dir).exists()
+        ):
+            day_samples = load_day(day, history_dir)
+        else:
+            day_samples = load_archived_day(day, history_dir, start, end)
+        for sample in day_samples or ():
+            if start <= sample.timestamp < end:
+                samples.append(sample)
+        day += timedelta(days=1)
+    return samples
+
+
+##################################################################
+##################################################################
+#
+class HistoryWriter:
+    """
+    Appends samples to the sample file for the day they were taken on.
+    Each sample is a single small write instead of rewriting the whole
+    day. Records have the columns of the metric schema.
+    """
+
+    ####################################################################
+    #
+    def __init__(
+        self, history_dir=HISTORY_FILE_DIR, schema=SCHEMA, prune=False
+    ):
+        """
+        Keyword Arguments:
+        history_dir -- where the sample files are
+        schema      -- `metric_schema.Schema` deciding the columns kept
+        prune       -- if True apply the schema's retention with
+                       `prune_history()`, and archive old days with
+                       `archive_history()`, whenever we start a new day
+        """
+        self.history_dir = Path(history_dir)
+        self.schema = schema
+        self.record = schema.record_type
+        self.prune = prune
+        self.day = None
+        self.fh = None
+
+    ####################################################################
+    #
+    def _open(self, day):
+        self.close()
+        self.history_dir.mkdir(parents=True, exist_ok=True)
+        if self.prune:
+            prune_history(self.schema, self.history_dir)
+            archive_history(self.history_dir, schema=self.schema)
+        path = sample_file(day, self.history_dir)
+        header = sample_file_header(self.record)
+        if path.exists() and path.stat().st_size:
+            with open(path, "rb") as f:
+                existing = f.readline()
+            # The schema changed since this file was started. Rewrite
+            # what is already there with the new columns.
+            #
+            if existing != header:
+                write_sample_file(path, read_sample_file(path), self.record)
+        self.fh = open(path, "ab")
+        if self.fh.tell() == 0:
+            self.fh.write(header)
+        else:
+            # Cut off a partial record left by a crash so the records
+            # after it stay aligned.
+            #
+            extra = (self.fh.tell() - len(header)) % self.record.STRUCT.size
+            if extra:
+                self.fh.truncate(self.fh.tell() - extra)
+        self.day = day
+
+    ####################################################################
+    #
+    def append(self, sample):
+        day = sample.as_datetime(TIMEZONE).date()
+        if day != self.day:
+            self._open(day)
+        if type(sample) is self.record:
+            self.fh.write(sample.pack())
+        else:
+            self.fh.write(self.record.pack_from(sample))
+        self.fh.flush()
+
+    ####################################################################
+    #
+    def merge(self, samples):
+        """
+        Merge `samples` in to the history in timestamp order, for
+        samples that belong before ones we already have. Each day they
+        touch is rewritten. A gap marker whose gap the new samples start
+        to fill is dropped.
+        """
+        by_day = {}
+        for sample in samples:
+            day = sample.as_datetime(TIMEZONE).date()
+            by_day.setdefault(day, []).append(sample)
+
+        # Our open file is about to be replaced. The next `append()`
+        # opens the new one.
+        #
+        self.close()
+        self.history_dir.mkdir(parents=True, exist_ok=True)
+        for day, new in sorted(by_day.items()):
+            existing = load_day(day, self.history_dir) or []
+            have = {s.timestamp for s in existing}
+            new = [s for s in new if s.timestamp not in have]
+            added = set(map(id, new))
+            merged = sorted(existing + new, key=lambda s: s.timestamp)
+            kept = []
+            for idx, sample in enumerate(merged):
+                if sample.is_gap:
+                    after = next(
+                        (s for s in merged[idx + 1 :] if not s.is_gap), None
+                    )
+                    if after is not None and id(after) in added:
+                        continue
+                kept.append(sample)
+            write_sample_file(
+                sample_file(day, self.history_dir), kept, self.record
+            )
+
+    ####################################################################
+    #
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+            self.day = None
+
+
+####################################################################
+#
+def calendar_file(day, history_dir=HISTORY_FILE_DIR):
+    """
+    Return the path of the cached cloud calendar history for `day`.
+    """
+    return history_dir / "calendar" / day.strftime(CALENDAR_FILE_FMT)
+
+
+####################################################################
+#
+def save_calendar_day(day, time_series, history_dir=HISTORY_FILE_DIR):
+    """
+    Store the cloud power time series for `day`.
+
+    Keyword Arguments:
+    day         -- datetime.date the series is for
+    time_series -- the 'time_series' list from
+                   `get_energy_site_calendar_history_data()`
+    """
+    write_json_atomic(
+        calendar_file(day, history_dir),
+        {"date": day.isoformat(), "time_series": time_series},
+    )
+
+
+####################################################################
+#
+def load_calendar_day(day, history_dir=HISTORY_FILE_DIR):
+    """
+    Return the cached cloud power time series for `day` or None if we
+    do not have it.
+    """
+    path = calendar_file(day, history_dir)
+    if not path.exists():
+        return None
+    with open(path, "r") as f:
+        return json.load(f)["time_series"]
@@ -1,13 +1,18 @@
 # This is an Example of how to use the tesla_powerwall API and the influxdb Client to generate and store
 # Monitoring Data in a Time Series Database. InfluxDB is natively compatible with https://grafana.com
 
+# Samples go to a local write-ahead spool first and a background thread
+# drains the spool in to InfluxDB, so an InfluxDB restart or a network
+# blip does not lose samples or stop the loop.
+
 # Imports
 import os
+import time
 from time import sleep
-import influxdb_client
-from influxdb_client.client.write_api import SYNCHRONOUS
 from tesla_powerwall import Powerwall
 
+from exporters import line_protocol
+from spool import Spool, SpoolDrainer, influx_writer
 
 # Variables
 # InfluxDB
@@ -16,9 +21,9 @@ org = "<my-org>"
 token = "<my-token>"
 url = "http://localhost:8086"
 
-client = influxdb_client.InfluxDBClient(url=url, token=token, org=org)
-
-write_api = client.write_api(write_options=SYNCHRONOUS)
+spool = Spool(os.getenv("SPOOL_DIR", "./influx-spool"))
+drainer = SpoolDrainer(spool, influx_writer(url, token, org, bucket))
+drainer.start()
 
 # Powerwall
 
@@ -45,8 +50,13 @@ print("Device Type: {}".format(power_wall.get_device_type()))
 # Sending Data
 
 while True:
-    p = influxdb_client.Point("Measurement").field(
-        "Charge", power_wall.get_charge
+    spool.append(
+        line_protocol(
+            "Measurement",
+            {},
+            {"Charge": power_wall.get_charge()},
+            time.time_ns(),
+        ),
+        drainer.metrics_line(),
     )
-    write_api.write(bucket=bucket, org=org, record=p)
     sleep(1)
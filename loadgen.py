@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+Load generator and throughput benchmark for shipping metrics to
+influxdb.
+
+Synthesizes realistic backup gateway readings for a number of sites and
+pushes them through the same path powerwall_to_influxdb.py uses:
+`sample_lines()`, the write-ahead `Spool`, and a `SpoolDrainer` writing
+with `influx_writer()`. The writes go to a stand-in influxdb that runs
+in its own process on localhost, accepts /api/v2/write line protocol,
+and times every point from the timestamp it was collected with to when
+it arrived.
+
+When the run is over and the spool has drained we report the sustained
+points per second, p50 and p99 end to end latency, and the CPU and
+memory used by the shipping process.
+
+Usage:
+  loadgen.py [options]
+
+Options:
+  --version
+  -h, --help            Show this text and exit
+  -n, --sites=<n>       Number of sites to simulate [default: 100]
+  -i, --interval=<secs> Seconds between samples from each site
+                        [default: 10]
+  -d, --duration=<secs> How long to generate load for [default: 60]
+  --batch-size=<n>      Most lines the drainer writes at once
+                        [default: 5000]
+  --idle-interval=<secs>  How long the drainer waits when the spool is
+                        empty [default: 1.0]
+  --drain-timeout=<secs>  How long to wait for the spool to drain after
+                        the run [default: 60]
+  --spool=<dir>         Spool directory. Defaults to a temporary one
+  --port=<port>         Port for the stand-in influxdb [default: 18086]
+  --seed=<n>            Random seed [default: 1]
+"""
+
+# system imports
+#
+import gzip
+import json
+import math
+import time
+import random
+import resource
+import tempfile
+import multiprocessing
+from array import array
+from pathlib import Path
+from urllib.request import urlopen
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 3rd party modules
+#
+from docopt import docopt
+from tesla_powerwall import GridStatus, MetersAggregates, SiteInfo
+
+# Project modules
+#
+from spool import Spool, SpoolDrainer, influx_writer
+from powerwall_to_influxdb import sample_lines
+
+BATTERY_KWH = 13.5
+
+
+####################################################################
+#
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+##################################################################
+##################################################################
+#
+class SyntheticPowerwall:
+    """
+    Stands in for a `Powerwall` in `sample_lines()`. Solar follows the
+    sun with passing clouds, the house load wanders around a base load,
+    the battery covers the difference within its limits and the grid
+    covers the rest. The meters' energy counters add up what flowed.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, site_name, rng):
+        self.site_name = site_name
+        self.rng = rng
+        self.solar_peak = rng.uniform(3000, 9000)
+        self.base_load = rng.uniform(300, 1200)
+        self.battery_max = 5000.0
+        self.charge = rng.uniform(20, 100)
+        self.cloud = 1.0
+        self.last = time.time()
+        self.energy = {
+            m: {"energy_exported": 0.0, "energy_imported": 0.0}
+            for m in ("site", "battery", "load", "solar")
+        }
+
+    ####################################################################
+    #
+    def get_site_info(self):
+        return SiteInfo({"site_name": self.site_name})
+
+    ####################################################################
+    #
+    def get_charge(self):
+        return self.charge
+
+    ####################################################################
+    #
+    def get_grid_status(self):
+        return GridStatus.CONNECTED
+
+    ####################################################################
+    #
+    def get_meters(self):
+        now = time.time()
+        hours = (now - self.last) / 3600
+        self.last = now
+
+        rng = self.rng
+        hour_of_day = (now / 3600) % 24
+        sun = max(0.0, math.sin(math.pi * (hour_of_day - 6) / 12))
+        self.cloud = min(1.0, max(0.2, self.cloud + rng.gauss(0, 0.05)))
+        solar = self.solar_peak * sun * self.cloud
+        load = self.base_load * rng.uniform(0.7, 1.6)
+
+        # Positive battery power is discharging, like the gateway says.
+        #
+        battery = max(-self.battery_max, min(self.battery_max, load - solar))
+        if self.charge <= 5 and battery > 0:
+            battery = 0.0
+        if self.charge >= 100 and battery < 0:
+            battery = 0.0
+        self.charge -= battery * hours / (BATTERY_KWH * 10)
+        self.charge = min(100.0, max(0.0, self.charge))
+        site = load - solar - battery
+
+        meters = {}
+        for name, power in (
+            ("site", site),
+            ("battery", battery),
+            ("load", load),
+            ("solar", solar),
+        ):
+            energy = self.energy[name]
+            if power > 0:
+                energy["energy_imported"] += power * hours
+            else:
+                energy["energy_exported"] -= power * hours
+            meters[name] = {
+                "last_communication_time": "",
+                "instant_power": power,
+                "instant_reactive_power": rng.uniform(-50, 50),
+                "instant_apparent_power": abs(power) * 1.02,
+                "frequency": 60.0,
+                "energy_exported": energy["energy_exported"],
+                "energy_imported": energy["energy_imported"],
+                "instant_average_voltage": rng.gauss(240, 1.5),
+                "instant_total_current": abs(power) / 240,
+                "i_a_current": 0,
+                "i_b_current": 0,
+                "i_c_current": 0,
+                "timeout": 1500000000,
+            }
+        return MetersAggregates(meters)
+
+
+##################################################################
+##################################################################
+#
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Accepts influxdb v2 line protocol writes and records, for every
+    point, how long ago it was collected. GET /stats returns the totals.
+    """
+
+    ####################################################################
+    #
+    def log_message(self, format, *args):
+        pass
+
+    ####################################################################
+    #
+    def do_POST(self):
+        received = time.time_ns()
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        server = self.server
+        points = 0
+        with server.lock:
+            for line in body.split(b"\n"):
+                if not line:
+                    continue
+                points += 1
+                ts = int(line.rsplit(b" ", 1)[1])
+                server.latencies.append((received - ts) / 1e9)
+            server.points += points
+            server.requests += 1
+            if server.first is None:
+                server.first = received / 1e9
+            server.last = received / 1e9
+        self.send_response(204)
+        self.end_headers()
+
+    ####################################################################
+    #
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            stats = {
+                "points": server.points,
+                "requests": server.requests,
+                "first": server.first,
+                "last": server.last,
+                "p50": percentile(server.latencies, 50),
+                "p99": percentile(server.latencies, 99),
+                "max": max(server.latencies, default=0.0),
+            }
+        body = json.dumps(stats).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+####################################################################
+#
+def run_stand_in(port):
+    """
+    Run the stand-in influxdb until killed. Runs in its own process so
+    its CPU time does not count against the shipper.
+    """
+    import threading
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), StandInHandler)
+    server.lock = threading.Lock()
+    server.latencies = array("d")
+    server.points = server.requests = 0
+    server.first = server.last = None
+    server.serve_forever()
+
+
+####################################################################
+#
+def stand_in_stats(url):
+    with urlopen(f"{url}/stats") as response:
+        return json.load(response)
+
+
+####################################################################
+#
+def wait_for(url, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return stand_in_stats(url)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+####################################################################
+#
+def generate(sites, interval, duration, spool):
+    """
+    Take a sample from every site once per `interval`, spread evenly
+    over the interval, for `duration` seconds. Returns (samples, lines,
+    most seconds we fell behind schedule).
+    """
+    step = interval / len(sites)
+    start = time.monotonic()
+    end = start + duration
+    samples = lines = 0
+    behind = 0.0
+    due = start
+    idx = 0
+    while due < end:
+        now = time.monotonic()
+        if due > now:
+            time.sleep(due - now)
+        else:
+            behind = max(behind, now - due)
+        # Everything that is due, which is more than one sample when
+        # we are behind.
+        #
+        now = time.monotonic()
+        while due <= now and due < end:
+            batch = sample_lines(sites[idx])
+            spool.append(*batch)
+            samples += 1
+            lines += len(batch)
+            idx = (idx + 1) % len(sites)
+            due += step
+    return samples, lines, behind
+
+
+#############################################################################
+#
+def main():
+    """
+    Start the stand-in influxdb, generate load through the spool and
+    drainer, wait for it to drain, and report.
+    """
+    args = docopt(__doc__, version="0.1")
+    n_sites = int(args["--sites"])
+    interval = float(args["--interval"])
+    duration = float(args["--duration"])
+    port = int(args["--port"])
+    url = f"http://127.0.0.1:{port}"
+    rng = random.Random(int(args["--seed"]))
+
+    stand_in = multiprocessing.Process(
+        target=run_stand_in, args=(port,), daemon=True
+    )
+    stand_in.start()
+    tmp_dir = None
+    try:
+        wait_for(url)
+        if args["--spool"]:
+            spool_dir = Path(args["--spool"])
+        else:
+            tmp_dir = tempfile.TemporaryDirectory(prefix="loadgen-spool-")
+            spool_dir = Path(tmp_dir.name)
+        spool = Spool(spool_dir)
+        drainer = SpoolDrainer(
+            spool,
+            influx_writer(url, "loadgen", "loadgen", "loadgen"),
+            batch_size=int(args["--batch-size"]),
+            idle_interval=float(args["--idle-interval"]),
+        )
+        sites = [
+            SyntheticPowerwall(f"site{i:05d}", random.Random(rng.random()))
+            for i in range(n_sites)
+        ]
+
+        print(
+            f"{n_sites} sites every {interval}s for {duration}s, "
+            f"{n_sites / interval:.1f} samples/s"
+        )
+        usage_start = resource.getrusage(resource.RUSAGE_SELF)
+        started = time.monotonic()
+        drainer.start()
+        samples, lines, behind = generate(sites, interval, duration, spool)
+        generated = time.monotonic()
+
+        spool.flush()
+        deadline = generated + float(args["--drain-timeout"])
+        while time.monotonic() < deadline:
+            if stand_in_stats(url)["points"] >= lines:
+                break
+            time.sleep(0.05)
+        drained = time.monotonic()
+        usage_end = resource.getrusage(resource.RUSAGE_SELF)
+        drainer.stop()
+        drainer.join()
+        spool.close()
+        stats = stand_in_stats(url)
+    finally:
+        stand_in.terminate()
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+    wall = drained - started
+    cpu = (usage_end.ru_utime - usage_start.ru_utime) + (
+        usage_end.ru_stime - usage_start.ru_stime
+    )
+    print(f"generated {samples} samples, {lines} points in {wall:.1f}s")
+    if behind > interval / n_sites:
+        print(f"  fell behind schedule by up to {behind:.3f}s")
+    print(f"  received {stats['points']} points in {stats['requests']} writes")
+    if stats["points"] < lines:
+        print(f"  NOT DRAINED: {lines - stats['points']} points still spooled")
+    print(f"  sustained {stats['points'] / wall:.0f} points/s")
+    print(
+        f"  latency p50 {1000 * stats['p50']:.1f}ms "
+        f"p99 {1000 * stats['p99']:.1f}ms max {1000 * stats['max']:.1f}ms"
+    )
+    print(f"  cpu {cpu:.2f}s, {100 * cpu / wall:.1f}% of one core")
+    print(f"  max rss {usage_end.ru_maxrss / 1024:.1f}MB")
+
+
+############################################################################
+############################################################################
+#
+# Here is where it all starts
+#
+if __name__ == "__main__":
+    main()
+#
+############################################################################
+############################################################################
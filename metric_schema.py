@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+The metric schema: the one list of what we collect, store and export.
+
+Each `Metric` names a column and says where its value comes from, its
+unit, and how many days of it the history store keeps, forever if its
+`retention_days` is None, the default. The collectors
+only request and read what is in the schema, the history store only
+keeps those columns, and the exporters only project the columns they
+are asked for.
+
+A metric's source is one of:
+- a meter ('site', 'battery', 'load', 'solar'): `field` is the key in
+  that meter's section of /api/meters/aggregates
+- 'soe': the battery charge percentage
+- 'grid_status': the grid status
+- 'calendar': `field` is the key in the tesla cloud calendar history
+  power time series rows
+
+The schema is read from the json file named by METRIC_SCHEMA if it is
+set, a list of objects with the `Metric` fields, otherwise it is
+`DEFAULT_METRICS`.
+"""
+
+# system imports
+#
+import os
+import json
+from collections import namedtuple
+from operator import attrgetter, itemgetter
+
+# 3rd party modules
+#
+from dotenv import load_dotenv
+
+# Project modules
+#
+from samples import METERS, NAN, Sample, record_type
+
+load_dotenv()
+
+Metric = namedtuple(
+    "Metric",
+    ["name", "source", "field", "unit", "retention_days", "fmt"],
+    defaults=(None, "f"),
+)
+
+CALENDAR = "calendar"
+
+# The extra meter fields powerwall_to_influxdb.py has always collected.
+# The energy counters only ever go up and soon outgrow the precision of
+# a float32 so they are stored as doubles.
+#
+METER_FIELDS = (
+    ("energy_exported", "Wh", "d"),
+    ("energy_imported", "Wh", "d"),
+    ("instant_apparent_power", "VA", "f"),
+    ("instant_average_voltage", "V", "f"),
+    ("instant_reactive_power", "var", "f"),
+    ("instant_total_current", "A", "f"),
+)
+
+DEFAULT_METRICS = (
+    *(Metric(meter, meter, "instant_power", "W") for meter in METERS),
+    Metric("battery_pct", "soe", "percentage", "%"),
+    Metric("grid_status", "grid_status", "grid_status", ""),
+    *(
+        Metric(f"{meter}_{field}", meter, field, unit, 90, fmt)
+        for meter in METERS
+        for field, unit, fmt in METER_FIELDS
+    ),
+    Metric("battery_power", CALENDAR, "battery_power", "W"),
+    Metric("grid_power", CALENDAR, "grid_power", "W"),
+    Metric("solar_power", CALENDAR, "solar_power", "W"),
+)
+
+
+####################################################################
+#
+def projection(columns, row=None):
+    """
+    Return a function that takes a row and returns the tuple of its
+    `columns` values. Uses `operator.attrgetter` for `Sample`s and
+    `operator.itemgetter` for dicts so picking a few columns out of a
+    wide row is a single C level call.
+
+    Keyword Arguments:
+    columns -- sequence of column names
+    row     -- an example of the rows it will be given
+    """
+    columns = tuple(columns)
+    getter = attrgetter if isinstance(row, Sample) else itemgetter
+    get = getter(*columns)
+    if len(columns) == 1:
+        return lambda r: (get(r),)
+    return get
+
+
+##################################################################
+##################################################################
+#
+class Schema:
+    """
+    A set of `Metric`s, with the lookups the collectors and stores
+    need worked out once.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, metrics=DEFAULT_METRICS):
+        self.metrics = tuple(Metric(*m) for m in metrics)
+        self.by_name = {m.name: m for m in self.metrics}
+        if len(self.by_name) != len(self.metrics):
+            raise ValueError("metric names must be unique")
+
+        # Gateway metrics are everything we read from the gateway
+        #
+        self.gateway = tuple(m for m in self.metrics if m.source != CALENDAR)
+        self.calendar_columns = tuple(
+            m.name for m in self.metrics if m.source == CALENDAR
+        )
+        self.meters = tuple(
+            meter
+            for meter in METERS
+            if any(m.source == meter for m in self.gateway)
+        )
+        self._meter_fields = {
+            meter: tuple(
+                (m.name, m.field) for m in self.gateway if m.source == meter
+            )
+            for meter in self.meters
+        }
+
+        # The history store always has the `Sample` columns. Anything
+        # else in the schema is an extra column.
+        #
+        self.extra_columns = tuple(
+            (m.name, m.fmt)
+            for m in self.gateway
+            if m.name not in Sample.FIELDS
+        )
+        self.record_type = record_type(self.extra_columns)
+
+    ####################################################################
+    #
+    def __contains__(self, name):
+        return name in self.by_name
+
+    ####################################################################
+    #
+    @property
+    def columns(self):
+        """
+        Names of the metrics read from the gateway.
+        """
+        return tuple(m.name for m in self.gateway)
+
+    ####################################################################
+    #
+    def meter_fields(self, meter):
+        """
+        Return (column name, field) for each field we want from `meter`.
+        """
+        return self._meter_fields.get(meter, ())
+
+    ####################################################################
+    #
+    def new_sample(self, timestamp):
+        """
+        Return an empty sample with our columns for `timestamp`.
+        """
+        return self.record_type(timestamp)
+
+    ####################################################################
+    #
+    def read_meters(self, sample, aggregates):
+        """
+        Set the meter columns of `sample` from the /api/meters/aggregates
+        response `aggregates`. Fields the gateway did not send are NaN.
+        """
+        for meter in self.meters:
+            section = aggregates.get(meter, {})
+            for name, field in self._meter_fields[meter]:
+                value = section.get(field)
+                setattr(sample, name, NAN if value is None else value)
+
+    ####################################################################
+    #
+    def unit(self, name):
+        return self.by_name[name].unit
+
+    ####################################################################
+    #
+    def retention_days(self, name):
+        """
+        Days the history store keeps `name`, None for forever. Columns
+        that are not in the schema are kept as long as the longest kept
+        column.
+        """
+        if name in self.by_name:
+            return self.by_name[name].retention_days
+        return self.max_retention_days
+
+    ####################################################################
+    #
+    def kept(self, name, age):
+        """
+        True if the history store still keeps `name` in a day that is
+        `age` days old.
+        """
+        days = self.retention_days(name)
+        return days is None or age <= days
+
+    ####################################################################
+    #
+    @property
+    def max_retention_days(self):
+        """
+        Days the history store keeps any gateway metric, None if some
+        metric is kept forever.
+        """
+        days = [m.retention_days for m in self.gateway]
+        if not days or None in days:
+            return None
+        return max(days)
+
+
+####################################################################
+#
+def load_schema(path=None):
+    """
+    Return the `Schema` in the json file at `path`, or the default
+    schema if `path` is None.
+    """
+    if path is None:
+        return Schema()
+    with open(os.path.expanduser(path), "r") as f:
+        return Schema(Metric(**m) for m in json.load(f))
+
+
+SCHEMA = load_schema(os.getenv("METRIC_SCHEMA"))
@@ -14,6 +14,8 @@ from tesla_powerwall import Powerwall, MeterType
 from tesla_powerwall.error import PowerwallUnreachableError
 import hvac
 
+from gateway_cache import CachingPowerwall
+
 VAULT_TOKEN_FILE = Path("~/.vault-token").expanduser()
 VAULT_SECRETS_PATH = os.getenev("VAULT_SECRETS_PATH")
 POWERWALL_HOST = os.getenv("BACKUP_GW_ADDR")
@@ -65,7 +67,7 @@ def main():
 
     creds = get_login_credentials()
 
-    power_wall = Powerwall(POWERWALL_HOST)
+    power_wall = CachingPowerwall(Powerwall(POWERWALL_HOST))
     try:
         power_wall.detect_and_pin_version()
     except PowerwallUnreachableError as e:
@@ -118,6 +120,7 @@ def main():
         # print(f"  Is drawing from: {meter.is_drawing_from()}")
         # print(f"  Is sending to: {meter.is_sending_to()}")
 
+    print(f"Cache stats: {pp.pformat(power_wall.cache_stats())}")
     return
 
 
@@ -22,11 +22,14 @@ import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 
 import hvac
-from tesla_api import TeslaApiClient
+
+# Project modules
+#
+from token_store import TokenStore, tesla_api_login
 
 COLORS = ["red", "blue", "green", "yellow", "orange", "cyan", "magenta"]
-TESLA_API_TOKEN_FILE = Path("~/.tesla-api-token").expanduser()
 VAULT_TOKEN_FILE = Path("~/.vault-token").expanduser()
+TOKEN_STORE = TokenStore()
 VAULT_SECRETS_PATH = os.getenv("VAULT_SECRETS_PATH")
 
 CHARTS = [
@@ -76,30 +79,15 @@ def get_login_credentials(hvac_client):
     return login_credentials["data"]
 
 
-#############################################################################
-#
-async def save_token(token):
-    """
-    Save the oauth token for re-use instead of logging in again.  We
-    store it in the vault cubbyhole secrets engine.
-    """
-    os.umask(0)
-    with open(
-        os.open(TESLA_API_TOKEN_FILE, os.O_CREAT | os.O_WRONLY, 0o600), "w"
-    ) as fh:
-        fh.write(token)
-
-
 ####################################################################
 #
-def read_token():
+async def login():
     """
-    Reads the token from the token file. Returns None if file does not
-    exist.
+    Log in to the tesla API with the credentials from vault. Called by
+    the token store when we need a new token.
     """
-    if not TESLA_API_TOKEN_FILE.exists():
-        return None
-    return open(TESLA_API_TOKEN_FILE, "r").read()
+    creds = get_login_credentials(get_hvac_client())
+    return await tesla_api_login(creds["username"], creds["password"])
 
 
 ####################################################################
@@ -151,17 +139,7 @@ def matplotlib_ts(ts):
 #
 async def main():
     pp = pprint.PrettyPrinter(indent=2)
-    email = password = None
-    token = read_token()
-    if token is None:
-        hvac_client = get_hvac_client()
-        creds = get_login_credentials(hvac_client)
-        email = creds["username"]
-        password = creds["password"]
-
-    async with TeslaApiClient(
-        email, password, token, on_new_token=save_token
-    ) as client:
+    async with TOKEN_STORE.client(login) as client:
         energy_sites = await client.list_energy_sites()
         print(f"Number of energy sites = {len(energy_sites)}")
 
@@ -7,66 +7,223 @@ Connect to the Tesla Backup Gateway 2.
 Collect some statistics.
 Send them to influxdb.
 
+Samples are written to a local write-ahead spool first and drained in to
+influxdb in batches by a background thread, so influxdb restarts and
+network blips do not lose any samples.
+
+Reads from the gateway go through a circuit breaker. While the gateway
+is unreachable we only send it a cheap status probe, backing off
+exponentially between probes, and the breaker's state is written to
+influxdb with each interval's metrics.
+
+`kill -USR1` starts and stops profiling and `kill -USR2` writes a
+report with the time spent fetching, spooling ("ship"), and writing to
+influxdb ("drain"), see profiler.py.
+
 Usage:
-  powerwall_to_influxdb.py [--debug]
+  powerwall_to_influxdb.py [--debug] [--interval=<secs>] [--spool=<dir>]
 
 Options:
   --version
   -h, --help        Show this text and exit
   --debug           Output debugging around http, redirects, and responses
+  --interval=<secs> Seconds between samples [default: 10]
+  --spool=<dir>     Directory for the write-ahead spool
+                    [default: ~/.powerwall-spool]
 """
 
 # system imports
 #
 import os
+import time
+from pathlib import Path
 
 # 3rd party imports
 #
-from tesla_powerwall import Powerwall, MeterType
-from tesla_powerwall.error import PowerwallUnreachableError
-import hvac
+from docopt import docopt
+from tesla_powerwall import Powerwall
+from tesla_powerwall.error import (
+    APIError,
+    AccessDeniedError,
+    PowerwallUnreachableError,
+)
 
-from .utils import get_hvac_client, INFLUXDB_CREDS_PATH
+# Project modules
+#
+from utils import get_hvac_client, INFLUXDB_CREDS_PATH
+from exporters import line_protocol
+from spool import Spool, SpoolDrainer, influx_writer
+from gateway_cache import CachingPowerwall
+from metric_schema import SCHEMA
+from circuit_breaker import OPEN, CircuitBreaker, CircuitOpenError
+from profiler import Profiler
 
 BG_GATEWAY_SECRETS_PATH = os.getenv("VAULT_SECRETS_PATH")
 BG_GATEWAY_HOST = os.getenv("BACKUP_GW_ADDR")
+PROBE_TIMEOUT = 2  # seconds
 
-# Which keys in a meter do we care about..
+# What the gateway raises when it is down, restarting (a 502 or 503 is
+# an `APIError`), or will not let us log in again. They all count as
+# failures for the circuit breaker and we back off instead of exiting.
 #
-METER_KEYS = (
-    "energy_exported",
-    "energy_imported",
-    "instant_apparent_power",
-    "instant_average_voltage",
-    "instant_power",
-    "instant_reactive_power",
-    "instant_total_current",
-)
+GATEWAY_ERRORS = (PowerwallUnreachableError, APIError, AccessDeniedError)
+
+
+####################################################################
+#
+def meter_fields(section, fields):
+    """
+    Return the dict of field to value for the `fields`, (column, field)
+    pairs, the gateway sent in a meter's `section`, leaving out the ones
+    it did not send. The gateway sends whole numbers as ints so every
+    value is made a float, otherwise influxdb would see the same field
+    as an integer in one line and a float in the next and reject one.
+    """
+    values = {}
+    for _, field in fields:
+        value = section.get(field)
+        if value is not None:
+            values[field] = float(value)
+    return values
+
+
+####################################################################
+#
+def sample_lines(powerwall, schema=SCHEMA):
+    """
+    Read the meters, battery charge and grid status in the metric schema
+    from the backup gateway and return them as a list of line protocol
+    lines. Each meter only gets the fields the schema lists for it and
+    endpoints nothing in the schema comes from are not requested.
+
+    `powerwall` should be a `CachingPowerwall` so the site info used
+    for tags does not cost a request every time.
+    """
+    now = time.time_ns()
+    tags = {"site": powerwall.get_site_info().site_name}
+    lines = []
+    if "battery_pct" in schema:
+        lines.append(
+            line_protocol(
+                "battery",
+                tags,
+                {"percentage": float(powerwall.get_charge())},
+                now,
+            )
+        )
+    if "grid_status" in schema:
+        lines.append(
+            line_protocol(
+                "grid",
+                tags,
+                {"status": powerwall.get_grid_status().value},
+                now,
+            )
+        )
+    if schema.meters:
+        aggregates = powerwall.get_meters().response
+        for meter in schema.meters:
+            section = aggregates.get(meter, {})
+            fields = meter_fields(section, schema.meter_fields(meter))
+            # A line with no fields is rejected by influxdb.
+            #
+            if fields:
+                lines.append(
+                    line_protocol(
+                        "meter", dict(tags, meter=meter), fields, now
+                    )
+                )
+    return lines
+
+
+####################################################################
+#
+def read_gateway(powerwall, creds):
+    """
+    Return `sample_lines()` for the gateway, logging in first if we are
+    not logged in or the gateway has forgotten our login, as it does
+    when it restarts.
+    """
+    if powerwall.get_pinned_version() is None:
+        powerwall.detect_and_pin_version()
+    if not powerwall.is_authenticated():
+        powerwall.login(creds["password"], email=creds["email"])
+    try:
+        return sample_lines(powerwall)
+    except AccessDeniedError:
+        powerwall.login(creds["password"], email=creds["email"])
+        return sample_lines(powerwall)
+
+
 #############################################################################
 #
 def main():
     """
     Get credentials from vault. Poke backup gateway. Push stats to influxdb
     """
+    args = docopt(__doc__, version="0.1")
+    interval = float(args["--interval"])
+
     vault = get_hvac_client()
-    bg_creds = vault.secrets.kv.v1.read_secret(BG_GATEWAY_SECRETS_PATH)
-    influxdb_creds = vault.secrets.kv.v1.read_secret(INFLUXDB_CREDS_PATH)
+    bg_creds = vault.secrets.kv.v1.read_secret(BG_GATEWAY_SECRETS_PATH)["data"]
+    influxdb_creds = vault.secrets.kv.v1.read_secret(INFLUXDB_CREDS_PATH)[
+        "data"
+    ]
+
+    # The drainer times its writes to influxdb with the profiler from
+    # its own thread.
+    #
+    profiler = Profiler("powerwall_to_influxdb").install()
+    spool = Spool(Path(args["--spool"]).expanduser())
+    drainer = SpoolDrainer(
+        spool,
+        influx_writer(
+            influxdb_creds["url"],
+            influxdb_creds["token"],
+            influxdb_creds["org"],
+            influxdb_creds["bucket"],
+        ),
+        timings=profiler,
+    )
+    drainer.start()
 
-    powerwall = Powerwall(BG_GATEWAY_HOST)
+    powerwall = CachingPowerwall(Powerwall(BG_GATEWAY_HOST))
+    probe = Powerwall(BG_GATEWAY_HOST, timeout=PROBE_TIMEOUT)
+    breaker = CircuitBreaker(
+        "gateway",
+        errors=GATEWAY_ERRORS,
+        probe=probe.get_version,
+    )
     try:
-        powerwall.detect_and_pin_version()
-    except PowerwallUnreachableError as e:
-        print(e)
-        return
-
-    _ = powerwall.login(bg_creds["email"], bg_creds["password"])
-    battery_pct_charge = powerwall.get_charge()
-    site_info = powerwall.get_site_info()
-    meters = power_wall.get_meters()
-    meter_data = meters.response
-    for (meter, data) in meters.items():
-        pass
-    return
+        while True:
+            lines = []
+            with profiler.phase("fetch"):
+                try:
+                    lines = breaker.call(read_gateway, powerwall, bg_creds)
+                except CircuitOpenError:
+                    pass
+                except GATEWAY_ERRORS as e:
+                    print(e)
+            with profiler.phase("ship"):
+                spool.append(
+                    *lines,
+                    drainer.metrics_line(),
+                    line_protocol(
+                        "gateway", {}, breaker.metrics(), time.time_ns()
+                    ),
+                )
+            if args["--debug"]:
+                print(drainer.metrics(), breaker.metrics())
+            # While the breaker is open wake up for its next probe so we
+            # notice the gateway is back as soon as we can.
+            #
+            if breaker.state == OPEN:
+                time.sleep(min(interval, max(breaker.retry_in(), 0.1)))
+            else:
+                time.sleep(interval)
+    finally:
+        drainer.stop()
+        spool.close()
 
 
 ############################################################################
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+On demand profiling for the long running collectors.
+
+A collector makes a `Profiler`, calls `install()` once, and times each
+phase of its loop (fetch, store, render, ship) with `phase()`. Phases
+can be timed from any thread, like the `sinks.FanOut` sink threads that
+store and ship each sample. Then, while it is running:
+
+  kill -USR1 <pid>   starts profiling. Sending it again stops profiling
+                     and writes a report
+  kill -USR2 <pid>   writes a report now without changing anything
+
+While profiling is on every call is recorded by `cProfile` and every
+allocation by `tracemalloc`. `cProfile` only sees the thread it was
+started in, so each other thread gets a profile of its own, enabled
+while it is in a phase, and they are all added together in the report. The report has the time spent in each
+phase, the functions that took the most time since profiling started,
+and the lines whose allocations grew the most since profiling started.
+Stopping also writes the raw `cProfile` stats next to the report for
+`pstats` or snakeviz.
+
+Reports go in PROFILE_DIR, ~/.powerwall-profiles if it is not set.
+Profiling is off until asked for so it costs nothing the rest of the
+time, apart from the phase timings which are a couple of
+`time.perf_counter()` calls each.
+"""
+
+# system imports
+#
+import io
+import os
+import time
+import pstats
+import signal
+import cProfile
+import threading
+import tracemalloc
+from pathlib import Path
+from contextlib import contextmanager
+from datetime import datetime
+
+PROFILE_DIR = Path(
+    os.getenv("PROFILE_DIR", "~/.powerwall-profiles")
+).expanduser()
+TRACE_FRAMES = 10  # stack frames kept for each allocation
+REPORT_LINES = 30  # functions and allocation sites in a report
+
+
+##################################################################
+##################################################################
+#
+class PhaseTimings:
+    """
+    Seconds spent in each phase of a loop: the total, how many times,
+    and the longest single time.
+    """
+
+    ####################################################################
+    #
+    def __init__(self):
+        self.totals = {}
+        self.counts = {}
+        self.longest = {}
+        self.lock = threading.Lock()  # phases are timed in many threads
+
+    ####################################################################
+    #
+    def add(self, phase, secs):
+        with self.lock:
+            self.totals[phase] = self.totals.get(phase, 0.0) + secs
+            self.counts[phase] = self.counts.get(phase, 0) + 1
+            if secs > self.longest.get(phase, 0.0):
+                self.longest[phase] = secs
+
+    ####################################################################
+    #
+    @contextmanager
+    def phase(self, phase):
+        """
+        Time the body of a `with` block as `phase`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start)
+
+    ####################################################################
+    #
+    def items(self):
+        """
+        (phase, total seconds) for each phase, in the order first seen.
+        """
+        with self.lock:
+            return list(self.totals.items())
+
+    ####################################################################
+    #
+    def report(self):
+        """
+        Return the timings as lines of text.
+        """
+        lines = [
+            f"{'phase':>10} {'count':>8} {'total s':>10} "
+            f"{'mean ms':>10} {'max ms':>10}"
+        ]
+        with self.lock:
+            totals = list(self.totals.items())
+        for phase, total in totals:
+            count = self.counts[phase]
+            lines.append(
+                f"{phase:>10} {count:8d} {total:10.3f} "
+                f"{1000 * total / count:10.3f} "
+                f"{1000 * self.longest[phase]:10.3f}"
+            )
+        return lines
+
+
+##################################################################
+##################################################################
+#
+class Profiler:
+    """
+    Turns `cProfile` and `tracemalloc` on and off in a running process
+    and writes reports, see the module doc.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, name, timings=None, output_dir=PROFILE_DIR):
+        """
+        Keyword Arguments:
+        name       -- the collector's name, reports are named after it
+        timings    -- `PhaseTimings` to report. A new one if None
+        output_dir -- directory reports are written in
+        """
+        self.name = name
+        self.timings = PhaseTimings() if timings is None else timings
+        self.output_dir = Path(output_dir)
+        self.profile = None
+        self.baseline = None
+        self.started = None
+        self.tracing = False  # tracemalloc was started by us
+        self.thread = threading.current_thread()
+        self.thread_profiles = {}  # thread: (lock, cProfile.Profile)
+        self.thread_lock = threading.Lock()
+
+    ####################################################################
+    #
+    @property
+    def running(self):
+        return self.profile is not None
+
+    ####################################################################
+    #
+    def phase(self, phase):
+        """
+        Time the body of a `with` block as `phase`. In any thread but
+        the one we were made in its calls are also recorded in that
+        thread's own profile while profiling is on.
+        """
+        if threading.current_thread() is self.thread:
+            return self.timings.phase(phase)
+        return self.thread_phase(phase)
+
+    ####################################################################
+    #
+    @contextmanager
+    def thread_phase(self, phase):
+        lock = profile = None
+        if self.running:
+            lock, profile = self.thread_profile()
+            lock.acquire()
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12 and later profile every thread with the
+                # one profiler and refuse to start another.
+                #
+                lock.release()
+                lock = profile = None
+        try:
+            with self.timings.phase(phase):
+                yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                lock.release()
+
+    ####################################################################
+    #
+    def thread_profile(self):
+        """
+        Return the (lock, `cProfile.Profile`) for the current thread,
+        making them if need be.
+        """
+        thread = threading.current_thread()
+        with self.thread_lock:
+            if thread not in self.thread_profiles:
+                self.thread_profiles[thread] = (
+                    threading.Lock(),
+                    cProfile.Profile(),
+                )
+            return self.thread_profiles[thread]
+
+    ####################################################################
+    #
+    def stats(self, stream=None):
+        """
+        Return the `pstats.Stats` of our profile and every thread's.
+        Collecting them turns our profile off.
+        """
+        stats = pstats.Stats(self.profile, stream=stream)
+        with self.thread_lock:
+            thread_profiles = list(self.thread_profiles.values())
+        for lock, profile in thread_profiles:
+            with lock:
+                if profile.getstats():
+                    stats.add(profile)
+        return stats
+
+    ####################################################################
+    #
+    def install(self, toggle=signal.SIGUSR1, dump=signal.SIGUSR2):
+        """
+        Toggle profiling on `toggle` and write a report on `dump`. Must
+        be called from the main thread. Returns self.
+        """
+        signal.signal(toggle, lambda signum, frame: self.toggle())
+        signal.signal(dump, lambda signum, frame: self.dump())
+        return self
+
+    ####################################################################
+    #
+    def start(self):
+        """
+        Start recording calls and allocations.
+        """
+        if self.running:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+            self.tracing = True
+        self.baseline = tracemalloc.take_snapshot()
+        self.started = time.time()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        print(f"{self.name}: profiling started")
+
+    ####################################################################
+    #
+    def stop(self):
+        """
+        Stop recording, write the report and the raw stats. Returns the
+        path of the report, or None if we were not profiling.
+        """
+        if not self.running:
+            return None
+        path = self.dump()
+        self.stats().dump_stats(path.with_suffix(".prof"))
+        self.profile = None
+        with self.thread_lock:
+            self.thread_profiles = {}
+        self.baseline = None
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+        print(f"{self.name}: profiling stopped")
+        return path
+
+    ####################################################################
+    #
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    ####################################################################
+    #
+    def dump(self):
+        """
+        Write a report of where we are now and return its path.
+        """
+        now = datetime.now()
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        path = self.output_dir / f"{self.name}-{now:%Y%m%d-%H%M%S}.txt"
+        lines = [f"{self.name} pid {os.getpid()} at {now.isoformat()}", ""]
+        lines += self.timings.report()
+
+        if self.running:
+            elapsed = time.time() - self.started
+            out = io.StringIO()
+            stats = self.stats(out)
+            self.profile.enable()
+            stats.sort_stats(pstats.SortKey.CUMULATIVE)
+            stats.print_stats(REPORT_LINES)
+            lines += ["", f"calls over the last {elapsed:.1f}s", ""]
+            lines.append(out.getvalue())
+
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            lines += [
+                "",
+                f"traced memory {current / 1024:.1f}KiB, "
+                f"peak {peak / 1024:.1f}KiB",
+            ]
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                (tracemalloc.Filter(False, tracemalloc.__file__),)
+            )
+            if self.baseline is not None:
+                lines.append("largest growth since profiling started:")
+                top = snapshot.compare_to(self.baseline, "lineno")
+            else:
+                lines.append("largest allocations:")
+                top = snapshot.statistics("lineno")
+            lines += [f"  {stat}" for stat in top[:REPORT_LINES]]
+
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        print(f"{self.name}: wrote profile report {path}")
+        return path
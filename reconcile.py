@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+Merge the local gateway history and the cloud power history for the
+same site in to one series on a common time grid.
+
+The two sources have different timestamps and different gaps: the
+local samples are about a minute apart and missing while the collector
+was not running or could not reach the gateway, the cloud series is
+every five minutes and lags real time. For each point on the grid we
+take the latest reading at or before it from each source, an as-of
+join, as long as it is recent enough to still count, and then pick a
+source:
+
+- a live local reading, if there is one
+- otherwise the cloud reading
+- otherwise a local reading backfilled from the cloud by gapfill.py,
+  which is an interpolation of the cloud series we did not have
+- otherwise nothing, and the point is a gap marker
+
+The battery charge and grid status only come from the gateway so they
+are always from the local reading, or NaN and unknown.
+
+The join is done with numpy a day at a time, carrying each source's
+last reading over to the next day, so any range can be merged with only
+a day of each source in memory.
+
+Usage:
+  reconcile.py [options] <start> [<end>]
+
+Arguments:
+  <start>           First day to merge, YYYY-MM-DD
+  <end>             Last day to merge, YYYY-MM-DD. Defaults to <start>
+
+Options:
+  --version
+  -h, --help        Show this text and exit
+  --step=<secs>     Seconds between points on the grid [default: 60]
+  --csv=<path>      Write the merged series as CSV to <path>
+"""
+
+# system imports
+#
+import time
+from datetime import date, datetime, timedelta
+
+# 3rd party modules
+#
+import numpy as np
+from docopt import docopt
+
+# Project modules
+#
+from samples import (
+    FLAG_BACKFILLED,
+    FLAG_CLOUD,
+    FLAG_GAP,
+    GRID_UNKNOWN,
+    METERS,
+    Sample,
+)
+from history import (
+    HISTORY_FILE_DIR,
+    TIMEZONE,
+    load_calendar_day,
+    load_day,
+)
+from exporters import CSVExporter, export_rows
+
+STEP = 60  # seconds between grid points
+
+# How old a reading can be and still stand for a grid point. A little
+# over each source's own cadence so one late reading does not make a
+# hole.
+#
+LOCAL_TOLERANCE = 150  # seconds
+CLOUD_TOLERANCE = 330  # seconds
+
+# Where each grid point's meters came from
+#
+SOURCE_NONE = 0
+SOURCE_LOCAL = 1
+SOURCE_CLOUD = 2
+SOURCE_BACKFILLED = 3
+
+LOCAL_COLUMNS = (*METERS, "battery_pct", "grid_status", "flags")
+
+
+####################################################################
+#
+def to_arrays(samples, columns):
+    """
+    Return a dict of column name to numpy array for `samples`, plus
+    "timestamp", in timestamp order.
+    """
+    samples = sorted(samples, key=lambda s: s.timestamp)
+    arrays = {
+        "timestamp": np.fromiter(
+            (s.timestamp for s in samples), float, len(samples)
+        )
+    }
+    for column in columns:
+        arrays[column] = np.fromiter(
+            (getattr(s, column) for s in samples), float, len(samples)
+        )
+    return arrays
+
+
+####################################################################
+#
+def concat(a, b):
+    """
+    Join two dicts of column arrays made by `to_arrays()`.
+    """
+    return {name: np.concatenate((a[name], b[name])) for name in a}
+
+
+####################################################################
+#
+def tail(arrays):
+    """
+    Return just the last row of a dict of column arrays.
+    """
+    return {name: values[-1:] for name, values in arrays.items()}
+
+
+####################################################################
+#
+def asof(timestamps, grid, tolerance):
+    """
+    Return, for each time in `grid`, the index of the latest of the
+    sorted `timestamps` at or before it, or -1 if there is none or it
+    is more than `tolerance` seconds before.
+    """
+    idx = np.searchsorted(timestamps, grid, side="right") - 1
+    found = idx >= 0
+    found[found] = grid[found] - timestamps[idx[found]] <= tolerance
+    return np.where(found, idx, -1)
+
+
+####################################################################
+#
+def merge_arrays(grid, local, cloud):
+    """
+    Merge the local and cloud readings on to `grid`. Returns a dict of
+    column arrays for the grid points, including "source", one of the
+    SOURCE_ values.
+
+    Keyword Arguments:
+    grid  -- numpy array of times, seconds since the epoch
+    local -- dict of `LOCAL_COLUMNS` arrays from `to_arrays()` for the
+             local samples
+    cloud -- dict of meter arrays from `to_arrays()` for the cloud
+             series
+    """
+    n = len(grid)
+    li = asof(local["timestamp"], grid, LOCAL_TOLERANCE)
+    ci = asof(cloud["timestamp"], grid, CLOUD_TOLERANCE)
+    has_local = li >= 0
+    has_cloud = ci >= 0
+
+    # A local reading only counts if it has all the meters. A gap
+    # marker is all NaN so it stops an older reading from standing in
+    # for the time after it.
+    #
+    local_flags = np.zeros(n, dtype=np.uint8)
+    local_flags[has_local] = local["flags"][li[has_local]].astype(np.uint8)
+    for meter in METERS:
+        values = np.full(n, np.nan)
+        values[has_local] = local[meter][li[has_local]]
+        has_local &= ~np.isnan(values)
+    backfilled = has_local & ((local_flags & FLAG_BACKFILLED) != 0)
+    live = has_local & ~backfilled
+
+    source = np.full(n, SOURCE_NONE, dtype=np.uint8)
+    source[backfilled] = SOURCE_BACKFILLED
+    source[has_cloud & ~live] = SOURCE_CLOUD
+    source[live] = SOURCE_LOCAL
+    from_local = (source == SOURCE_LOCAL) | (source == SOURCE_BACKFILLED)
+    from_cloud = source == SOURCE_CLOUD
+
+    merged = {"timestamp": grid, "source": source}
+    for meter in METERS:
+        values = np.full(n, np.nan)
+        values[from_local] = local[meter][li[from_local]]
+        values[from_cloud] = cloud[meter][ci[from_cloud]]
+        merged[meter] = values
+
+    # The gateway only columns come from any local reading that is
+    # recent enough, whichever source the meters came from.
+    #
+    any_local = li >= 0
+    merged["battery_pct"] = np.full(n, np.nan)
+    merged["battery_pct"][any_local] = local["battery_pct"][li[any_local]]
+    merged["grid_status"] = np.full(n, GRID_UNKNOWN, dtype=np.uint8)
+    merged["grid_status"][any_local] = local["grid_status"][li[any_local]]
+
+    flags = np.full(n, FLAG_GAP, dtype=np.uint8)
+    flags[from_local] = local_flags[from_local]
+    flags[from_cloud] = FLAG_CLOUD
+    merged["flags"] = flags
+    return merged
+
+
+####################################################################
+#
+def day_grid(day, step=STEP):
+    """
+    Return the grid points in `day`, multiples of `step` seconds since
+    the epoch.
+    """
+    start, end = (
+        TIMEZONE.localize(datetime(d.year, d.month, d.day)).timestamp()
+        for d in (day, day + timedelta(days=1))
+    )
+    first = -(-start // step) * step
+    return np.arange(first, end, step, dtype=float)
+
+
+####################################################################
+#
+def merged_days(start, end, step=STEP, history_dir=HISTORY_FILE_DIR):
+    """
+    Yield (day, merged) for each day from `start` to `end`, both
+    `datetime.date`s, where `merged` is the dict of column arrays from
+    `merge_arrays()` for that day. Only a day of each source is loaded
+    at a time.
+    """
+    local_carry = to_arrays((), LOCAL_COLUMNS)
+    cloud_carry = to_arrays((), METERS)
+    day = start
+    while day <= end:
+        local = concat(
+            local_carry,
+            to_arrays(load_day(day, history_dir) or (), LOCAL_COLUMNS),
+        )
+        rows = load_calendar_day(day, history_dir) or ()
+        cloud = concat(
+            cloud_carry,
+            to_arrays((Sample.from_calendar_row(r) for r in rows), METERS),
+        )
+        yield day, merge_arrays(day_grid(day, step), local, cloud)
+
+        # Only the last reading of each source can stand in for a time
+        # in the next day.
+        #
+        if len(local["timestamp"]):
+            local_carry = tail(local)
+        if len(cloud["timestamp"]):
+            cloud_carry = tail(cloud)
+        day += timedelta(days=1)
+
+
+####################################################################
+#
+def reconcile(start, end, step=STEP, history_dir=HISTORY_FILE_DIR):
+    """
+    Yield the merged series from `start` to `end`, both
+    `datetime.date`s, as `samples.Sample`s. The samples from the cloud
+    are flagged `FLAG_CLOUD` and grid points neither source has are gap
+    markers.
+    """
+    for _, merged in merged_days(start, end, step, history_dir):
+        rows = zip(
+            merged["timestamp"].tolist(),
+            *(merged[meter].tolist() for meter in METERS),
+            merged["battery_pct"].tolist(),
+            merged["grid_status"].tolist(),
+            merged["flags"].tolist(),
+        )
+        for row in rows:
+            yield Sample(*row)
+
+
+#############################################################################
+#
+def main():
+    """
+    Merge the local and cloud history for the days asked for and print
+    how much of each day came from each source.
+    """
+    args = docopt(__doc__, version="0.1")
+    start = date.fromisoformat(args["<start>"])
+    end = date.fromisoformat(args["<end>"]) if args["<end>"] else start
+    step = float(args["--step"])
+
+    started = time.perf_counter()
+    points = 0
+    print(
+        f"{'day':>10} {'local':>6} {'cloud':>6} {'backfilled':>10} {'none':>6}"
+    )
+    for day, merged in merged_days(start, end, step):
+        counts = np.bincount(merged["source"], minlength=4)
+        points += len(merged["source"])
+        print(
+            f"{day.isoformat():>10} {counts[SOURCE_LOCAL]:6d} "
+            f"{counts[SOURCE_CLOUD]:6d} {counts[SOURCE_BACKFILLED]:10d} "
+            f"{counts[SOURCE_NONE]:6d}"
+        )
+    print(f"{points} points in {time.perf_counter() - started:.3f}s")
+
+    if args["--csv"]:
+        columns = [*METERS, "battery_pct", "grid_status", "flags"]
+        count = export_rows(
+            reconcile(start, end, step), [CSVExporter(args["--csv"], columns)]
+        )
+        print(f"Wrote {count} rows to {args['--csv']}")
+
+
+############################################################################
+############################################################################
+#
+# Here is where it all starts
+#
+if __name__ == "__main__":
+    main()
+#
+############################################################################
+############################################################################
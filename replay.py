@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+Replay recorded history through the same sinks, built by the same
+`as_power_plot.new_fanout()`, that as_power_plot.py publishes live
+samples from the backup gateway to.
+
+Samples come from the daily gateway history files or from the cached
+cloud calendar history (see backfill.py). They are fed at `--speed`
+times real time, or as fast as possible with a speed of 0, so we can
+profile and check changes to the pipeline without waiting on a gateway.
+Time spent publishing, plotting, and in each sink, per-sample latency,
+and each sink's metrics are reported at the end.
+
+Usage:
+  replay.py [options] <start> [<end>]
+
+Arguments:
+  <start>           First day to replay, YYYY-MM-DD
+  <end>             Last day to replay, YYYY-MM-DD. Defaults to <start>
+
+Options:
+  --version
+  -h, --help        Show this text and exit
+  -s, --speed=<x>   Multiple of real time to replay at. 0 means as fast
+                    as possible [default: 0]
+  --calendar        Replay the cached cloud calendar history instead of
+                    the gateway history files
+  -o, --output=<dir>  Directory the replayed history files are written
+                    to, so we never clobber the real ones
+                    [default: replay-output]
+  --alerts          Also run the samples through the alert rules
+  --no-draw         Do not rasterize the plot after each sample
+  --png=<file>      Save the final plot to this file
+"""
+
+# system imports
+#
+import time
+from pathlib import Path
+from datetime import date, timedelta
+
+# 3rd party modules
+#
+from docopt import docopt
+import matplotlib
+
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt  # noqa: E402
+
+# Project modules
+#
+from alerts import default_engine  # noqa: E402
+from samples import Sample  # noqa: E402
+from profiler import PhaseTimings  # noqa: E402
+from history import (  # noqa: E402
+    TIMEZONE,
+    HistoryWriter,
+    load_day,
+    load_calendar_day,
+)
+from as_power_plot import (  # noqa: E402
+    BACKUP_RESERVE_PCT,
+    SITE_NAME,
+    new_fanout,
+    new_series,
+    render_plot,
+)
+
+
+####################################################################
+#
+def gateway_samples(days):
+    """
+    Generate the samples saved in the gateway history for `days`.
+    """
+    for day in days:
+        samples = load_day(day)
+        if samples:
+            yield from samples
+
+
+####################################################################
+#
+def calendar_samples(days):
+    """
+    Generate samples from the cached cloud calendar history for `days`.
+    """
+    for day in days:
+        time_series = load_calendar_day(day)
+        if time_series is None:
+            continue
+        for row in time_series:
+            yield Sample.from_calendar_row(row)
+
+
+####################################################################
+#
+def paced(samples, speed):
+    """
+    Yield `samples` spaced out by their recorded timestamps divided by
+    `speed`. A speed of 0 yields them as fast as they are consumed.
+    """
+    start_wall = start_ts = None
+    for sample in samples:
+        if speed > 0:
+            ts = sample.timestamp
+            if start_wall is None:
+                start_wall, start_ts = time.monotonic(), ts
+            delay = start_wall + (ts - start_ts) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        yield sample
+
+
+####################################################################
+#
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+#############################################################################
+#
+def main():
+    """
+    Set up a figure and sinks like as_power_plot.py does and publish
+    every recorded sample to them.
+    """
+    args = docopt(__doc__, version="0.1")
+    start = date.fromisoformat(args["<start>"])
+    end = date.fromisoformat(args["<end>"]) if args["<end>"] else start
+    days = [start + timedelta(days=n) for n in range((end - start).days + 1)]
+    speed = float(args["--speed"])
+    output_dir = Path(args["--output"])
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    source = calendar_samples if args["--calendar"] else gateway_samples
+    alert_engine = None
+    if args["--alerts"]:
+        alert_engine = default_engine(SITE_NAME, BACKUP_RESERVE_PCT, TIMEZONE)
+
+    fig = plt.figure()
+    ax = fig.add_subplot(1, 1, 1)
+    ax2 = ax.twinx()
+    series = new_series()
+    timings = PhaseTimings()
+    fanout = new_fanout(
+        series, HistoryWriter(output_dir), alert_engine, timings
+    )
+    latencies = []
+    started = time.perf_counter()
+    for sample in paced(source(days), speed):
+        t0 = time.perf_counter()
+        with timings.phase("publish"):
+            fanout.publish(sample)
+        with timings.phase("render"):
+            if fanout.poll("plot"):
+                render_plot(ax, ax2, series)
+        if not args["--no-draw"]:
+            with timings.phase("draw"):
+                fig.canvas.draw()
+        latencies.append(time.perf_counter() - t0)
+    fanout.close()
+    elapsed = time.perf_counter() - started
+
+    if args["--png"] and series:
+        fig.savefig(args["--png"])
+
+    n = len(latencies)
+    print(f"{n} samples in {elapsed:.2f}s, {n / max(elapsed, 1e-9):.1f}/s")
+    for stage, secs in timings.items():
+        print(
+            f"  {stage:>8}: {secs:8.3f}s total "
+            f"{1000 * secs / max(n, 1):8.3f}ms/sample"
+        )
+    for p in (50, 90, 99):
+        print(f"  p{p} latency: {1000 * percentile(latencies, p):.3f}ms")
+    for name, metrics in fanout.metrics().items():
+        print(
+            f"  sink {name}: {metrics['written']} written "
+            f"{metrics['dropped']} dropped {metrics['errors']} errors, "
+            f"max lag {1000 * metrics['max_lag']:.3f}ms"
+        )
+
+
+############################################################################
+############################################################################
+#
+# Here is where it all starts
+#
+if __name__ == "__main__":
+    main()
+#
+############################################################################
+############################################################################
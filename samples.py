@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+The `Sample` record: one reading of the site at a point in time.
+
+This is what the collector produces, what the history store saves, and
+what the exporters, alert rules and plots consume. It is a fixed set of
+slots rather than a dict so a day of samples is small in memory, and it
+packs to a fixed size binary record for storage.
+
+`Sample` has the readings every script uses. `record_type()` makes
+sub-classes with more columns, as the metric schema asks for (see
+metric_schema.py).
+"""
+
+# system imports
+#
+import math
+import struct
+from datetime import datetime
+from operator import attrgetter
+
+METERS = ("site", "battery", "load", "solar")
+
+# `GridStatus` values are stored as small integers.
+#
+GRID_UNKNOWN = 0
+GRID_CONNECTED = 1
+GRID_STATUS_CODES = {
+    "SystemGridConnected": GRID_CONNECTED,
+    "SystemIslandedReady": 2,
+    "SystemIslandedActive": 3,
+    "SystemTransitionToGrid": 4,
+}
+GRID_STATUS_NAMES = {v: k for k, v in GRID_STATUS_CODES.items()}
+
+# Where a sample came from.
+#
+FLAG_LIVE = 0  # read from the backup gateway
+FLAG_CLOUD = 1 << 0  # derived from the tesla cloud calendar history
+FLAG_GAP = 1 << 1  # no readings from here until the next sample
+FLAG_BACKFILLED = 1 << 2  # filled in after the fact, see gapfill.py
+
+NAN = float("nan")
+
+
+##################################################################
+##################################################################
+#
+class Sample:
+    """
+    One reading of the site.
+
+    Attributes:
+    - timestamp   -- seconds since the epoch
+    - site        -- instant power of each meter in watts. NaN if unknown
+    - battery
+    - load
+    - solar
+    - battery_pct -- battery charge percent. NaN if unknown
+    - grid_status -- one of the GRID_* codes
+    - flags       -- FLAG_* bits saying where the sample came from
+    """
+
+    __slots__ = (
+        "timestamp",
+        "site",
+        "battery",
+        "load",
+        "solar",
+        "battery_pct",
+        "grid_status",
+        "flags",
+    )
+
+    # Packed little endian: double timestamp, five float32 readings, and
+    # two unsigned bytes. 30 bytes a sample.
+    #
+    STRUCT = struct.Struct("<d5fBB")
+    FIELDS = __slots__
+    _values = attrgetter(*FIELDS)
+
+    ####################################################################
+    #
+    def __init__(
+        self,
+        timestamp,
+        site=NAN,
+        battery=NAN,
+        load=NAN,
+        solar=NAN,
+        battery_pct=NAN,
+        grid_status=GRID_UNKNOWN,
+        flags=FLAG_LIVE,
+    ):
+        self.timestamp = timestamp
+        self.site = site
+        self.battery = battery
+        self.load = load
+        self.solar = solar
+        self.battery_pct = battery_pct
+        self.grid_status = grid_status
+        self.flags = flags
+
+    ####################################################################
+    #
+    def __repr__(self):
+        values = ", ".join(f"{f}={getattr(self, f)!r}" for f in self.FIELDS)
+        return f"Sample({values})"
+
+    ####################################################################
+    #
+    def __eq__(self, other):
+        if not isinstance(other, Sample):
+            return NotImplemented
+        return self.astuple() == other.astuple()
+
+    ####################################################################
+    #
+    def __getitem__(self, field):
+        """
+        Mapping style access so a sample can be used anywhere a row dict
+        with the same keys can.
+        """
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field) from None
+
+    ####################################################################
+    #
+    def astuple(self):
+        return self._values(self)
+
+    ####################################################################
+    #
+    def pack(self):
+        return self.STRUCT.pack(*self._values(self))
+
+    ####################################################################
+    #
+    @classmethod
+    def pack_from(cls, sample):
+        """
+        Pack any sample in to our record layout. Columns `sample` does
+        not have are packed as NaN.
+        """
+        return cls.STRUCT.pack(*(getattr(sample, f, NAN) for f in cls.FIELDS))
+
+    ####################################################################
+    #
+    @classmethod
+    def unpack(cls, buf, offset=0):
+        return cls(*cls.STRUCT.unpack_from(buf, offset))
+
+    ####################################################################
+    #
+    @classmethod
+    def iter_unpack(cls, buf):
+        """
+        Generate the samples packed back to back in `buf`.
+        """
+        for values in cls.STRUCT.iter_unpack(buf):
+            yield cls(*values)
+
+    ####################################################################
+    #
+    def as_datetime(self, tz):
+        return datetime.fromtimestamp(self.timestamp, tz)
+
+    ####################################################################
+    #
+    @property
+    def grid_status_name(self):
+        return GRID_STATUS_NAMES.get(self.grid_status, "Unknown")
+
+    ####################################################################
+    #
+    @property
+    def grid_connected(self):
+        return self.grid_status == GRID_CONNECTED
+
+    ####################################################################
+    #
+    @property
+    def is_gap(self):
+        return bool(self.flags & FLAG_GAP)
+
+    ####################################################################
+    #
+    def has(self, field):
+        """
+        True if `field` has a value in this sample.
+        """
+        return not math.isnan(getattr(self, field))
+
+    ####################################################################
+    #
+    @classmethod
+    def gap(cls, timestamp, flags=FLAG_GAP):
+        """
+        Make a gap marker: a sample with no readings saying that we have
+        none from `timestamp` until the next sample. Plotted, its NaNs
+        break the lines instead of joining across the gap.
+        """
+        return cls(timestamp, flags=flags | FLAG_GAP)
+
+    ####################################################################
+    #
+    @classmethod
+    def from_calendar_row(cls, row):
+        """
+        Make a sample from a row of the cloud calendar history power
+        time series. The cloud series has no battery charge or grid
+        status, and the load is what the site, battery, and solar
+        together supply.
+        """
+        site = row["grid_power"]
+        battery = row["battery_power"]
+        solar = row["solar_power"]
+        return cls(
+            datetime.fromisoformat(row["timestamp"]).timestamp(),
+            site=site,
+            battery=battery,
+            load=site + battery + solar,
+            solar=solar,
+            flags=FLAG_CLOUD,
+        )
+
+
+####################################################################
+#
+_RECORD_TYPES = {}
+
+
+def record_type(columns=()):
+    """
+    Return a sub-class of `Sample` with the extra `columns` after the
+    standard ones. Calling it again with the same columns returns the
+    same class.
+
+    Keyword Arguments:
+    columns -- sequence of (name, struct format character) for the extra
+               columns. 'f' (float32) suits readings, 'd' (float64) the
+               large ever increasing energy counters.
+    """
+    columns = tuple(columns)
+    if not columns:
+        return Sample
+    if columns in _RECORD_TYPES:
+        return _RECORD_TYPES[columns]
+
+    names = tuple(name for name, _ in columns)
+    fields = Sample.FIELDS + names
+
+    def __init__(self, timestamp, *args, **kwargs):
+        core = len(Sample.FIELDS) - 1
+        super(cls, self).__init__(timestamp, *args[:core])
+        for name, value in zip(names, args[core:]):
+            setattr(self, name, value)
+        for name in names[max(0, len(args) - core) :]:
+            setattr(self, name, NAN)
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    cls = type(
+        "Sample",
+        (Sample,),
+        {
+            "__slots__": names,
+            "__init__": __init__,
+            "STRUCT": struct.Struct(
+                Sample.STRUCT.format + "".join(fmt for _, fmt in columns)
+            ),
+            "FIELDS": fields,
+            "_values": attrgetter(*fields),
+        },
+    )
+    _RECORD_TYPES[columns] = cls
+    return cls
+
+
+####################################################################
+#
+def grid_status_code(grid_status):
+    """
+    Return the code for a `GridStatus` or its value string.
+    """
+    grid_status = getattr(grid_status, "value", grid_status)
+    return GRID_STATUS_CODES.get(grid_status, GRID_UNKNOWN)
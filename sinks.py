@@ -0,0 +1,586 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+Fan each sample out to any number of sinks: the history file, the
+influxdb spool, the live plot, an MQTT broker.
+
+The collector calls `FanOut.publish()` once per sample. Every sink has
+its own bounded queue and, unless it is polled, its own thread taking
+samples off the queue and writing them, so a slow sink, say an MQTT
+broker that has gone away, never holds up sampling or the other sinks.
+When a sink's queue is full its overflow policy decides what gives:
+
+- `DROP_OLDEST` -- the oldest queued sample makes room for the new one.
+  For sinks that only care about the latest, like the plot
+- `DROP_NEWEST` -- the new sample is not queued
+- `BLOCK` -- the collector waits up to `block_timeout` seconds for room
+  and then drops the new sample. For sinks where losing a sample is
+  worse than a short delay
+
+Polled sinks are written to by whoever calls `FanOut.poll()`, for sinks
+that have to be used from one thread, like anything matplotlib draws.
+
+Per sink we keep how many samples were published, written, dropped,
+and failed, how many are queued, how long the oldest queued one has
+been waiting, and the lag from publish to written. `FanOut.metrics()`
+returns them and `FanOut.metrics_lines()` formats them for influxdb.
+Given a `profiler.Profiler` or `profiler.PhaseTimings` every write to
+a sink is also timed as a phase named after the sink, in whichever
+thread writes it.
+"""
+
+# system imports
+#
+import json
+import math
+import time
+import threading
+from collections import deque
+from datetime import datetime
+
+# 3rd party modules
+#
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
+
+# Project modules
+#
+from samples import NAN
+from exporters import line_protocol
+from metric_schema import SCHEMA
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+BLOCK = "block"
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+QUEUE_SIZE = 1000  # samples
+BLOCK_TIMEOUT = 0.1  # seconds
+CLOSE_TIMEOUT = 5.0  # seconds to wait for a sink to finish its queue
+
+
+####################################################################
+#
+def sample_to_lines(sample, tags, schema=SCHEMA):
+    """
+    Return the influxdb line protocol lines for `sample`, the same
+    measurements and fields powerwall_to_influxdb.py writes. Gap markers
+    have no lines, and NaN values and columns the sample does not have
+    are left out. Values are always floats, as in powerwall_to_influxdb.py,
+    so influxdb never sees a field change type.
+    """
+    if sample.is_gap:
+        return []
+    now = int(sample.timestamp * 1e9)
+    lines = []
+    if "battery_pct" in schema and not math.isnan(sample.battery_pct):
+        lines.append(
+            line_protocol(
+                "battery",
+                tags,
+                {"percentage": float(sample.battery_pct)},
+                now,
+            )
+        )
+    if "grid_status" in schema:
+        lines.append(
+            line_protocol(
+                "grid", tags, {"status": sample.grid_status_name}, now
+            )
+        )
+    for meter in schema.meters:
+        fields = {}
+        for name, field in schema.meter_fields(meter):
+            value = float(getattr(sample, name, NAN))
+            if not math.isnan(value):
+                fields[field] = value
+        if fields:
+            lines.append(
+                line_protocol("meter", dict(tags, meter=meter), fields, now)
+            )
+    return lines
+
+
+##################################################################
+##################################################################
+#
+class Sink:
+    """
+    Base class for sinks. Sub-classes implement `write()`, and `close()`
+    if they have anything to let go of.
+    """
+
+    name = "sink"
+
+    ####################################################################
+    #
+    def write(self, sample):
+        raise NotImplementedError
+
+    ####################################################################
+    #
+    def close(self):
+        pass
+
+
+##################################################################
+##################################################################
+#
+class HistorySink(Sink):
+    """
+    Append samples to the history with a `history.HistoryWriter`.
+    `merge()` goes through the same lock so merging in backfilled
+    samples does not race with appending new ones.
+    """
+
+    name = "history"
+
+    ####################################################################
+    #
+    def __init__(self, writer):
+        self.writer = writer
+        self.lock = threading.Lock()
+
+    ####################################################################
+    #
+    def write(self, sample):
+        with self.lock:
+            self.writer.append(sample)
+
+    ####################################################################
+    #
+    def merge(self, samples):
+        with self.lock:
+            self.writer.merge(samples)
+
+    ####################################################################
+    #
+    def close(self):
+        with self.lock:
+            self.writer.close()
+
+
+##################################################################
+##################################################################
+#
+class SpoolSink(Sink):
+    """
+    Append samples as line protocol to a `spool.Spool`, which a
+    `spool.SpoolDrainer` writes in to influxdb.
+    """
+
+    name = "influxdb"
+
+    ####################################################################
+    #
+    def __init__(self, spool, tags=None, schema=SCHEMA, metrics=None):
+        """
+        Keyword Arguments:
+        spool   -- the `spool.Spool` to append to
+        tags    -- influxdb tags for every line, like the site
+        schema  -- `metric_schema.Schema` deciding the fields written
+        metrics -- if not None, a function returning more lines, like
+                   `FanOut.metrics_lines()`, appended with each sample
+        """
+        self.spool = spool
+        self.tags = tags or {}
+        self.schema = schema
+        self.metrics = metrics
+
+    ####################################################################
+    #
+    def write(self, sample):
+        lines = sample_to_lines(sample, self.tags, self.schema)
+        if self.metrics is not None:
+            lines += self.metrics()
+        if lines:
+            self.spool.append(*lines)
+
+
+##################################################################
+##################################################################
+#
+class SeriesSink(Sink):
+    """
+    Append samples to a series, like the deque from
+    `as_power_plot.new_series()` the live plot draws. Meant to be polled
+    from the thread that draws the series.
+    """
+
+    name = "plot"
+
+    ####################################################################
+    #
+    def __init__(self, series):
+        self.series = series
+
+    ####################################################################
+    #
+    def write(self, sample):
+        self.series.append(sample)
+
+
+##################################################################
+##################################################################
+#
+class AlertSink(Sink):
+    """
+    Run samples through an `alerts.AlertEngine` and print any alerts.
+    """
+
+    name = "alerts"
+
+    ####################################################################
+    #
+    def __init__(self, engine, site, tz=None):
+        self.engine = engine
+        self.site = site
+        self.tz = tz
+
+    ####################################################################
+    #
+    def write(self, sample):
+        for alert in self.engine.process(self.site, sample):
+            state = "FIRING" if alert.firing else "resolved"
+            when = datetime.fromtimestamp(alert.timestamp, self.tz)
+            print(f"{when} {state} {alert.rule}: {alert.message}")
+
+
+##################################################################
+##################################################################
+#
+class MqttSink(Sink):
+    """
+    Publish each sample as a json object to an MQTT topic. Needs the
+    paho-mqtt module. The client reconnects on its own, and while it is
+    disconnected `publish()` only queues the message in the client, so
+    a broker being away costs us memory in the client, not time.
+    """
+
+    name = "mqtt"
+
+    ####################################################################
+    #
+    def __init__(self, host, topic, port=1883, qos=0, columns=None):
+        """
+        Keyword Arguments:
+        host    -- the MQTT broker
+        topic   -- topic every sample is published to
+        port    -- the broker's port
+        qos     -- MQTT quality of service for the messages
+        columns -- the sample columns to publish. All of them if None
+        """
+        if mqtt is None:
+            raise RuntimeError("MQTT needs the paho-mqtt module")
+        self.topic = topic
+        self.qos = qos
+        self.columns = columns
+        if hasattr(mqtt, "CallbackAPIVersion"):
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        else:
+            self.client = mqtt.Client()
+        self.client.connect_async(host, port)
+        self.client.loop_start()
+
+    ####################################################################
+    #
+    def write(self, sample):
+        columns = self.columns or sample.FIELDS
+        payload = {}
+        for column in columns:
+            value = getattr(sample, column)
+            if isinstance(value, float) and math.isnan(value):
+                value = None
+            payload[column] = value
+        self.client.publish(self.topic, json.dumps(payload), qos=self.qos)
+
+    ####################################################################
+    #
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+##################################################################
+##################################################################
+#
+class SinkQueue:
+    """
+    A sink's bounded queue, its overflow policy, and its metrics.
+    """
+
+    ####################################################################
+    #
+    def __init__(
+        self,
+        sink,
+        maxsize=QUEUE_SIZE,
+        overflow=DROP_OLDEST,
+        block_timeout=BLOCK_TIMEOUT,
+        timings=None,
+    ):
+        """
+        Keyword Arguments:
+        sink          -- the `Sink` samples are written to
+        maxsize       -- most samples that can be waiting
+        overflow      -- one of `OVERFLOW_POLICIES`
+        block_timeout -- longest `put()` waits for room with `BLOCK`
+        timings       -- if not None, a `profiler.Profiler` or
+                         `profiler.PhaseTimings` each write is timed by
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"unknown overflow policy {overflow!r}")
+        self.sink = sink
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.timings = timings
+        self.items = deque()  # (monotonic time published, sample)
+        self.cond = threading.Condition()
+        self.closed = False
+
+        self.published = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_error = None
+        self.lag = 0.0  # seconds from publish to written, last sample
+        self.max_lag = 0.0
+
+    ####################################################################
+    #
+    def put(self, sample):
+        """
+        Queue `sample`. Returns False if it was dropped.
+        """
+        with self.cond:
+            self.published += 1
+            if len(self.items) >= self.maxsize:
+                if self.overflow == DROP_OLDEST:
+                    self.items.popleft()
+                    self.dropped += 1
+                elif self.overflow == DROP_NEWEST or not self.cond.wait_for(
+                    lambda: len(self.items) < self.maxsize,
+                    self.block_timeout,
+                ):
+                    self.dropped += 1
+                    return False
+            self.items.append((time.monotonic(), sample))
+            self.cond.notify_all()
+        return True
+
+    ####################################################################
+    #
+    def get(self, timeout=None):
+        """
+        Take the oldest queued sample and when it was published. Returns
+        None if there is nothing queued after waiting `timeout` seconds,
+        or once the queue is closed and empty.
+        """
+        with self.cond:
+            if not self.cond.wait_for(
+                lambda: self.items or self.closed, timeout
+            ):
+                return None
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            self.cond.notify_all()
+            return item
+
+    ####################################################################
+    #
+    def deliver(self, item):
+        """
+        Write a queued sample to the sink and account for it.
+        """
+        published, sample = item
+        try:
+            if self.timings is None:
+                self.sink.write(sample)
+            else:
+                with self.timings.phase(self.sink.name):
+                    self.sink.write(sample)
+        except Exception as e:
+            self.errors += 1
+            self.last_error = str(e)
+            print(f"Unable to write to {self.sink.name}: {e}")
+            return
+        self.written += 1
+        self.lag = time.monotonic() - published
+        self.max_lag = max(self.max_lag, self.lag)
+
+    ####################################################################
+    #
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    ####################################################################
+    #
+    def metrics(self):
+        with self.cond:
+            depth = len(self.items)
+            oldest = time.monotonic() - self.items[0][0] if depth else 0.0
+        return {
+            "published": self.published,
+            "written": self.written,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "queued": depth,
+            "oldest": round(oldest, 3),
+            "lag": round(self.lag, 3),
+            "max_lag": round(self.max_lag, 3),
+        }
+
+
+##################################################################
+##################################################################
+#
+class SinkWorker(threading.Thread):
+    """
+    Background thread writing a `SinkQueue`'s samples to its sink until
+    the queue is closed and empty.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, queue):
+        super().__init__(name=f"sink-{queue.sink.name}", daemon=True)
+        self.queue = queue
+
+    ####################################################################
+    #
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self.queue.deliver(item)
+
+
+##################################################################
+##################################################################
+#
+class FanOut:
+    """
+    Publishes each sample to every registered sink's queue.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, timings=None):
+        """
+        Keyword Arguments:
+        timings -- if not None, a `profiler.Profiler` or
+                   `profiler.PhaseTimings` every write to a sink is timed
+                   by, as a phase named after the sink
+        """
+        self.timings = timings
+        self.queues = {}
+        self.workers = {}
+
+    ####################################################################
+    #
+    def add(
+        self,
+        sink,
+        maxsize=QUEUE_SIZE,
+        overflow=DROP_OLDEST,
+        polled=False,
+        block_timeout=BLOCK_TIMEOUT,
+    ):
+        """
+        Register a sink. Unless it is `polled` it gets a thread of its
+        own, started right away. Returns the sink.
+
+        Keyword Arguments:
+        sink          -- the `Sink`. Its `name` must be unique
+        maxsize       -- most samples that can be waiting for it
+        overflow      -- one of `OVERFLOW_POLICIES`
+        polled        -- if True samples are only written to the sink by
+                         `poll()`
+        block_timeout -- longest `publish()` waits for room with `BLOCK`
+        """
+        if sink.name in self.queues:
+            raise ValueError(f"there is already a sink named {sink.name}")
+        queue = SinkQueue(sink, maxsize, overflow, block_timeout, self.timings)
+        self.queues[sink.name] = queue
+        if not polled:
+            worker = SinkWorker(queue)
+            self.workers[sink.name] = worker
+            worker.start()
+        return sink
+
+    ####################################################################
+    #
+    def sink(self, name):
+        return self.queues[name].sink
+
+    ####################################################################
+    #
+    def publish(self, sample):
+        for queue in self.queues.values():
+            queue.put(sample)
+
+    ####################################################################
+    #
+    def poll(self, name):
+        """
+        Write everything queued for the polled sink `name` to it, in
+        this thread. Returns the number of samples written.
+        """
+        queue = self.queues[name]
+        count = 0
+        while True:
+            item = queue.get(timeout=0)
+            if item is None:
+                return count
+            queue.deliver(item)
+            count += 1
+
+    ####################################################################
+    #
+    def metrics(self):
+        """
+        Return a dict of sink name to its metrics.
+        """
+        return {name: q.metrics() for name, q in self.queues.items()}
+
+    ####################################################################
+    #
+    def metrics_lines(self, tags=None):
+        """
+        Return the metrics as line protocol lines, one per sink.
+        """
+        now = time.time_ns()
+        return [
+            line_protocol("sink", dict(tags or {}, sink=name), metrics, now)
+            for name, metrics in self.metrics().items()
+        ]
+
+    ####################################################################
+    #
+    def close(self, timeout=CLOSE_TIMEOUT):
+        """
+        Let each threaded sink finish what is queued for it, for up to
+        `timeout` seconds, then close every sink.
+        """
+        for queue in self.queues.values():
+            queue.close()
+        for name, worker in self.workers.items():
+            worker.join(timeout)
+            if worker.is_alive():
+                print(f"Sink {name} did not finish in {timeout}s")
+        for name, queue in self.queues.items():
+            if name not in self.workers:
+                self.poll(name)
+            try:
+                queue.sink.close()
+            except Exception as e:
+                print(f"Unable to close sink {name}: {e}")
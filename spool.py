@@ -0,0 +1,492 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+A disk backed write-ahead spool for influxdb line protocol.
+
+Collectors `append()` every line to the spool instead of writing it to
+influxdb directly. A `SpoolDrainer` thread reads the spool in large
+batches and writes them to influxdb. If influxdb is down the lines
+simply accumulate on disk and are drained as fast as influxdb will take
+them once it is back.
+
+The spool is a directory of segment files named by a sequence number.
+Lines are appended to the newest segment and we only fsync every
+`fsync_every` lines or `fsync_interval` seconds, whichever is first.
+When a segment reaches `segment_bytes` a new one is started. How far
+the drainer has gotten is kept in a `cursor` file (segment number and
+byte offset) and segments are deleted once fully drained.
+
+A batch influxdb rejects because of its lines, one that does not parse
+or has a field type conflict, would fail the same way every time and
+hold up everything behind it. It is moved to a segment in the
+`dead-letter` directory instead, to be looked at by hand, and draining
+carries on. Any other failure is retried, so a misconfigured influxdb
+never drains the spool in to the dead letters.
+"""
+
+# system imports
+#
+import os
+import json
+import time
+import threading
+from pathlib import Path
+
+# 3rd party imports
+#
+import influxdb_client
+from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client.rest import ApiException
+
+# Project modules
+#
+from exporters import line_protocol
+from history import write_json_atomic
+
+SEGMENT_BYTES = 4 * 1024 * 1024
+FSYNC_EVERY = 256  # lines
+DEAD_LETTER_DIR = "dead-letter"
+FSYNC_INTERVAL = 1.0  # seconds
+DRAIN_BATCH_SIZE = 5000  # lines
+DRAIN_IDLE_INTERVAL = 1.0  # seconds
+DRAIN_MAX_BACKOFF = 30.0  # seconds
+
+# What influxdb says in the body of a 400 when the lines themselves are
+# bad: they do not parse or a field has the wrong type.
+#
+BAD_LINE_ERRORS = ("unable to parse", "field type conflict")
+
+
+####################################################################
+#
+def is_permanent(error):
+    """
+    True if a failed write will never succeed however often it is
+    retried: influxdb rejected the batch with a 400 because a line does
+    not parse or has a field type conflict. Everything else, including
+    a missing bucket (404) or a batch that is too large (413), is
+    retried. Those go away once influxdb is set up right, and until
+    then the lines stay safe in the spool.
+    """
+    if not isinstance(error, ApiException) or error.status != 400:
+        return False
+    body = error.body or ""
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", "replace")
+    return any(message in body for message in BAD_LINE_ERRORS)
+
+
+####################################################################
+#
+def is_too_large(error):
+    """
+    True if influxdb turned a write down because the batch was too big.
+    """
+    return isinstance(error, ApiException) and error.status == 413
+
+
+####################################################################
+#
+def influx_writer(url, token, org, bucket):
+    """
+    Return a function that synchronously writes a list of line protocol
+    lines to the given influxdb bucket, raising an exception on
+    failure. Suitable as the `write` argument of a `SpoolDrainer`.
+    """
+    client = influxdb_client.InfluxDBClient(url=url, token=token, org=org)
+    write_api = client.write_api(write_options=SYNCHRONOUS)
+
+    def write(lines):
+        write_api.write(bucket=bucket, org=org, record=lines)
+
+    return write
+
+
+##################################################################
+##################################################################
+#
+class Spool:
+    """
+    Append only, segmented, on disk queue of line protocol lines.
+    """
+
+    ####################################################################
+    #
+    def __init__(
+        self,
+        spool_dir,
+        segment_bytes=SEGMENT_BYTES,
+        fsync_every=FSYNC_EVERY,
+        fsync_interval=FSYNC_INTERVAL,
+    ):
+        """
+        Keyword Arguments:
+        spool_dir      -- directory holding the segment files
+        segment_bytes  -- size at which we start a new segment
+        fsync_every    -- fsync after this many appended lines
+        fsync_interval -- fsync if it has been this long since the last
+        """
+        self.spool_dir = Path(spool_dir)
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.cursor_file = self.spool_dir / "cursor"
+        self.lock = threading.Lock()
+
+        self.appended = 0
+        self.drained = 0
+        self.dead_lettered = 0
+        self.unsynced = 0
+        self.last_fsync = time.monotonic()
+
+        segments = self._segments()
+        if self.cursor_file.exists():
+            with open(self.cursor_file, "r") as f:
+                cursor = json.load(f)
+            self.read_seq, self.read_offset = cursor["seq"], cursor["offset"]
+        elif segments:
+            self.read_seq, self.read_offset = segments[0], 0
+        else:
+            self.read_seq, self.read_offset = 0, 0
+
+        # Re-open the newest segment for appending. If we crashed in
+        # the middle of writing a line, cut the partial line off.
+        #
+        self.write_seq = segments[-1] if segments else self.read_seq
+        path = self._segment_path(self.write_seq)
+        if path.exists():
+            self._truncate_partial_line(path)
+        self.fh = open(path, "ab")
+        self.write_offset = self.fh.tell()
+        self.synced_offset = self.write_offset
+        self.pending = self._count_pending(segments)
+
+    ####################################################################
+    #
+    def _segments(self):
+        return sorted(int(p.stem) for p in self.spool_dir.glob("*.seg"))
+
+    ####################################################################
+    #
+    def _segment_path(self, seq):
+        return self.spool_dir / f"{seq:012d}.seg"
+
+    ####################################################################
+    #
+    @staticmethod
+    def _truncate_partial_line(path):
+        with open(path, "rb+") as f:
+            data = f.read()
+            end = data.rfind(b"\n") + 1
+            if end != len(data):
+                f.truncate(end)
+
+    ####################################################################
+    #
+    def _count_pending(self, segments):
+        """
+        Count the lines not yet drained. Only done when the spool is
+        opened, after that we keep a running count.
+        """
+        pending = 0
+        for seq in segments:
+            if seq < self.read_seq:
+                continue
+            with open(self._segment_path(seq), "rb") as f:
+                if seq == self.read_seq:
+                    f.seek(self.read_offset)
+                while True:
+                    chunk = f.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    pending += chunk.count(b"\n")
+        return pending
+
+    ####################################################################
+    #
+    def _sync(self):
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.synced_offset = self.write_offset
+        self.unsynced = 0
+        self.last_fsync = time.monotonic()
+
+    ####################################################################
+    #
+    def _rotate(self):
+        self._sync()
+        self.fh.close()
+        self.write_seq += 1
+        self.fh = open(self._segment_path(self.write_seq), "ab")
+        self.write_offset = 0
+        self.synced_offset = 0
+
+    ####################################################################
+    #
+    def append(self, *lines):
+        """
+        Append one or more line protocol lines to the spool.
+        """
+        data = "".join(f"{line}\n" for line in lines).encode()
+        with self.lock:
+            self.fh.write(data)
+            self.write_offset += len(data)
+            self.appended += len(lines)
+            self.pending += len(lines)
+            self.unsynced += len(lines)
+            if (
+                self.unsynced >= self.fsync_every
+                or time.monotonic() - self.last_fsync >= self.fsync_interval
+            ):
+                self._sync()
+            if self.write_offset >= self.segment_bytes:
+                self._rotate()
+
+    ####################################################################
+    #
+    def flush(self):
+        """
+        Make sure everything appended so far is on disk.
+        """
+        with self.lock:
+            if self.unsynced:
+                self._sync()
+
+    ####################################################################
+    #
+    def read_batch(self, max_lines=DRAIN_BATCH_SIZE):
+        """
+        Return up to `max_lines` of the oldest undrained lines along with
+        the cursor to `commit()` once they have been written. Only lines
+        that have been fsync'd are returned.
+        """
+        with self.lock:
+            if self.unsynced and self.read_seq == self.write_seq:
+                self._sync()
+            write_seq, synced_offset = self.write_seq, self.synced_offset
+
+        lines = []
+        seq, offset = self.read_seq, self.read_offset
+        while len(lines) < max_lines:
+            path = self._segment_path(seq)
+            end = synced_offset if seq == write_seq else None
+            if path.exists():
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    data = f.read() if end is None else f.read(end - offset)
+                # Only take whole lines, and no more than we want.
+                #
+                got = data.split(b"\n")[:-1][: max_lines - len(lines)]
+                lines.extend(line.decode() for line in got)
+                offset += sum(len(line) + 1 for line in got)
+            if len(lines) >= max_lines or seq >= write_seq:
+                break
+            seq, offset = seq + 1, 0
+        return lines, (seq, offset)
+
+    ####################################################################
+    #
+    def commit(self, cursor, count):
+        """
+        Record that the lines up to `cursor` have been written and delete
+        any segments that are now completely drained.
+
+        Keyword Arguments:
+        cursor -- the cursor returned by `read_batch()`
+        count  -- the number of lines that were in the batch
+        """
+        seq, offset = cursor
+        write_json_atomic(self.cursor_file, {"seq": seq, "offset": offset})
+        with self.lock:
+            old_seq = self.read_seq
+            self.read_seq, self.read_offset = seq, offset
+            self.drained += count
+            self.pending -= count
+        for old in range(old_seq, seq):
+            try:
+                self._segment_path(old).unlink()
+            except FileNotFoundError:
+                pass
+
+    ####################################################################
+    #
+    def dead_letter(self, lines, cursor):
+        """
+        Move a batch influxdb will never accept out of the way: write it
+        to a segment in the dead-letter directory, named by the cursor
+        at the start of the batch, and commit past it.
+
+        Keyword Arguments:
+        lines  -- the batch from `read_batch()`
+        cursor -- the cursor returned with it
+        """
+        dead_dir = self.spool_dir / DEAD_LETTER_DIR
+        dead_dir.mkdir(exist_ok=True)
+        with self.lock:
+            start = f"{self.read_seq:012d}-{self.read_offset:012d}"
+        with open(dead_dir / f"{start}.seg", "w") as f:
+            f.write("".join(f"{line}\n" for line in lines))
+            f.flush()
+            os.fsync(f.fileno())
+        self.commit(cursor, len(lines))
+        with self.lock:
+            self.dead_lettered += len(lines)
+
+    ####################################################################
+    #
+    def size_bytes(self):
+        """
+        Bytes of undrained lines on disk.
+        """
+        with self.lock:
+            read_seq, read_offset = self.read_seq, self.read_offset
+        total = 0
+        for seq in self._segments():
+            if seq >= read_seq:
+                try:
+                    total += self._segment_path(seq).stat().st_size
+                except FileNotFoundError:
+                    pass
+        return total - read_offset
+
+    ####################################################################
+    #
+    def close(self):
+        with self.lock:
+            self._sync()
+            self.fh.close()
+
+
+##################################################################
+##################################################################
+#
+class SpoolDrainer(threading.Thread):
+    """
+    Background thread that drains a `Spool` in to influxdb (or anything
+    else that `write` writes to) in large batches. When a write fails we
+    back off exponentially and try the same batch again, unless
+    `is_permanent()` says retrying can not help, in which case the batch
+    is dead-lettered. A batch that is too large is split in half until
+    influxdb takes it, and the batch size grows back as writes succeed.
+    """
+
+    ####################################################################
+    #
+    def __init__(
+        self,
+        spool,
+        write,
+        batch_size=DRAIN_BATCH_SIZE,
+        idle_interval=DRAIN_IDLE_INTERVAL,
+        max_backoff=DRAIN_MAX_BACKOFF,
+        timings=None,
+    ):
+        """
+        Keyword Arguments:
+        spool         -- the `Spool` to drain
+        write         -- function taking a list of lines. Raises an
+                         exception if they could not be written.
+        batch_size    -- most lines to write in one call to `write`
+        idle_interval -- how long to wait when the spool is empty
+        max_backoff   -- longest we will wait between failing writes
+        timings       -- if not None, a `profiler.Profiler` or
+                         `profiler.PhaseTimings` each write is timed by
+                         as the "drain" phase
+        """
+        super().__init__(name="spool-drainer", daemon=True)
+        self.spool = spool
+        self.write = write
+        self.batch_size = batch_size
+        self.idle_interval = idle_interval
+        self.max_backoff = max_backoff
+        self.timings = timings
+        self.limit = batch_size  # lines per batch, less after a 413
+        self.stop_event = threading.Event()
+
+        self.write_failures = 0
+        self.last_error = None
+        self.drain_rate = 0.0  # lines per second, smoothed
+        self.backoff = 0.0
+
+    ####################################################################
+    #
+    def stop(self):
+        self.stop_event.set()
+
+    ####################################################################
+    #
+    def run(self):
+        while not self.stop_event.is_set():
+            lines, cursor = self.spool.read_batch(self.limit)
+            if not lines:
+                self.drain_rate *= 0.5
+                self.stop_event.wait(self.idle_interval)
+                continue
+            started = time.monotonic()
+            try:
+                if self.timings is None:
+                    self.write(lines)
+                else:
+                    with self.timings.phase("drain"):
+                        self.write(lines)
+            except Exception as e:
+                self.write_failures += 1
+                self.last_error = str(e)
+                if is_permanent(e):
+                    print(f"Dead-lettering {len(lines)} lines: {e}")
+                    self.spool.dead_letter(lines, cursor)
+                    continue
+                if is_too_large(e) and len(lines) > 1:
+                    self.limit = max(1, len(lines) // 2)
+                    print(f"Batch too large, trying {self.limit} lines")
+                    continue
+                self.backoff = min(
+                    self.max_backoff, max(self.idle_interval, self.backoff * 2)
+                )
+                self.stop_event.wait(self.backoff)
+                continue
+            self.spool.commit(cursor, len(lines))
+            self.backoff = 0.0
+            rate = len(lines) / max(time.monotonic() - started, 1e-6)
+            self.drain_rate = 0.8 * self.drain_rate + 0.2 * rate
+
+            # A short batch means we have caught up.
+            #
+            caught_up = len(lines) < self.limit
+            self.limit = min(self.batch_size, self.limit * 2)
+            if caught_up:
+                self.stop_event.wait(self.idle_interval)
+
+    ####################################################################
+    #
+    def metrics(self):
+        """
+        Return a dict describing the state of the spool and drainer.
+        """
+        spool = self.spool
+        return {
+            "spool_bytes": spool.size_bytes(),
+            "spool_segments": len(spool._segments()),
+            "pending": spool.pending,
+            "appended": spool.appended,
+            "drained": spool.drained,
+            "dead_lettered": spool.dead_lettered,
+            "drain_rate": round(self.drain_rate, 1),
+            "write_failures": self.write_failures,
+            "backoff": self.backoff,
+            "batch_limit": self.limit,
+        }
+
+    ####################################################################
+    #
+    def metrics_line(self, tags=None):
+        """
+        Return the metrics as a line protocol line so they can be
+        spooled and graphed along with everything else.
+        """
+        return line_protocol(
+            "spool", tags or {}, self.metrics(), time.time_ns()
+        )
@@ -11,30 +11,29 @@ Try using the tesla-api instead of talking to the powerwall directly
 import os
 import asyncio
 import pprint
-import time
 from pathlib import Path
-from collections import defaultdict
 from datetime import datetime, date, timedelta
 
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 
 import hvac
-from tesla_api import TeslaApiClient
 
-COLORS = ["red", "blue", "green", "yellow", "orange", "cyan", "magenta"]
-TESLA_API_TOKEN_FILE = Path("~/.tesla-api-token").expanduser()
+# Project modules
+#
+from exporters import (
+    CHARTS,
+    BlessedExporter,
+    TermgraphExporter,
+    export_rows,
+)
+from token_store import TokenStore, tesla_api_login
+from profiler import Profiler
+
 VAULT_TOKEN_FILE = Path("~/.vault-token").expanduser()
+TOKEN_STORE = TokenStore()
 VAULT_SECRETS_PATH = os.getenev("VAULT_SECRETS_PATH")
 
-CHARTS = [
-    "battery_power",
-    # "generator_power",
-    "grid_power",
-    # "grid_services_power",
-    "solar_power",
-]
-
 
 ####################################################################
 #
@@ -74,153 +73,62 @@ def get_login_credentials(hvac_client):
     return login_credentials["data"]
 
 
-#############################################################################
-#
-async def save_token(token):
-    """
-    Save the oauth token for re-use instead of logging in again.  We
-    store it in the vault cubbyhole secrets engine.
-    """
-    os.umask(0)
-    with open(
-        os.open(TESLA_API_TOKEN_FILE, os.O_CREAT | os.O_WRONLY, 0o600), "w"
-    ) as fh:
-        fh.write(token)
-
-
 ####################################################################
 #
-def read_token():
+async def login():
     """
-    Reads the token from the token file. Returns None if file does not
-    exist.
+    Log in to the tesla API with the credentials from vault. Called by
+    the token store when we need a new token.
     """
-    if not TESLA_API_TOKEN_FILE.exists():
-        return None
-    return open(TESLA_API_TOKEN_FILE, "r").read()
+    creds = get_login_credentials(get_hvac_client())
+    return await tesla_api_login(creds["username"], creds["password"])
 
 
 ####################################################################
 #
-def tg_plot_history_power(ts):
+def tg_plot_history_power(ts, path="termgraph.dat", columns=CHARTS):
     """
     Plot the timeseries data using termgraph
 
     Keyword Arguments:
 
-    ts -- list of dicts. Each dict contains the keys: 'battery_power',
-          'generator_power', 'grid_power', 'grid_services_power',
-          'solar_power', 'timestamp'
+    ts      -- iterable of dicts. Each dict contains the keys:
+               'battery_power', 'generator_power', 'grid_power',
+               'grid_services_power', 'solar_power', 'timestamp'
+    path    -- termgraph data file to write
+    columns -- which of the power keys to chart
 
     'timestamp' is of the format: : '2020-10-25T00:00:00-07:00'
     All of the other values are floats (presummably in watts?)
     """
-    # Open our output data file we are generating for termgraph and
-    # define in it what data columns we are writing.
-    #
-    with open("termgraph.dat", "w") as fh:
-        fh.write(f"# Tesla energy graph starting {ts[0]['timestamp']}\n")
-        fh.write(f"@ {','.join(CHARTS)}\n")
-
-        for ts_d in ts:
-            # We generate one row at a time. The row label, then the data
-            # in the same order as we wrote in the header above.
-            #
-            row = []
-            row.append(ts_d["timestamp"][11:16])
-            for c in CHARTS:
-                row.append(str(abs(ts_d[c])))
-            fh.write(",".join(row))
-            fh.write("\n")
+    export_rows(ts, [TermgraphExporter(path, columns)])
 
 
 ####################################################################
 #
-def write_blessed_datafile(ts):
+def write_blessed_datafile(ts, path="tesla-blessed.js", columns=CHARTS):
     """
     Write a javascript file that can be used by `blessed` to write an
     ascii chart
 
     Keyword Arguments:
-    ts -- list of dicts. Each dict contains the keys: 'battery_power',
-          'generator_power', 'grid_power', 'grid_services_power',
-          'solar_power', 'timestamp'
+    ts      -- iterable of dicts. Each dict contains the keys:
+               'battery_power', 'generator_power', 'grid_power',
+               'grid_services_power', 'solar_power', 'timestamp'
+    path    -- javascript file to write
+    columns -- which of the power keys to chart
 
     'timestamp' is of the format: : '2020-10-25T00:00:00-07:00'
     All of the other values are floats (presummably in watts?)
     """
-    min_y = 0
-    max_y = 0
-
-    timestamps = []
-    series = defaultdict(list)
-
-    for ts_d in ts:
-        timestamps.append(f"\"{ts_d['timestamp'][11:16]}\"")
-        for c in CHARTS:
-            min_y = min(min_y, ts_d[c])
-            max_y = max(max_y, ts_d[c])
-            series[c].append(str(ts_d[c]))
-
-    # Open our output data file we are generating for termgraph and
-    # define in it what data columns we are writing.
-    #
-    with open("tesla-blessed.js", "w") as fh:
-        fh.write(
-            f"""
-var blessed = require('blessed')
-, contrib = require('../index')
-, screen = blessed.screen()
-, line = contrib.line(
-      {{ width: 164
-      , height: 24
-      , xPadding: 5
-      , minY: {min_y}
-      , showLegend: true
-      , legend: {{width: 12}}
-      , wholeNumbersOnly: false // true=do not show fraction in y axis
-      , label: 'Power data'}});
-"""
-        )
-        series_names = []
-        for idx, c in enumerate(CHARTS):
-            series_name = f"series{idx}"
-            series_names.append(series_name)
-            fh.write(f"var {series_name} = {{\n")
-            fh.write(f"      title: '{c}',\n")
-            fh.write(f"      x: [{','.join(timestamps)}],\n")
-            fh.write(f"      y: [{','.join(series[c])}],\n")
-            fh.write(f"      style: {{line: '{COLORS[idx]}'}}\n")
-            fh.write("   };\n")
-        fh.write("screen.append(line); //must append before setting data\n")
-        set_data = ", ".join(series_names)
-        fh.write(f"line.setData([{set_data}]);\n")
-        fh.write(
-            """
-screen.key(['escape', 'q', 'C-c'], function(ch, key) {
-  return process.exit(0);
-});
-
-screen.render();
-"""
-        )
+    export_rows(ts, [BlessedExporter(path, columns)])
 
 
 #############################################################################
 #
 async def main():
     pp = pprint.PrettyPrinter(indent=2)
-    email = password = None
-    token = read_token()
-    if token is None:
-        hvac_client = get_hvac_client()
-        creds = get_login_credentials(hvac_client)
-        email = creds["username"]
-        password = creds["password"]
-
-    async with TeslaApiClient(
-        email, password, token, on_new_token=save_token
-    ) as client:
+    async with TOKEN_STORE.client(login) as client:
         energy_sites = await client.list_energy_sites()
         print(f"Number of energy sites = {len(energy_sites)}")
 
@@ -248,13 +156,31 @@ async def main():
         # )
         # print(f"History self consumption:\n{pp.pformat(history_sc)}")
 
+        # kill -USR1 to start and stop profiling, kill -USR2 for a report.
+        #
+        profiler = Profiler("tesla-api-play").install()
         while True:
-            live_status = await site_as01.get_energy_site_live_status()
-            print(f"Site live status:\n{pp.pformat(live_status)}")
-            time.sleep(150)
+            with profiler.phase("fetch"):
+                live_status = await site_as01.get_energy_site_live_status()
+            with profiler.phase("render"):
+                print(f"Site live status:\n{pp.pformat(live_status)}")
+            await asyncio.sleep(150)
 
         # tg_plot_history_power(history_power["time_series"])
         # write_blessed_datafile(history_power["time_series"])
+        #
+        # Or write every format in a single pass over the series, with
+        # CSVExporter and LineProtocolExporter imported from exporters:
+        #
+        # export_rows(
+        #     history_power["time_series"],
+        #     [
+        #         TermgraphExporter(),
+        #         BlessedExporter(),
+        #         CSVExporter(),
+        #         LineProtocolExporter(tags={"site": "as01"}),
+        #     ],
+        # )
 
         # print("Increment backup reserve percent")
         # await energy_sites[0].set_backup_reserve_percent(reserve + 1)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+A token store for the tesla_api oauth token shared by all of our
+scripts that talk to the Tesla cloud API.
+
+The token is saved with its expiry time. `TokenStore.get_token()` hands
+out the saved token while it is good and logs in again shortly before
+it lapses. Refreshes are serialized across processes with an exclusive
+lock on a lock file next to the token file, so when several pollers
+notice the token is about to expire only one of them logs in and the
+rest pick up the new token.
+
+The token file is replaced atomically so readers never see a partially
+written or stale token.
+
+Long running pollers should get their client from `TokenStore.client()`.
+It keeps checking the token in the background and swaps a new one in to
+the client before the old one lapses, so the refresh goes through the
+store's lock instead of the client refreshing on its own when a request
+finds the token has expired.
+"""
+
+# system imports
+#
+import os
+import json
+import time
+import fcntl
+import asyncio
+import tempfile
+from pathlib import Path
+from contextlib import asynccontextmanager
+
+TESLA_API_TOKEN_FILE = Path("~/.tesla-api-token").expanduser()
+
+# Assumed lifetime of a token we can not find an expiry for.
+#
+DEFAULT_TOKEN_LIFETIME = 8 * 60 * 60  # seconds
+
+# Log in again when the token has less than this long to live.
+#
+REFRESH_MARGIN = 15 * 60  # seconds
+
+LOCK_POLL_INTERVAL = 0.1  # seconds
+
+# How often a client from `TokenStore.client()` checks its token. Well
+# inside `REFRESH_MARGIN` so a refresh is never missed.
+#
+TOKEN_CHECK_INTERVAL = 5 * 60  # seconds
+
+
+####################################################################
+#
+def token_expiry(token, issued_at=None):
+    """
+    Return when `token` expires as seconds since the epoch. The
+    tesla_api token is a json string with 'created_at' and 'expires_in'.
+    If it is not we assume it has the default lifetime starting at
+    `issued_at` (now if not given).
+    """
+    try:
+        data = json.loads(token)
+        return float(data["created_at"]) + float(data["expires_in"])
+    except (ValueError, TypeError, KeyError):
+        if issued_at is None:
+            issued_at = time.time()
+        return issued_at + DEFAULT_TOKEN_LIFETIME
+
+
+####################################################################
+#
+async def tesla_api_login(email, password):
+    """
+    Log in to the tesla API with an email and password and return the
+    new token.
+    """
+    # Imported here so users of the store that never need to log in do
+    # not need tesla_api.
+    #
+    from tesla_api import TeslaApiClient
+
+    tokens = []
+
+    async def on_new_token(token):
+        tokens.append(token)
+
+    async with TeslaApiClient(
+        email, password, on_new_token=on_new_token
+    ) as client:
+        await client.authenticate()
+    return tokens[-1]
+
+
+####################################################################
+#
+def set_client_token(client, token):
+    """
+    Give a `TeslaApiClient` the token string `token`, if it is not the
+    one it already has. The client keeps its token in its `token`
+    attribute, parsed in to a dict, and uses it for every request.
+    """
+    current = getattr(client, "token", None)
+    if isinstance(current, dict):
+        token = json.loads(token)
+    if current != token:
+        client.token = token
+
+
+##################################################################
+##################################################################
+#
+class TokenStore:
+    """
+    Expiry aware, multi-process safe storage for the tesla_api token.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, path=TESLA_API_TOKEN_FILE, refresh_margin=None):
+        """
+        Keyword Arguments:
+        path           -- file the token is stored in
+        refresh_margin -- log in again when the token has less than this
+                          many seconds left. Defaults to `REFRESH_MARGIN`
+        """
+        self.path = Path(path)
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        self.refresh_margin = (
+            REFRESH_MARGIN if refresh_margin is None else refresh_margin
+        )
+
+    ####################################################################
+    #
+    @asynccontextmanager
+    async def _locked(self):
+        """
+        Hold an exclusive lock on the lock file. We poll with a non
+        blocking lock so that waiting does not block the event loop.
+        """
+        fd = os.open(self.lock_path, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(LOCK_POLL_INTERVAL)
+            yield
+        finally:
+            os.close(fd)
+
+    ####################################################################
+    #
+    def read(self):
+        """
+        Return (token, expires_at) from the token file or None if there
+        is no token. A file holding just the bare token, as we used to
+        write them, is handled too.
+        """
+        if not self.path.exists():
+            return None
+        with open(self.path, "r") as fh:
+            contents = fh.read()
+        try:
+            data = json.loads(contents)
+            return data["token"], data["expires_at"]
+        except (ValueError, TypeError, KeyError):
+            contents = contents.strip()
+            if not contents:
+                return None
+            return contents, token_expiry(contents, self.path.stat().st_mtime)
+
+    ####################################################################
+    #
+    def write(self, token, expires_at=None):
+        """
+        Atomically replace the token file with `token` and its expiry.
+        """
+        if expires_at is None:
+            expires_at = token_expiry(token)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=self.path.parent, prefix=f".{self.path.name}."
+        )
+        try:
+            with os.fdopen(fd, "w") as fh:
+                json.dump({"token": token, "expires_at": expires_at}, fh)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    ####################################################################
+    #
+    def is_fresh(self, expires_at):
+        return expires_at - time.time() > self.refresh_margin
+
+    ####################################################################
+    #
+    async def save_token(self, token):
+        """
+        Save a new token. Suitable as the `on_new_token` callback of a
+        `TeslaApiClient`.
+        """
+        async with self._locked():
+            self.write(token)
+
+    ####################################################################
+    #
+    async def get_token(self, login):
+        """
+        Return a token that is good for at least `refresh_margin`
+        seconds, calling `login()` for a new one if needed.
+
+        Keyword Arguments:
+        login -- coroutine function returning a new token string
+        """
+        saved = self.read()
+        if saved is not None and self.is_fresh(saved[1]):
+            return saved[0]
+
+        async with self._locked():
+            # Another process may have logged in while we were waiting
+            # for the lock.
+            #
+            saved = self.read()
+            if saved is not None and self.is_fresh(saved[1]):
+                return saved[0]
+            token = await login()
+            self.write(token)
+            return token
+
+    ####################################################################
+    #
+    async def refresh_client(self, client, login):
+        """
+        Make sure `client` has a token good for at least `refresh_margin`
+        seconds, getting a new one with `get_token()` if needed.
+        """
+        token = await self.get_token(login)
+        set_client_token(client, token)
+
+    ####################################################################
+    #
+    async def keep_fresh(self, client, login, interval=TOKEN_CHECK_INTERVAL):
+        """
+        Call `refresh_client()` every `interval` seconds until cancelled.
+        A failed refresh is retried next time around. The client still has
+        its old token until it expires.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh_client(client, login)
+            except Exception as e:
+                print(f"Unable to refresh the tesla API token: {e}")
+
+    ####################################################################
+    #
+    @asynccontextmanager
+    async def client(self, login, interval=TOKEN_CHECK_INTERVAL):
+        """
+        An async context manager giving a `TeslaApiClient` whose token is
+        kept fresh through the store while it is open.
+
+        Keyword Arguments:
+        login    -- coroutine function returning a new token string
+        interval -- seconds between checks of the token
+        """
+        from tesla_api import TeslaApiClient
+
+        token = await self.get_token(login)
+        async with TeslaApiClient(
+            token=token, on_new_token=self.save_token
+        ) as client:
+            task = asyncio.create_task(
+                self.keep_fresh(client, login, interval)
+            )
+            try:
+                yield client
+            finally:
+                task.cancel()
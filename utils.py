@@ -13,7 +13,7 @@ from pathlib import Path
 
 import hvac
 
-IFLUXDB_CREDS_PATH = os.getenv("IFLUXDB_CREDS_PATH")
+INFLUXDB_CREDS_PATH = os.getenv("INFLUXDB_CREDS_PATH")
 VAULT_TOKEN_FILE = Path("~/.vault-token").expanduser()
 
 